@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -93,11 +94,39 @@ WSGI_APPLICATION = 'alwaysontime.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # Django's, with the 'transaction_mode' option of Django 5.1
+        'ENGINE': 'timers.sqlite3',
         'NAME': BASE_DIR / 'database' / 'db.sqlite3',
+        'OPTIONS': {
+            # The transactions take the write lock upfront, see
+            # 'timers.sqlite3.base'
+            'transaction_mode': 'IMMEDIATE',
+        },
+        # Persistent connections: the pragmas of 'TIMERS_SQLITE_PRAGMAS' are
+        # set once per connection instead of once per request
+        'CONN_MAX_AGE': 60,
+        # Checks a persistent connection still works before reusing it. Only
+        # from Django 4.1: until then, Django closes the connections that
+        # errored at the end of the request
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# 'DB_ENGINE=postgresql' switches to PostgreSQL, which several instances of
+# the app and of the scheduler can share, e.g. the 'postgres' service of
+# 'docker-compose.yml'
+if os.environ.get('DB_ENGINE') == 'postgresql':
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('DB_NAME', 'alwaysontime'),
+        'USER': os.environ.get('DB_USER', 'alwaysontime'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+        'HOST': os.environ.get('DB_HOST', 'localhost'),
+        'PORT': os.environ.get('DB_PORT', '5432'),
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -186,3 +215,90 @@ SHARED_CALENDAR_OWNER = 'flori@nkempenich.com'
 TIMERS_SHOW_X_MIN_PAST = 10
 TIMERS_SHOW_X_MIN_FUTURE = 8 * 60
 GOOGLE_APP_NAME = 'Google'
+# Max number of items per page returned by the Google API (max: 2500 for
+# events, 250 for calendars)
+TIMERS_GOOGLE_API_PAGE_SIZE = 250
+# Number of events written to the DB at once during a sync
+TIMERS_SYNC_WRITE_BATCH_SIZE = 100
+# How the events of all the active calendars are fetched during a refresh:
+# - 'batch': in Google batch requests
+# - 'threads': in parallel, 'TIMERS_SYNC_MAX_PARALLEL_CALENDARS' at a time
+TIMERS_SYNC_FETCH_MODE = 'batch'
+TIMERS_SYNC_MAX_PARALLEL_CALENDARS = 4
+# Refreshes skip the calendars, and calendar lists, synced less than that many
+# seconds ago, unless forced
+TIMERS_EVENTS_MAX_STALENESS_SECONDS = 60
+TIMERS_CALENDARS_MAX_STALENESS_SECONDS = 5 * 60
+# Google access tokens expiring within that many seconds are refreshed in the
+# background, ahead of their expiry
+TIMERS_TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+# Ready-to-use Google API clients are cached per user, see 'timers.clients'
+TIMERS_API_CLIENT_CACHE_SIZE = 256
+TIMERS_API_CLIENT_CACHE_TTL_SECONDS = 15 * 60
+# Background sync with Google, see 'timers.scheduler'. Once
+# 'manage.py run_sync_scheduler' runs, set 'TIMERS_REFRESH_ON_PAGE_LOAD' to
+# False so the pages stop triggering a refresh every time they load
+TIMERS_REFRESH_ON_PAGE_LOAD = True
+TIMERS_SCHEDULER_EVENTS_INTERVAL_SECONDS = 60
+TIMERS_SCHEDULER_CALENDAR_LIST_INTERVAL_SECONDS = 15 * 60
+# Delay before syncing again after a failed sync
+TIMERS_SCHEDULER_RETRY_SECONDS = 5 * 60
+# How often the schedule is reloaded from the DB, to pick up the calendars
+# activated, notified by Google or synced by other instances in the meantime
+TIMERS_SCHEDULER_POLL_SECONDS = 10
+# A process syncing a calendar or a calendar list holds a lease on it for
+# that long at most, see 'timers.leases'
+TIMERS_SYNC_LEASE_SECONDS = 5 * 60
+# How often a process waiting for a lease checks whether it's released
+TIMERS_SYNC_LEASE_POLL_SECONDS = 0.2
+# Concurrent refreshes of the same data are coalesced, see
+# 'timers.singleflight'. Callers wait at most that long for the refresh of
+# another process
+TIMERS_SINGLE_FLIGHT_TIMEOUT_SECONDS = 30
+# Push notifications from Google, see 'timers.channels'. Google only sends
+# them to a public HTTPS address, e.g.
+# 'https://example.com/calendars/notifications/'. Disabled when None
+TIMERS_WATCH_CHANNELS_WEBHOOK_URL = None
+TIMERS_WATCH_CHANNELS_TTL_SECONDS = 7 * 24 * 60 * 60
+# Channels expiring within that many seconds are replaced by new ones
+TIMERS_WATCH_CHANNELS_RENEWAL_MARGIN_SECONDS = 24 * 60 * 60
+# Calendars Google refused to watch, e.g. the ones which don't support push
+# notifications, are only polled, and watched again after that many seconds
+TIMERS_WATCH_CHANNELS_RETRY_SECONDS = 24 * 60 * 60
+# Calendars watched through a channel are still synced that often, in case a
+# notification got lost
+TIMERS_SCHEDULER_WATCHED_EVENTS_INTERVAL_SECONDS = 6 * 60 * 60
+# The home page of a user is cached that long at most, or until a sync
+# changes its data, see 'timers.dashboard'. Not cached when 0
+TIMERS_DASHBOARD_CACHE_SECONDS = 60
+# The home page polls the events to show that often, see
+# 'timers.views.events_upcoming'. The events returned are the same during
+# each period of 'TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS', so they can be
+# revalidated with an ETag
+TIMERS_UPCOMING_EVENTS_POLL_SECONDS = 30
+TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS = 5 * 60
+# Event streams of the home page, see 'timers.streams'. Served under ASGI only
+# (e.g. 'uvicorn alwaysontime.asgi:application'), the page polls otherwise.
+# 'timers.brokers.LocalBroker' only sees the syncs of the process serving the
+# streams: use 'timers.brokers.PollingBroker' when the scheduler runs in
+# another process
+TIMERS_STREAM_BROKER = 'timers.brokers.LocalBroker'
+TIMERS_STREAM_POLL_SECONDS = 1
+TIMERS_STREAM_HEARTBEAT_SECONDS = 15
+# HTTP client of the async Google Calendar client, see
+# 'timers.async_google_api'. Its connections are shared by all the requests
+# served by the event loop
+TIMERS_ASYNC_HTTP_MAX_CONNECTIONS = 20
+TIMERS_ASYNC_HTTP_TIMEOUT_SECONDS = 30
+# Set on every new SQLite connection, see 'timers.db'. WAL lets the dashboards
+# read while a sync writes. 'synchronous = normal' is safe in WAL mode: a
+# power loss can only lose the last transactions, never corrupt the database.
+# The connections wait up to 'busy_timeout' milliseconds for a lock, and
+# 'cache_size' is in KiB when negative
+TIMERS_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    'mmap_size': 128 * 1024 * 1024,
+    'cache_size': -32 * 1024,
+}
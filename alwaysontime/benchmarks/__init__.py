@@ -0,0 +1,11 @@
+"""
+Benchmarks, run from the `alwaysontime` directory:
+
+    python -m benchmarks.<name_of_the_benchmark>
+"""
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alwaysontime.settings')
+django.setup()
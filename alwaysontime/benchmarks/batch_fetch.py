@@ -0,0 +1,51 @@
+"""
+Time to fetch the events of several calendars against a local fake Google
+API, depending on how the requests are sent:
+- serial: one request per calendar, one after the other
+- batch: Google batch requests
+- threads: one request per calendar, in parallel on a thread pool of
+  `TIMERS_SYNC_MAX_PARALLEL_CALENDARS` threads
+
+    python -m benchmarks.batch_fetch [number_of_calendars] [latency_in_ms]
+"""
+import sys
+import time
+
+from django.conf import settings
+
+from timers.calendar import _prefetch_first_pages_in_parallel
+from timers.tests.fake_google_api import FakeGoogleApi
+
+
+def fetch_events(calendar_api, number_of_calendars, mode):
+    all_events = [calendar_api.sync_events(f'cal{i}', sync_token='token')
+                  for i in range(number_of_calendars)]
+    if mode == 'batch':
+        calendar_api.prefetch_first_pages(all_events)
+    elif mode == 'threads':
+        syncs = [(None, events, None) for events in all_events]
+        all_events = [events for _, events, _
+                      in _prefetch_first_pages_in_parallel(calendar_api, syncs)]
+    return sum(len(list(events)) for events in all_events)
+
+
+def main(number_of_calendars=12, latency_in_ms=100):
+    with FakeGoogleApi(latency=latency_in_ms / 1000) as fake_api:
+        calendar_api = fake_api.calendar_api()
+        print(f'{number_of_calendars} calendars, '
+              f'{latency_in_ms}ms latency per HTTP request, '
+              f'{settings.TIMERS_SYNC_MAX_PARALLEL_CALENDARS} threads')
+
+        for mode in ('serial', 'batch', 'threads'):
+            fake_api.http_requests = 0
+            start = time.perf_counter()
+            events = fetch_events(calendar_api, number_of_calendars, mode)
+            duration = time.perf_counter() - start
+            print(f'  {mode:>7}: '
+                  f'{duration * 1000:7.1f}ms '
+                  f'| {fake_api.http_requests} HTTP requests '
+                  f'| {events} events')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,108 @@
+"""
+Requests per second of the home page, with its data cached per user (see
+`timers.dashboard`) and without, for concurrent users reloading it.
+
+Runs against a throwaway test database.
+
+    python -m benchmarks.dashboard_cache [users] [events_per_user] [seconds]
+"""
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from allauth.socialaccount.models import SocialAccount, SocialApp, \
+    SocialToken
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment, override_settings
+from django.utils import timezone
+
+from timers.models import Calendar, Event, UserSyncState
+
+
+def create_users(number_of_users, events_per_user):
+    app = SocialApp.objects.create(name=settings.GOOGLE_APP_NAME,
+                                   client_id='client_id',
+                                   secret='secret')
+    users = []
+    for i in range(number_of_users):
+        user = User.objects.create_user(username=f'user{i}')
+        SocialToken.objects.create(
+                account=SocialAccount.objects.create(user=user, uid=str(i)),
+                app=app,
+                token='token'
+        )
+        UserSyncState.objects.create(user=user)
+        cal = Calendar.objects.create(google_id='cal',
+                                      name='cal',
+                                      user=user,
+                                      active=True)
+        now = timezone.now()
+        Event.objects.bulk_create([
+            Event(google_id=f'event{j}',
+                  name=f'Event {j}',
+                  start=now + timedelta(minutes=j),
+                  end=now + timedelta(minutes=j + 30),
+                  calendar=cal,
+                  user=user,
+                  active=True)
+            for j in range(events_per_user)
+        ])
+        users.append(user)
+    return users
+
+
+def logged_in_client(user):
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def reload_home_page(client, deadline):
+    requests = 0
+    try:
+        while time.monotonic() < deadline:
+            assert client.get('/').status_code == 200
+            requests += 1
+    finally:
+        connections.close_all()
+    return requests
+
+
+def requests_per_second(clients, seconds):
+    deadline = time.monotonic() + seconds
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        requests = sum(executor.map(
+                lambda client: reload_home_page(client, deadline), clients
+        ))
+    return requests / seconds
+
+
+def main(number_of_users=8, events_per_user=50, seconds=5):
+    setup_test_environment()
+    old_database_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        # Logged in beforehand: concurrent writes would lock SQLite
+        clients = [logged_in_client(user)
+                   for user in create_users(number_of_users, events_per_user)]
+        print(f'{number_of_users} concurrent users, '
+              f'{events_per_user} events each, '
+              f'{seconds}s per run')
+        for label, cache_seconds in (('uncached', 0), ('cached', 60)):
+            with override_settings(
+                    TIMERS_DASHBOARD_CACHE_SECONDS=cache_seconds,
+                    TIMERS_REFRESH_ON_PAGE_LOAD=False
+            ):
+                rate = requests_per_second(clients, seconds)
+                print(f'  {label:>8}: {rate:7.1f} requests/s')
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
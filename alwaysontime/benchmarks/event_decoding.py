@@ -0,0 +1,79 @@
+"""
+Decoding throughput, and memory held by the decoded events, per 10k events:
+`timers.google_events.decode_event` against the dicts parsed with `dateutil`
+it replaced.
+
+The events are the ones of `timers.tests.fake_google_api.EVENTS_LIST`,
+repeated, as restricted by the 'fields' mask of
+`GoogleCalendarApi.sync_events`.
+
+    python -m benchmarks.event_decoding [number_of_events] [repeat]
+"""
+import json
+import sys
+import time
+import tracemalloc
+
+import dateutil.parser
+
+from timers.google_api import GoogleCalendarApi, list_fields
+from timers.google_events import decode_event
+from timers.tests.fake_google_api import apply_fields_mask, EVENTS_LIST
+
+
+def decode_event_as_dict(event):
+    """How `GoogleCalendarApi` used to decode the events"""
+    if event.get('status') == 'cancelled':
+        return {'id': event['id'], 'deleted': True}
+    return {
+        'id': event['id'],
+        'name': event['summary'],
+        'start': dateutil.parser.isoparse(event['start']['dateTime']),
+        'end': dateutil.parser.isoparse(event['end']['dateTime'])
+    }
+
+
+def load_items(number_of_events):
+    page = apply_fields_mask(json.loads(EVENTS_LIST.read_text()),
+                             list_fields(GoogleCalendarApi.EVENT_FIELDS))
+    items = page['items']
+    return [items[i % len(items)] for i in range(number_of_events)]
+
+
+def events_per_second(decode, items, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            decode(item)
+    return len(items) * repeat / (time.perf_counter() - start)
+
+
+def memory_of_decoded_events(decode, items):
+    """
+    Bytes allocated for the decoded events, and still held by them.
+    'items' are not counted: they are allocated beforehand.
+    """
+    tracemalloc.start()
+    try:
+        events = [decode(item) for item in items]
+        held, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del events
+    return held
+
+
+def main(number_of_events=10_000, repeat=5):
+    items = load_items(number_of_events)
+    print(f'{number_of_events} events, decoded {repeat} times')
+    for label, decode in (('dicts', decode_event_as_dict),
+                          ('records', decode_event)):
+        throughput = events_per_second(decode, items, repeat)
+        held = memory_of_decoded_events(decode, items)
+        print(f'  {label:>7}: {throughput:9.0f} events/s '
+              f'| {held / 1024 / number_of_events * 10_000:7.0f} KiB '
+              f'per 10k events ({held / number_of_events:4.0f} bytes/event)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
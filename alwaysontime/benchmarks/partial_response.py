@@ -0,0 +1,55 @@
+"""
+Bytes on the wire and decoding time per event of a page of events, as Google
+returns it to `GoogleCalendarApi.sync_events`: with the whole events or only
+the fields of the 'fields' mask, compressed with gzip or not.
+
+The page is `timers.tests.fake_google_api.EVENTS_LIST`: 50 events of a team
+calendar, with their descriptions, attendees, conference data, etc.
+Decoding includes decompressing, parsing the JSON and mapping the events to
+the domain.
+
+    python -m benchmarks.partial_response [repeat]
+"""
+import gzip
+import json
+import sys
+import time
+
+from timers.tests.fake_google_api import apply_fields_mask, EVENTS_LIST
+from timers.google_api import GoogleCalendarApi, list_fields
+
+
+def decode(body, compressed):
+    if compressed:
+        body = gzip.decompress(body)
+    return [GoogleCalendarApi._map_event_to_domain(item)
+            for item in json.loads(body)['items']]
+
+
+def main(repeat=200):
+    page = json.loads(EVENTS_LIST.read_text())
+    number_of_events = len(page['items'])
+    masked_page = apply_fields_mask(
+            page,
+            list_fields(GoogleCalendarApi.EVENT_FIELDS,
+                        GoogleCalendarApi.EVENT_PAGE_FIELDS)
+    )
+    print(f'{number_of_events} events, decoded {repeat} times')
+
+    for label, response in (('full', page), ('fields', masked_page)):
+        body = json.dumps(response).encode()
+        for compressed in (False, True):
+            wire_body = gzip.compress(body) if compressed else body
+            start = time.perf_counter()
+            for _ in range(repeat):
+                decode(wire_body, compressed)
+            seconds = time.perf_counter() - start
+            print(f'  {label:>6}{" + gzip" if compressed else "       "}: '
+                  f'{len(wire_body):7} bytes '
+                  f'({len(wire_body) / number_of_events:6.0f}/event) '
+                  f'| {seconds / repeat / number_of_events * 1e6:5.1f}µs '
+                  f'per event')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
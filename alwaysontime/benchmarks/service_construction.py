@@ -0,0 +1,44 @@
+"""
+Cost of getting an authorized Calendar v3 client for a request:
+- before: the service is built from the discovery document on every request
+- after: the resources are built once per process, only the authorized HTTP
+  client is created per request
+
+    python -m benchmarks.service_construction [iterations]
+"""
+import sys
+import time
+
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+
+from timers.google_api import calendar_resource
+
+
+def build_service_per_request(credentials):
+    service = build('calendar', 'v3', credentials=credentials)
+    return service.events(), service.calendarList()
+
+
+def use_cached_resources(credentials):
+    http = AuthorizedHttp(credentials, http=build_http())
+    return calendar_resource('events'), calendar_resource('calendarList'), http
+
+
+def main(iterations=200):
+    credentials = Credentials(token='not_used')
+    print(f'{iterations} iterations')
+    for construct in (build_service_per_request, use_cached_resources):
+        construct(credentials)  # Warm up
+        start = time.perf_counter()
+        for _ in range(iterations):
+            construct(credentials)
+        duration = time.perf_counter() - start
+        print(f'  {construct.__name__:>25}: '
+              f'{duration / iterations * 1000:7.3f}ms per request')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
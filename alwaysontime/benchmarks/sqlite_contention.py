@@ -0,0 +1,123 @@
+"""
+Home page reads per second while other users refresh their events, with the
+SQLite connections tuned like in the settings (`TIMERS_SQLITE_PRAGMAS` and
+the 'transaction_mode' option, see `timers.db` and `timers.sqlite3`) and with
+the defaults of SQLite and Django. Also counts the requests failing with
+"database is locked".
+
+Runs against a throwaway test database, in a file since the locks of an
+in-memory database differ, and a local fake of the Google API.
+
+    python -m benchmarks.sqlite_contention [readers] [writers] [seconds]
+"""
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import patch
+
+from django.conf import settings
+from django.db import connection, connections, OperationalError
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment, override_settings
+
+import timers.calendar
+from benchmarks.dashboard_cache import create_users, logged_in_client
+from timers.calendar import refresh_events
+from timers.tests.fake_google_api import FakeGoogleApi
+
+# Label, pragmas, 'transaction_mode' option
+PROFILES = (
+    ('defaults', {'journal_mode': 'delete'}, None),
+    ('tuned',
+     settings.TIMERS_SQLITE_PRAGMAS,
+     settings.DATABASES['default']['OPTIONS'].get('transaction_mode')),
+)
+
+
+def read_home_page(client, deadline):
+    return _repeat(lambda: client.get('/'), deadline)
+
+
+def refresh_events_of(user, deadline):
+    return _repeat(lambda: refresh_events(user, force=True), deadline)
+
+
+def _repeat(func, deadline):
+    done = failed = 0
+    try:
+        while time.monotonic() < deadline:
+            try:
+                func()
+                done += 1
+            except OperationalError as error:
+                if 'locked' not in str(error):
+                    raise
+                failed += 1
+    finally:
+        connections.close_all()
+    return done, failed
+
+
+def run(readers, writers, seconds):
+    """
+    'readers' are the clients of the users reading their home page, 'writers'
+    the users refreshing their events. Returns the reads and the writes done
+    and failed.
+    """
+    deadline = time.monotonic() + seconds
+    with ThreadPoolExecutor(max_workers=len(readers) + len(writers)) \
+            as executor:
+        reads = [executor.submit(read_home_page, client, deadline)
+                 for client in readers]
+        writes = [executor.submit(refresh_events_of, user, deadline)
+                  for user in writers]
+        return [tuple(map(sum, zip(*(f.result() for f in futures))))
+                for futures in (reads, writes)]
+
+
+def main(number_of_readers=8, number_of_writers=4, seconds=5):
+    setup_test_environment()
+    print(f'{number_of_readers} users reading their home page, '
+          f'{number_of_writers} refreshing their events, '
+          f'{seconds}s per run')
+    with FakeGoogleApi(latency=0, events_per_calendar=200) as fake_api, \
+            tempfile.TemporaryDirectory() as database_dir, \
+            patch.object(timers.calendar,
+                         'calendar_api_for',
+                         lambda user: fake_api.calendar_api()):
+        for label, pragmas, transaction_mode in PROFILES:
+            connection.settings_dict['TEST']['NAME'] = \
+                str(Path(database_dir) / f'{label}.sqlite3')
+            connection.settings_dict['OPTIONS'] = \
+                {'transaction_mode': transaction_mode}
+            with override_settings(TIMERS_SQLITE_PRAGMAS=pragmas,
+                                   TIMERS_DASHBOARD_CACHE_SECONDS=0,
+                                   TIMERS_REFRESH_ON_PAGE_LOAD=False):
+                old_database_name = \
+                    connection.creation.create_test_db(verbosity=0)
+                try:
+                    users = create_users(number_of_readers
+                                         + number_of_writers, 50)
+                    # Logged in beforehand, to only measure the reads
+                    readers = [logged_in_client(user)
+                               for user in users[:number_of_readers]]
+                    (reads, failed_reads), (writes, failed_writes) = run(
+                            readers,
+                            users[number_of_readers:],
+                            seconds
+                    )
+                finally:
+                    connection.creation.destroy_test_db(old_database_name,
+                                                        verbosity=0)
+            print(f'  {label:>8}: '
+                  f'{reads / seconds:7.1f} reads/s '
+                  f'({failed_reads} locked) '
+                  f'| {writes / seconds:5.1f} refreshes/s '
+                  f'({failed_writes} locked)')
+    teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,9 +1,16 @@
+from contextlib import contextmanager
+
 import pytest
 from allauth.socialaccount.models import SocialToken, SocialAccount, SocialApp
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
+from timers.clients import forget_all_calendar_apis
 from timers.models import Calendar
+from timers.tests.fake_google_api import FakeGoogleApi
 
 TEST_PASSWORD = 'testuser1234@'
 TEST_USERNAME = 'testuser'
@@ -12,6 +19,61 @@ TEST_GOOGLE_TOKEN = 'abcdefg123456'
 TEST_GOOGLE_REFRESH_TOKEN = 'zyxvgadf482'
 TEST_GOOGLE_APP_CLIENT_ID = 'google_app_client_id'
 TEST_GOOGLE_APP_SECRET = 'google_app_client_secret'
+# Queries of every request of a logged in user before the view runs: loading
+# its session, then its user
+LOGIN_QUERIES = 2
+
+# The suite runs against SQLite, or PostgreSQL with 'DB_ENGINE=postgresql'
+only_on_sqlite = pytest.mark.skipif(connection.vendor != 'sqlite',
+                                    reason="Specific to SQLite")
+only_on_postgresql = pytest.mark.skipif(connection.vendor != 'postgresql',
+                                        reason="Specific to PostgreSQL")
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def no_cached_calendar_apis():
+    forget_all_calendar_apis()
+    yield
+    forget_all_calendar_apis()
+
+
+@pytest.fixture
+def assert_query_budget():
+    """
+    Asserts the request made in the 'with' block runs at most 'budget'
+    queries, on top of the `LOGIN_QUERIES` of a logged in user. The
+    budgets of the views are documented in their docstrings.
+
+    Savepoints aren't counted: only the tests wrap the views in a transaction.
+    """
+
+    @contextmanager
+    def assert_query_budget(budget, logged_in=True):
+        with CaptureQueriesContext(connection) as context:
+            yield
+        queries = [q['sql'] for q in context.captured_queries
+                   if 'SAVEPOINT' not in q['sql']]
+        max_queries = budget + (LOGIN_QUERIES if logged_in else 0)
+        assert len(queries) <= max_queries, \
+            f"{len(queries)} queries, over the budget of {max_queries}:\n" \
+            + '\n'.join(queries)
+
+    return assert_query_budget
+
+
+@pytest.fixture
+def fake_google_api():
+    """
+    A local stand-in for the Google Calendar API, see
+    `timers.tests.fake_google_api`
+    """
+    with FakeGoogleApi(latency=0) as fake_api:
+        yield fake_api
 
 
 @pytest.fixture
@@ -50,6 +112,14 @@ def logged_in_test_user(test_user, client):
     return test_user
 
 
+def create_calendar(user, google_id, active=True, **kwargs):
+    return Calendar.objects.create(google_id=google_id,
+                                   name=google_id,
+                                   user=user,
+                                   active=active,
+                                   **kwargs)
+
+
 @pytest.fixture
 def test_user_calendar(test_user):
     return Calendar.objects.create(
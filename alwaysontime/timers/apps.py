@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class TimersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'timers'
+
+    def ready(self):
+        # Connects the signals invalidating the cached clients
+        import timers.clients  # noqa: F401
+        # Connects the signal tuning the SQLite connections
+        import timers.db  # noqa: F401
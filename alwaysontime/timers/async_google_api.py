@@ -0,0 +1,180 @@
+"""
+asyncio counterpart of `GoogleCalendarApi`, for the async views served under
+ASGI: waiting for Google doesn't tie up a thread, only a coroutine.
+
+Talks to the REST API of Google Calendar directly with httpx, instead of the
+blocking `googleapiclient`/httplib2 stack. The domain objects and the errors
+are the same as `GoogleCalendarApi`'s.
+"""
+import asyncio
+import weakref
+from urllib.parse import quote
+
+import httpx
+import httplib2
+from django.conf import settings
+from googleapiclient.errors import HttpError
+
+from timers.google_api import GoogleCalendarApi, SyncTokenExpired, \
+    list_fields, _to_google_format
+
+GOOGLE_CALENDAR_API_URL = 'https://www.googleapis.com/calendar/v3/'
+
+# Event loop -> its HTTP client. A client, and its connection pool, can only
+# be used by the loop it was created in.
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def http_client():
+    """
+    The HTTP client of the running event loop, shared by all the
+    `AsyncGoogleCalendarApi`, so they reuse each other's connections
+    """
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None or client.is_closed:
+        limits = httpx.Limits(
+                max_connections=settings.TIMERS_ASYNC_HTTP_MAX_CONNECTIONS
+        )
+        client = _http_clients[loop] = httpx.AsyncClient(
+                limits=limits,
+                timeout=settings.TIMERS_ASYNC_HTTP_TIMEOUT_SECONDS,
+                # Google only compresses the responses of the user agents
+                # saying they accept gzip, like `googleapiclient` does
+                headers={'accept-encoding': 'gzip',
+                         'user-agent': 'alwaysontime (gzip)'}
+        )
+    return client
+
+
+class AsyncGoogleCalendarApi:
+    def __init__(self, credentials, url=GOOGLE_CALENDAR_API_URL):
+        """
+        'credentials' must be valid: they are not refreshed, see
+        `timers.clients.async_calendar_api_for`
+        """
+        self.credentials = credentials
+        self.url = url
+
+    def sync_events(self, calendar_id, sync_token=None, before=None,
+                    after=None, page_size=None):
+        """
+        See `GoogleCalendarApi.sync_events`. Returns an `AsyncPagedResults`.
+        """
+        if sync_token:
+            params = {'syncToken': sync_token}
+        else:
+            if not before.tzinfo or not after.tzinfo:
+                raise RuntimeError("Make sure to set 'tzinfo' in "
+                                   "'before' and 'after' parameters")
+            params = {'timeMin': _to_google_format(before),
+                      'timeMax': _to_google_format(after)}
+
+        events = AsyncPagedResults(
+                self,
+                f"calendars/{quote(calendar_id, safe='')}/events",
+                lambda item: GoogleCalendarApi._map_event_to_domain(
+                        item, events.time_zone
+                ),
+                page_size,
+                singleEvents='true',
+                fields=list_fields(GoogleCalendarApi.EVENT_FIELDS,
+                                   GoogleCalendarApi.EVENT_PAGE_FIELDS),
+                **params
+        )
+        return events
+
+    async def sync_calendars(self, sync_token=None):
+        """
+        See `GoogleCalendarApi.sync_calendars`
+        """
+        params = {'syncToken': sync_token} if sync_token else {}
+        calendars = await AsyncPagedResults(
+                self,
+                'users/me/calendarList',
+                GoogleCalendarApi._map_calendar_to_domain,
+                fields=list_fields(GoogleCalendarApi.CALENDAR_FIELDS),
+                **params
+        ).fetch_all()
+        return list(calendars), calendars.next_sync_token
+
+    async def get(self, path, params):
+        """
+        Returns the JSON body of the response. Errors are raised as the
+        `HttpError` of `googleapiclient`, like `GoogleCalendarApi` does.
+        """
+        headers = {}
+        self.credentials.apply(headers)
+        response = await http_client().get(self.url + path,
+                                           params=params,
+                                           headers=headers)
+        if response.status_code >= 400:
+            raise HttpError(
+                    httplib2.Response({'status': response.status_code,
+                                       'reason': response.reason_phrase}),
+                    response.content,
+                    uri=str(response.url)
+            )
+        return response.json()
+
+
+class AsyncPagedResults:
+    """
+    Asynchronously iterates over the items of a Google API 'list' call,
+    following 'nextPageToken', see `timers.google_api.PagedResults`.
+
+    Can only be iterated over once. 'next_sync_token' is set once the last
+    page has been received, 'time_zone' once the first one has.
+    """
+
+    def __init__(self, calendar_api, path, map_item, page_size=None,
+                 **params):
+        self._calendar_api = calendar_api
+        self._path = path
+        self._map_item = map_item
+        self._params = {
+            **params,
+            'maxResults': page_size or settings.TIMERS_GOOGLE_API_PAGE_SIZE
+        }
+        self.next_sync_token = None
+        self.time_zone = None
+
+    async def __aiter__(self):
+        page_token = None
+        while True:
+            response = await self._fetch_page(page_token)
+            self.time_zone = response.get('timeZone', self.time_zone)
+            for item in response.get('items', []):
+                yield self._map_item(item)
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                # Only the last page contains the 'nextSyncToken'
+                self.next_sync_token = response.get('nextSyncToken')
+                return
+
+    async def fetch_all(self):
+        """
+        Fetches every page. Returns a `FetchedResults`, which the sync code
+        can iterate over like a `PagedResults`.
+        """
+        items = [item async for item in self]
+        return FetchedResults(items, self.next_sync_token, self.time_zone)
+
+    async def _fetch_page(self, page_token):
+        params = {**self._params, 'pageToken': page_token} \
+            if page_token else self._params
+        try:
+            return await self._calendar_api.get(self._path, params)
+        except HttpError as error:
+            if error.resp.status == 410:
+                raise SyncTokenExpired() from error
+            raise
+
+
+class FetchedResults(list):
+    def __init__(self, items, next_sync_token, time_zone=None):
+        super().__init__(items)
+        self.next_sync_token = next_sync_token
+        self.time_zone = time_zone
+
@@ -0,0 +1,143 @@
+"""
+Tells the event streams of the dashboards (see `timers.streams`) that the
+data of a user changed, i.e. that their data version was bumped (see
+`timers.dashboard.bump_data_version`).
+
+The broker is picked with `TIMERS_STREAM_BROKER`:
+- `LocalBroker`: in-process fan-out, only sees the changes made by the
+  process serving the streams
+- `PollingBroker`: also sees the changes made by other processes, e.g. the
+  scheduler, by polling the data versions of the users with a stream open
+"""
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from timers.models import UserSyncState
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def broker():
+    """The broker of the process, see `TIMERS_STREAM_BROKER`"""
+    return import_string(settings.TIMERS_STREAM_BROKER)()
+
+
+class Subscription:
+    """
+    Changes of the data of a user, for one stream. Changes notified while
+    the stream is busy are coalesced.
+    """
+
+    def __init__(self, user_id, loop):
+        self.user_id = user_id
+        self._loop = loop
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        """Thread-safe"""
+        self._loop.call_soon_threadsafe(self._changed.set)
+
+    async def wait(self, timeout):
+        """Returns whether the data changed within 'timeout' seconds"""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._changed.clear()
+        return True
+
+
+class LocalBroker:
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        # How many changes were published per user with a subscription
+        self._changes = {}
+        self._lock = threading.Lock()
+
+    @asynccontextmanager
+    async def subscribe(self, user_id):
+        subscription = Subscription(user_id, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions[user_id].add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                self._subscriptions[user_id].discard(subscription)
+                if not self._subscriptions[user_id]:
+                    del self._subscriptions[user_id]
+                    self._changes.pop(user_id, None)
+
+    def publish(self, user_ids):
+        """
+        Notifies the subscriptions of the users. Thread-safe, called by the
+        sync engine after its transaction is committed.
+        """
+        with self._lock:
+            subscriptions = []
+            for user_id in user_ids:
+                if user_id in self._subscriptions:
+                    self._changes[user_id] = self._changes.get(user_id, 0) + 1
+                    subscriptions.extend(self._subscriptions[user_id])
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def changes_of(self, user_id):
+        """
+        How many changes of the data of the user were published since its
+        first subscription: the streams woken by the same change see the
+        same count, see `timers.streams`
+        """
+        with self._lock:
+            return self._changes.get(user_id, 0)
+
+    def subscribed_user_ids(self):
+        with self._lock:
+            return list(self._subscriptions)
+
+
+class PollingBroker(LocalBroker):
+    """
+    Polls the data versions every `TIMERS_STREAM_POLL_SECONDS`, with one
+    query for all the streams of the process, while there are any
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._versions = {}
+        self._poller = None
+
+    @asynccontextmanager
+    async def subscribe(self, user_id):
+        async with super().subscribe(user_id) as subscription:
+            if self._poller is None or self._poller.done():
+                self._poller = asyncio.create_task(self._poll())
+            yield subscription
+
+    async def _poll(self):
+        while user_ids := self.subscribed_user_ids():
+            try:
+                versions = await sync_to_async(_data_versions_of)(user_ids)
+            except Exception:
+                logger.exception("Couldn't poll the data versions")
+            else:
+                changed = [user_id for user_id, version in versions.items()
+                           if self._versions.get(user_id, version) != version]
+                self._versions = versions
+                self.publish(changed)
+            await asyncio.sleep(settings.TIMERS_STREAM_POLL_SECONDS)
+
+
+def _data_versions_of(user_ids):
+    return dict(UserSyncState.objects
+                .filter(user_id__in=user_ids)
+                .values_list('user_id', 'data_version'))
@@ -1,66 +1,672 @@
+import asyncio
+import hashlib
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
+from functools import partial
 
-from allauth.socialaccount.models import SocialToken
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction, connection
+from django.db.models import Q
 from django.utils import timezone
+from googleapiclient.errors import HttpError
 
-from timers.google_api import GoogleCalendarApi
-from timers.models import Event, Calendar
+from timers.clients import calendar_api_for, async_calendar_api_for
+from timers.dashboard import bump_data_version
+from timers.google_api import SyncTokenExpired, API_ERRORS
+from timers.models import Event, Calendar, UserSyncState
 
+logger = logging.getLogger(__name__)
 
-def refresh_events(user):
-    calendar_api = _get_calendar_api_for(user)
-    active_calendars = list(Calendar.objects.filter(user=user, active=True))
+EVENTS_PAST_WINDOW = timedelta(hours=1)
+EVENTS_FUTURE_WINDOW = timedelta(days=2)
+# A full sync fetches the events further in the future than necessary, so the
+# incremental syncs that follow still cover the whole window as time goes by.
+# Once they don't anymore, the next refresh runs a full sync again.
+FULL_SYNC_EXTRA_FUTURE_WINDOW = timedelta(days=1)
+
+
+def refresh_events(user, calendars=None, force=False):
+    """
+    Refreshes the events of the active calendars of 'user', or only of
+    'calendars' if given. Unless 'force', the calendars synced less than
+    `TIMERS_EVENTS_MAX_STALENESS_SECONDS` ago are skipped.
+
+    Returns the number of calendars refreshed
+    """
+    if calendars is None:
+        calendars = Calendar.objects.filter(user=user, active=True)
+    now = timezone.now()
+    active_calendars = [
+        cal for cal in calendars
+        if force or is_stale(cal, settings.TIMERS_EVENTS_MAX_STALENESS_SECONDS)
+    ]
+    if not active_calendars:
+        return 0
+
+    calendar_api = calendar_api_for(user)
+
+    # Nothing is fetched until the events are iterated over, which allows to
+    # fetch the first page of every calendar at once
+    syncs = [(cal, *_prepare_events_sync(calendar_api, cal, now))
+             for cal in active_calendars]
+    if settings.TIMERS_SYNC_FETCH_MODE == 'threads':
+        syncs = _prefetch_first_pages_in_parallel(calendar_api, syncs)
+    else:
+        calendar_api.prefetch_first_pages([events for _, events, _ in syncs])
+
+    refreshed = 0
+    changed = False
+    for cal, events, save_events in syncs:
+        try:
+            try:
+                counts = save_events(events)
+            except SyncTokenExpired:
+                events, save_events = _prepare_events_sync(
+                        calendar_api, cal, now, full_sync=True
+                )
+                counts = save_events(events)
+            refreshed += 1
+            changed = changed or _wrote_any(counts)
+        except API_ERRORS:
+            # Do not prevent the other calendars from being refreshed
+            logger.exception("Couldn't refresh the events of calendar '%s'",
+                             cal.google_id)
+            _save_sync_failure(cal)
+    # The dashboards are up-to-date unless an event was written
+    if changed:
+        bump_data_version([user.id])
+    return refreshed
+
+
+async def refresh_events_async(user, calendars=None, force=False):
+    """
+    Async counterpart of `refresh_events`. The events of the calendars are
+    fetched concurrently, `TIMERS_SYNC_MAX_PARALLEL_CALENDARS` at a time, and
+    each calendar is saved as soon as its events have arrived.
+    """
+    if calendars is None:
+        calendars = Calendar.objects.filter(user=user, active=True)
     now = timezone.now()
-    for cal in active_calendars:
-        events = calendar_api.events(
+    active_calendars = [
+        cal for cal in await sync_to_async(list)(calendars)
+        if force or is_stale(cal, settings.TIMERS_EVENTS_MAX_STALENESS_SECONDS)
+    ]
+    if not active_calendars:
+        return 0
+
+    calendar_api = await async_calendar_api_for(user)
+    semaphore = asyncio.Semaphore(settings.TIMERS_SYNC_MAX_PARALLEL_CALENDARS)
+    all_counts = [counts for counts in await asyncio.gather(*(
+        _refresh_calendar_events_async(calendar_api, semaphore, cal, now)
+        for cal in active_calendars
+    )) if counts is not None]
+    if any(_wrote_any(counts) for counts in all_counts):
+        await sync_to_async(bump_data_version)([user.id])
+    return len(all_counts)
+
+
+async def _refresh_calendar_events_async(calendar_api, semaphore, cal, now):
+    """
+    Returns the counts of the events of 'cal' written, see `_save_events`,
+    or None if they couldn't be refreshed
+    """
+    try:
+        try:
+            return await _sync_events_async(calendar_api, semaphore, cal, now)
+        except SyncTokenExpired:
+            return await _sync_events_async(calendar_api, semaphore, cal, now,
+                                            full_sync=True)
+    except HttpError:
+        # Do not prevent the other calendars from being refreshed
+        logger.exception("Couldn't refresh the events of calendar '%s'",
+                         cal.google_id)
+        await sync_to_async(_save_sync_failure)(cal)
+        return None
+
+
+async def _sync_events_async(calendar_api, semaphore, cal, now,
+                             full_sync=False):
+    events, save_events = _prepare_events_sync(calendar_api, cal, now,
+                                               full_sync=full_sync)
+    async with semaphore:
+        events = await events.fetch_all()
+    return await sync_to_async(save_events)(events)
+
+
+def is_stale(synced_row, max_staleness_seconds):
+    """
+    Whether the 'synced_row' (`Calendar`, `UserSyncState`) was never synced,
+    or was synced more than 'max_staleness_seconds' ago
+    """
+    return synced_row.last_synced_at is None \
+           or synced_row.last_synced_at <= _fresh_since(max_staleness_seconds)
+
+
+def only_stale(synced_rows, max_staleness_seconds):
+    """
+    Filters the 'synced_rows' queryset, see `is_stale`
+    """
+    return synced_rows.filter(
+            Q(last_synced_at__isnull=True)
+            | Q(last_synced_at__lte=_fresh_since(max_staleness_seconds))
+    )
+
+
+def _fresh_since(max_staleness_seconds):
+    return timezone.now() - timedelta(seconds=max_staleness_seconds)
+
+
+def _save_sync_failure(synced_row):
+    synced_row.last_sync_status = synced_row.SYNC_FAILED
+    type(synced_row).objects \
+        .filter(id=synced_row.id) \
+        .update(last_sync_status=synced_row.SYNC_FAILED)
+
+
+def _prefetch_first_pages_in_parallel(calendar_api, syncs):
+    """
+    Fetches the first page of events of every sync on a thread pool, and
+    yields each sync as soon as its page has arrived. That way a slow calendar
+    doesn't delay saving the others, which happens on the calling thread.
+    """
+    with ThreadPoolExecutor(
+            max_workers=settings.TIMERS_SYNC_MAX_PARALLEL_CALENDARS
+    ) as executor:
+        futures = {
+            executor.submit(calendar_api.prefetch_first_page, events):
+                (cal, events, save_events)
+            for cal, events, save_events in syncs
+        }
+        for future in as_completed(futures):
+            cal, events, save_events = futures[future]
+            if future.exception() is not None:
+                # The errors of Google are raised when iterating over the
+                # events, not there
+                logger.error("Couldn't fetch the events of calendar '%s'",
+                             cal.google_id, exc_info=future.exception())
+                _save_sync_failure(cal)
+                continue
+            yield cal, events, save_events
+
+
+def _prepare_events_sync(calendar_api, cal, now, full_sync=False):
+    """
+    Returns the events to sync and the function to save them: the function
+    depends on whether it's an incremental or a full sync.
+    """
+    if not full_sync and _can_sync_events_incrementally(cal, now):
+        changed_events = calendar_api.sync_events(
                 cal.google_id,
-                before=now - timedelta(hours=1),
-                after=now + timedelta(days=2),
-                order_by='startTime'
+                sync_token=cal.sync_token
         )
-        for e in events:
-            e_id = e['id']
-            if Event.objects.filter(google_id=e_id, calendar=cal).exists():
-                event = Event.objects.get(google_id=e_id, calendar=cal)
-            else:
-                event = Event(google_id=e_id)
-            event.name = e['name']
-            event.start = e['start']
-            event.end = e['end']
-            event.calendar = cal
-            event.save()
-
-        all_event_ids_returned_by_google = [e['id'] for e in events]
+        return changed_events, partial(_save_changed_events, cal)
+
+    synced_until = now + EVENTS_FUTURE_WINDOW + FULL_SYNC_EXTRA_FUTURE_WINDOW
+    events = calendar_api.sync_events(
+            cal.google_id,
+            before=now - EVENTS_PAST_WINDOW,
+            after=synced_until
+    )
+    return events, partial(_save_all_events, cal, synced_until)
+
+
+def _can_sync_events_incrementally(cal, now):
+    return cal.sync_token \
+           and cal.synced_until \
+           and now + EVENTS_FUTURE_WINDOW <= cal.synced_until
+
+
+def _save_all_events(cal, synced_until, events):
+    events, next_sync_token = _fetch_all(events)
+    # A single transaction: the readers see the events before or after the
+    # sync, never in between
+    with transaction.atomic():
+        _lock_calendar(cal)
+        saved_events = _saved_events(Event.objects.filter(calendar=cal))
+        counts = Counter()
+        returned_ids = set()
+        for batch in _in_batches(events):
+            counts.update(_save_events(cal, batch, saved_events))
+            returned_ids.update(e.id for e in batch)
+
+        # Usually a handful: the events which ended before the synced
+        # timeframe, or were deleted without an incremental sync noticing
+        for ids in _in_batches(saved_events.keys() - returned_ids):
+            counts['deleted'] += _delete_events(cal, ids)
+
+        _save_sync_state(cal, next_sync_token, synced_until)
+    _log_sync_counts('events of calendar', cal.google_id, counts)
+    return counts
+
+
+def _save_changed_events(cal, changed_events):
+    changed_events, next_sync_token = _fetch_all(changed_events)
+    with transaction.atomic():
+        _lock_calendar(cal)
+        counts = Counter()
+        for batch in _in_batches(changed_events):
+            # Events moved outside the synced timeframe are treated as
+            # deleted, they will be fetched again by the next full sync
+            ids_to_delete = {
+                e.id for e in batch
+                if e.deleted or e.start >= cal.synced_until
+            }
+            counts.update(_save_events(cal, [e for e in batch
+                                             if e.id not in ids_to_delete]))
+            counts['deleted'] += _delete_events(cal, ids_to_delete)
+
+        _save_sync_state(cal, next_sync_token, cal.synced_until)
+    _log_sync_counts('events of calendar', cal.google_id, counts)
+    return counts
+
+
+def _fetch_all(events):
+    """
+    Fetches the remaining pages of 'events' (a `PagedResults`) before the
+    transaction saving them: otherwise it would stay open, holding the SQLite
+    write lock or the row lock of the calendar, while Google answers.
+
+    Returns the events and the next sync token.
+    """
+    events_list = list(events)
+    return events_list, events.next_sync_token
+
+
+def _lock_calendar(cal):
+    """
+    Re-reads 'cal.active' in the transaction saving the events, which copy
+    it. On PostgreSQL, the row of 'cal' is also locked until the end of the
+    transaction: `set_calendars_active` either commits before, and 'active'
+    is up-to-date, or waits, then also updates the events inserted here.
+    SQLite runs one writing transaction at a time anyway.
+    """
+    cal.active = Calendar.objects \
+        .select_for_update(no_key=True) \
+        .values_list('active', flat=True) \
+        .get(id=cal.id)
+
+
+def _in_batches(events):
+    batch = []
+    for e in events:
+        batch.append(e)
+        if len(batch) == settings.TIMERS_SYNC_WRITE_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _saved_events(events):
+    """
+    The 'google_id', 'id' and 'content_hash' of the 'events' queryset, by
+    'google_id'
+    """
+    return {e.google_id: e for e in events.values_list('google_id',
+                                                       'id',
+                                                       'content_hash',
+                                                       named=True)}
+
+
+def _save_events(cal, events, saved_events=None):
+    """
+    Only writes the events which are new or changed since they were saved,
+    going by their content hash. 'saved_events' are the saved events of 'cal'
+    (see `_saved_events`), queried unless given.
+
+    Returns how many events were inserted, updated and unchanged
+    """
+    # A batch can't write the same row twice
+    events = {e.id: e for e in events}
+    content_hashes = {e.id: _content_hash(e.name, e.start, e.end)
+                      for e in events.values()}
+    if connection.vendor == 'postgresql' and saved_events is None:
+        # Skips the unchanged events itself, without querying them first
+        return _upsert_events(cal, list(events.values()), content_hashes)
+
+    if saved_events is None:
+        saved_events = _saved_events(
+                Event.objects.filter(calendar=cal, google_id__in=list(events))
+        )
+    counts = Counter()
+    new_events = []
+    changed_events = []
+    for e in events.values():
+        saved_event = saved_events.get(e.id)
+        if saved_event is None:
+            new_events.append(e)
+        elif saved_event.content_hash == content_hashes[e.id]:
+            counts['unchanged'] += 1
+        else:
+            changed_events.append(e)
+
+    if connection.vendor == 'postgresql':
+        counts.update(_upsert_events(cal,
+                                     new_events + changed_events,
+                                     content_hashes))
+        return counts
+
+    # A concurrent refresh of the same calendar may have inserted some of
+    # these events in the meantime. Let the constraint skip them instead
+    # of raising an 'IntegrityError'
+    Event.objects.bulk_create([Event(google_id=e.id,
+                                     calendar=cal,
+                                     user_id=cal.user_id,
+                                     active=cal.active,
+                                     name=e.name,
+                                     start=e.start,
+                                     end=e.end,
+                                     content_hash=content_hashes[e.id])
+                               for e in new_events],
+                              ignore_conflicts=True)
+    Event.objects.bulk_update([Event(id=saved_events[e.id].id,
+                                     name=e.name,
+                                     start=e.start,
+                                     end=e.end,
+                                     content_hash=content_hashes[e.id])
+                               for e in changed_events],
+                              ['name', 'start', 'end', 'content_hash'])
+    counts['inserted'] += len(new_events)
+    counts['updated'] += len(changed_events)
+    return counts
+
+
+def _upsert_events(cal, events, content_hashes):
+    """
+    Saves the events with a single 'INSERT ... ON CONFLICT DO UPDATE', instead
+    of a query for the existing events, then an insert and an update. The
+    conflicts are detected by the "Unique 'google_id' per calendar" constraint,
+    so concurrent refreshes of the same calendar don't conflict either.
+
+    The events whose content hash, in 'content_hashes' by 'google_id', didn't
+    change are left untouched. Returns how many events were inserted, updated
+    and unchanged.
+    """
+    counts = Counter()
+    if not events:
+        return counts
+
+    quote = connection.ops.quote_name
+    table = quote(Event._meta.db_table)
+    columns = ('google_id', 'calendar_id', 'user_id', 'active',
+               'name', 'start', 'end', 'content_hash')
+    updated_columns = ('name', 'start', 'end', 'content_hash')
+    values = ', '.join(['(' + ', '.join(['%s'] * len(columns)) + ')']
+                       * len(events))
+    params = [param
+              for e in events
+              for param in (e.id, cal.id, cal.user_id, cal.active,
+                            e.name, e.start, e.end,
+                            content_hashes[e.id])]
+    with connection.cursor() as cursor:
+        cursor.execute(
+                f'INSERT INTO {table} '
+                f'({", ".join(quote(c) for c in columns)}) '
+                f'VALUES {values} '
+                f'ON CONFLICT ({quote("google_id")}, {quote("calendar_id")}) '
+                f'DO UPDATE SET '
+                + ', '.join(f'{quote(c)} = EXCLUDED.{quote(c)}'
+                            for c in updated_columns)
+                + f' WHERE {table}.{quote("content_hash")} '
+                  f'IS DISTINCT FROM EXCLUDED.{quote("content_hash")} '
+                  # Only the inserted rows have no deleting transaction
+                  f'RETURNING xmax = 0',
+                params
+        )
+        written = [inserted for inserted, in cursor.fetchall()]
+    counts['inserted'] += sum(written)
+    counts['updated'] += len(written) - sum(written)
+    counts['unchanged'] += len(events) - len(written)
+    return counts
+
+
+def _delete_events(cal, google_ids):
+    """
+    Returns how many events were deleted
+    """
+    if not google_ids:
+        return 0
+    deleted, _ = Event.objects \
+        .filter(calendar=cal, google_id__in=google_ids) \
+        .delete()
+    return deleted
+
+
+def _content_hash(*values):
+    """
+    Compact fingerprint of what is saved of an event or a calendar, to tell
+    whether it changed since it was saved. Google's etags change with
+    everything else too: the description, the attendees, etc.
+    """
+    digest = hashlib.blake2b(repr(values).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def _wrote_any(counts):
+    return bool(counts['inserted'] or counts['updated'] or counts['deleted'])
+
+
+def _log_sync_counts(what, google_id, counts):
+    logger.info("Synced the %s '%s': %d inserted, %d updated, %d unchanged, "
+                "%d deleted",
+                what, google_id, counts['inserted'], counts['updated'],
+                counts['unchanged'], counts['deleted'])
+
+
+def _save_sync_state(cal, sync_token, synced_until):
+    cal.sync_token = sync_token
+    cal.synced_until = synced_until
+    cal.last_synced_at = timezone.now()
+    cal.last_sync_status = Calendar.SYNC_OK
+    Calendar.objects \
+        .filter(id=cal.id) \
+        .update(sync_token=sync_token,
+                synced_until=synced_until,
+                last_synced_at=cal.last_synced_at,
+                last_sync_status=cal.last_sync_status)
+
+
+def refresh_calendars(user, force=False):
+    """
+    Refreshes the calendar list of 'user'. Unless 'force', skips it if it
+    was synced less than `TIMERS_CALENDARS_MAX_STALENESS_SECONDS` ago.
+
+    Returns whether the calendar list was refreshed
+    """
+    sync_state, _ = UserSyncState.objects.get_or_create(user=user)
+    if not force and not is_stale(
+            sync_state,
+            settings.TIMERS_CALENDARS_MAX_STALENESS_SECONDS
+    ):
+        return False
+
+    calendar_api = calendar_api_for(user)
+    try:
+        counts = _sync_calendar_list(calendar_api, user, sync_state)
+    except HttpError:
+        _save_sync_failure(sync_state)
+        raise
+    if _wrote_any(counts):
+        bump_data_version([user.id])
+    return True
+
+
+async def refresh_calendars_async(user, force=False):
+    """
+    Async counterpart of `refresh_calendars`
+    """
+    sync_state, _ = await sync_to_async(
+            UserSyncState.objects.get_or_create
+    )(user=user)
+    if not force and not is_stale(
+            sync_state,
+            settings.TIMERS_CALENDARS_MAX_STALENESS_SECONDS
+    ):
+        return False
+
+    calendar_api = await async_calendar_api_for(user)
+    try:
+        counts = await _sync_calendar_list_async(calendar_api, user,
+                                                 sync_state)
+    except HttpError:
+        await sync_to_async(_save_sync_failure)(sync_state)
+        raise
+    if _wrote_any(counts):
+        await sync_to_async(bump_data_version)([user.id])
+    return True
+
+
+def _sync_calendar_list(calendar_api, user, sync_state):
+    if sync_state.calendar_list_sync_token:
+        try:
+            changed_calendars, sync_token = calendar_api.sync_calendars(
+                    sync_token=sync_state.calendar_list_sync_token
+            )
+            return _save_changed_calendar_list(user, sync_state,
+                                               changed_calendars, sync_token)
+        except SyncTokenExpired:
+            pass
+
+    calendars, sync_token = calendar_api.sync_calendars()
+    return _save_calendar_list(user, sync_state, calendars, sync_token)
+
+
+async def _sync_calendar_list_async(calendar_api, user, sync_state):
+    if sync_state.calendar_list_sync_token:
+        try:
+            changed_calendars, sync_token = await calendar_api.sync_calendars(
+                    sync_token=sync_state.calendar_list_sync_token
+            )
+            return await sync_to_async(_save_changed_calendar_list)(
+                    user, sync_state, changed_calendars, sync_token
+            )
+        except SyncTokenExpired:
+            pass
+
+    calendars, sync_token = await calendar_api.sync_calendars()
+    return await sync_to_async(_save_calendar_list)(
+            user, sync_state, calendars, sync_token
+    )
+
+
+def _save_changed_calendar_list(user, sync_state, changed_calendars,
+                                sync_token):
+    with transaction.atomic():
+        returned_calendars = [c for c in changed_calendars
+                              if not c.get('deleted')]
+        counts = _save_calendars(
+                user,
+                returned_calendars,
+                _saved_calendars(Calendar.objects.filter(
+                        user=user,
+                        google_id__in=[c['id'] for c in returned_calendars]
+                ))
+        )
+        counts['deleted'] += set_calendars_active(
+                Calendar.objects.filter(
+                        user=user,
+                        active=True,
+                        google_id__in=[c['id']
+                                       for c in changed_calendars
+                                       if c.get('deleted')]
+                ),
+                False
+        )
+        _save_calendar_list_sync_token(sync_state, sync_token)
+    _log_sync_counts('calendar list of user', user.id, counts)
+    return counts
+
+
+def _save_calendar_list(user, sync_state, calendars, sync_token):
+    with transaction.atomic():
+        saved_calendars = _saved_calendars(Calendar.objects.filter(user=user))
+        counts = _save_calendars(user, calendars, saved_calendars)
+
+        calendars_not_returned_by_google = Calendar.objects.filter(
+                user=user,
+                active=True,
+                google_id__in=saved_calendars.keys() - {c['id']
+                                                        for c in calendars}
+        )
+        counts['deleted'] += set_calendars_active(
+                calendars_not_returned_by_google,
+                False
+        )
+
+        _save_calendar_list_sync_token(sync_state, sync_token)
+    _log_sync_counts('calendar list of user', user.id, counts)
+    return counts
+
+
+def set_calendars_active(calendars, active):
+    """
+    Activates or deactivates the calendars of the 'calendars' queryset, and
+    their events. Returns how many calendars there were.
+    """
+    calendars = list(calendars.values_list('id', 'user_id'))
+    if not calendars:
+        return 0
+    calendar_ids = [cal_id for cal_id, _ in calendars]
+    with transaction.atomic():
+        Calendar.objects.filter(id__in=calendar_ids).update(active=active)
         Event.objects \
-            .filter(calendar=cal) \
-            .exclude(google_id__in=all_event_ids_returned_by_google) \
-            .delete()
+            .filter(calendar_id__in=calendar_ids) \
+            .update(active=active)
+        bump_data_version({user_id for _, user_id in calendars})
+    return len(calendars)
 
 
-def _get_calendar_api_for(user):
-    social_token = SocialToken.objects.filter(account__user=user).get()
-    return GoogleCalendarApi(token=social_token.token,
-                             refresh_token=social_token.token_secret)
+def _saved_calendars(calendars):
+    """
+    The 'google_id', 'id' and 'content_hash' of the 'calendars' queryset, by
+    'google_id'
+    """
+    return {c.google_id: c for c in calendars.values_list('google_id',
+                                                          'id',
+                                                          'content_hash',
+                                                          named=True)}
 
 
-def refresh_calendars(user):
-    calendar_api = _get_calendar_api_for(user)
-    calendars = calendar_api.calendars()
-    for cal in calendars:
-        cal_id = cal['id']
-        if Calendar.objects.filter(google_id=cal_id, user=user).exists():
-            calendar = Calendar.objects.get(google_id=cal_id, user=user)
+def _save_calendars(user, calendars, saved_calendars):
+    """
+    Only writes the calendars which are new or renamed, see `_save_events`:
+    with a query for the new ones, and one for the renamed ones. Returns how
+    many calendars were inserted, updated and unchanged.
+    """
+    counts = Counter()
+    new_calendars = []
+    renamed_calendars = []
+    for cal in {c['id']: c for c in calendars}.values():
+        content_hash = _content_hash(cal['name'])
+        saved_calendar = saved_calendars.get(cal['id'])
+        if saved_calendar is None:
+            new_calendars.append(Calendar(google_id=cal['id'],
+                                          user=user,
+                                          active=False,
+                                          name=cal['name'],
+                                          content_hash=content_hash))
+        elif saved_calendar.content_hash == content_hash:
+            counts['unchanged'] += 1
         else:
-            calendar = Calendar(google_id=cal_id, user=user, active=False)
-        calendar.name = cal['name']
-        calendar.save()
+            renamed_calendars.append(Calendar(id=saved_calendar.id,
+                                              name=cal['name'],
+                                              content_hash=content_hash))
 
-    all_calendar_ids = [c['id'] for c in calendars]
+    # Lets the constraint skip the calendars inserted by a concurrent refresh
+    Calendar.objects.bulk_create(new_calendars, ignore_conflicts=True)
+    Calendar.objects.bulk_update(renamed_calendars, ['name', 'content_hash'])
+    counts['inserted'] += len(new_calendars)
+    counts['updated'] += len(renamed_calendars)
+    return counts
 
-    calendars_not_returned_by_google = Calendar.objects \
-        .filter(user=user) \
-        .exclude(google_id__in=all_calendar_ids)
 
-    for calendar in calendars_not_returned_by_google:
-        calendar.active = False
-        calendar.save()
+def _save_calendar_list_sync_token(sync_state, sync_token):
+    sync_state.calendar_list_sync_token = sync_token
+    sync_state.last_synced_at = timezone.now()
+    sync_state.last_sync_status = UserSyncState.SYNC_OK
+    sync_state.save(update_fields=['calendar_list_sync_token',
+                                   'last_synced_at',
+                                   'last_sync_status'])
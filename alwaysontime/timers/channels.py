@@ -0,0 +1,162 @@
+"""
+Push notifications from Google when the events of a calendar change.
+
+Every active calendar is watched through a channel, which Google notifies by
+POSTing to `TIMERS_WATCH_CHANNELS_WEBHOOK_URL`. A notification only marks
+its calendar as due, the scheduler then refreshes it (see `timers.scheduler`).
+Channels expire: `renew_channels` replaces them before they do.
+"""
+import hmac
+import logging
+import secrets
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+
+from timers.clients import calendar_api_for
+from timers.models import Calendar
+
+logger = logging.getLogger(__name__)
+
+# First notification of a channel, only confirming it has been created
+SYNC_STATE = 'sync'
+
+
+def handle_notification(channel_id, token, resource_state):
+    """
+    Marks the calendar of the channel as due to be refreshed.
+
+    Returns False if there's no such channel, or if 'token' isn't the token
+    of the channel, i.e. the notification doesn't come from Google.
+    """
+    if not channel_id or not token:
+        return False
+    cal = Calendar.objects \
+        .filter(channel_id=channel_id) \
+        .only('id', 'channel_token') \
+        .first()
+    # Compares bytes: strings can only be compared if they're ASCII
+    if cal is None or not hmac.compare_digest(cal.channel_token.encode(),
+                                              token.encode()):
+        return False
+
+    if resource_state != SYNC_STATE:
+        Calendar.objects \
+            .filter(id=cal.id) \
+            .update(next_sync_at=timezone.now())
+    return True
+
+
+def renew_channels():
+    """
+    Watches the active calendars that aren't watched yet, or whose channel is
+    about to expire, and stops the channels of the inactive calendars.
+    Does nothing unless `TIMERS_WATCH_CHANNELS_WEBHOOK_URL` is set.
+
+    A calendar that couldn't be watched is only polled by the scheduler
+    until `TIMERS_WATCH_CHANNELS_RETRY_SECONDS` later.
+    """
+    if not settings.TIMERS_WATCH_CHANNELS_WEBHOOK_URL:
+        return
+
+    now = timezone.now()
+    renew_before = now + timedelta(
+            seconds=settings.TIMERS_WATCH_CHANNELS_RENEWAL_MARGIN_SECONDS
+    )
+    calendars_to_watch = Calendar.objects \
+        .filter(active=True) \
+        .filter(Q(channel_expires_at__isnull=True)
+                | Q(channel_expires_at__lte=renew_before)) \
+        .filter(Q(channel_retry_at__isnull=True)
+                | Q(channel_retry_at__lte=now)) \
+        .select_related('user')
+    calendars_to_unwatch = Calendar.objects \
+        .filter(active=False, channel_id__isnull=False) \
+        .select_related('user')
+
+    for cal in calendars_to_unwatch:
+        _log_if_it_fails(unwatch_calendar, cal)
+    for cal in calendars_to_watch:
+        try:
+            watch_calendar(cal)
+        except HttpError as e:
+            # e.g. 'pushNotSupportedForRequestedResource': expected, and
+            # repeated until the retry
+            logger.warning("Couldn't watch calendar '%s': %s",
+                           cal.google_id, e)
+            _retry_watching_later(cal, now)
+        except Exception:
+            logger.exception("Couldn't watch calendar '%s'", cal.google_id)
+            _retry_watching_later(cal, now)
+
+
+def watch_calendar(cal):
+    """
+    Opens a new channel for the calendar, replacing its current one
+    """
+    calendar_api = calendar_api_for(cal.user)
+    token = secrets.token_urlsafe(32)
+    channel = calendar_api.watch_events(
+            cal.google_id,
+            channel_id=uuid.uuid4().hex,
+            token=token,
+            address=settings.TIMERS_WATCH_CHANNELS_WEBHOOK_URL,
+            ttl=timedelta(seconds=settings.TIMERS_WATCH_CHANNELS_TTL_SECONDS)
+    )
+
+    # Only replace the channel this function started from: another
+    # scheduler instance may have renewed it in the meantime
+    replaced = Calendar.objects \
+        .filter(id=cal.id, channel_id=cal.channel_id) \
+        .update(channel_id=channel['id'],
+                channel_resource_id=channel['resource_id'],
+                channel_token=token,
+                channel_expires_at=channel['expires_at'],
+                channel_retry_at=None)
+    if not replaced:
+        calendar_api.stop_channel(channel['id'], channel['resource_id'])
+        return
+
+    if cal.channel_id:
+        # Otherwise Google notifies both channels until the old one expires
+        _log_if_it_fails(calendar_api.stop_channel,
+                         cal.channel_id,
+                         cal.channel_resource_id)
+
+
+def unwatch_calendar(cal):
+    try:
+        calendar_api_for(cal.user).stop_channel(cal.channel_id,
+                                                cal.channel_resource_id)
+    finally:
+        # Even if Google failed to stop it, the channel expires eventually.
+        # Its notifications are ignored in the meantime.
+        Calendar.objects \
+            .filter(id=cal.id, channel_id=cal.channel_id) \
+            .update(channel_id=None,
+                    channel_resource_id=None,
+                    channel_token=None,
+                    channel_expires_at=None)
+
+
+def _retry_watching_later(cal, now):
+    Calendar.objects \
+        .filter(id=cal.id) \
+        .update(channel_retry_at=now + timedelta(
+                seconds=settings.TIMERS_WATCH_CHANNELS_RETRY_SECONDS
+        ))
+
+
+def is_watched(cal, now):
+    return cal.channel_expires_at is not None and cal.channel_expires_at > now
+
+
+def _log_if_it_fails(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception("Couldn't %s %s", func.__name__, args)
@@ -0,0 +1,91 @@
+"""
+Ready-to-use `GoogleCalendarApi` clients, cached per user, and their async
+counterparts.
+
+Building a client costs a query for the `SocialToken` of the user and its
+Google app. The clients are kept in a bounded LRU cache for
+`TIMERS_API_CLIENT_CACHE_TTL_SECONDS`, or until their token is about to
+expire, and dropped as soon as the `SocialToken` changes in this process.
+"""
+import threading
+from collections import OrderedDict
+from datetime import timedelta, timezone as dt_timezone
+
+from allauth.socialaccount.models import SocialToken
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from timers.async_google_api import AsyncGoogleCalendarApi
+from timers.google_api import GoogleCalendarApi
+from timers.tokens import social_token_of, credentials_from
+
+# user id -> (client, id of its SocialToken, valid until)
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def calendar_api_for(user):
+    now = timezone.now()
+    with _clients_lock:
+        cached = _clients.get(user.id)
+        if cached is not None and now < cached[2]:
+            _clients.move_to_end(user.id)
+            return cached[0]
+
+    social_token = social_token_of(user)
+    calendar_api = GoogleCalendarApi(credentials_from(social_token))
+    valid_until = _valid_until(calendar_api.credentials, now)
+
+    with _clients_lock:
+        _clients[user.id] = (calendar_api, social_token.id, valid_until)
+        _clients.move_to_end(user.id)
+        while len(_clients) > settings.TIMERS_API_CLIENT_CACHE_SIZE:
+            _clients.popitem(last=False)
+    return calendar_api
+
+
+async def async_calendar_api_for(user):
+    """
+    An `AsyncGoogleCalendarApi` with the credentials of the cached client of
+    'user', which are refreshed before they expire
+    """
+    calendar_api = await sync_to_async(calendar_api_for)(user)
+    return AsyncGoogleCalendarApi(calendar_api.credentials)
+
+
+def forget_calendar_api_of(user):
+    with _clients_lock:
+        _clients.pop(user.id, None)
+
+
+def forget_all_calendar_apis():
+    with _clients_lock:
+        _clients.clear()
+
+
+def _valid_until(credentials, now):
+    """
+    Once the token is about to expire, the client is built again, which
+    refreshes the token (see `credentials_from`)
+    """
+    valid_until = now + timedelta(
+            seconds=settings.TIMERS_API_CLIENT_CACHE_TTL_SECONDS
+    )
+    if credentials.expiry is not None:
+        expires_soon_at = \
+            credentials.expiry.replace(tzinfo=dt_timezone.utc) \
+            - timedelta(seconds=settings.TIMERS_TOKEN_REFRESH_MARGIN_SECONDS)
+        valid_until = min(valid_until, expires_soon_at)
+    return valid_until
+
+
+@receiver(post_save, sender=SocialToken)
+@receiver(post_delete, sender=SocialToken)
+def _forget_calendar_api_of_changed_token(sender, instance, **kwargs):
+    with _clients_lock:
+        for user_id, (_, social_token_id, _) in list(_clients.items()):
+            if social_token_id == instance.id:
+                del _clients[user_id]
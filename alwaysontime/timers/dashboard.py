@@ -0,0 +1,145 @@
+"""
+What the home page shows, cached per user.
+
+The cache entries are keyed by the data version of the user
+(`UserSyncState.data_version`), which the sync engine and the settings page
+bump whenever they change the calendars or the events of the user: a new
+version makes the old entries unreachable, no need to delete them.
+
+The version lives in the DB rather than in the cache, so a sync running in
+another process (e.g. the scheduler) invalidates the entries even with a
+cache local to each process.
+
+The page gets `upcoming_events` from its event stream (see `timers.streams`),
+or polls them with an ETag deriving from the same version.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from timers.brokers import broker
+from timers.models import Calendar, Event, UserSyncState
+
+_CACHE_KEY = 'timers:dashboard:{}:{}'
+
+
+def dashboard_of(user):
+    """
+    The names of the active calendars of 'user', and the events to show,
+    i.e. starting between `TIMERS_SHOW_X_MIN_PAST` minutes ago and
+    `TIMERS_SHOW_X_MIN_FUTURE` minutes from now
+    """
+    now = timezone.now()
+    # Read before the data: data changed in the meantime is cached under an
+    # outdated version, never the other way around
+    version = data_version_of(user)
+    cache_seconds = settings.TIMERS_DASHBOARD_CACHE_SECONDS
+    if version is None or not cache_seconds:
+        return _with_events_at(_load_dashboard_of(user, now, 0), now)
+
+    key = _CACHE_KEY.format(user.id, version)
+    dashboard = cache.get(key)
+    if dashboard is None:
+        # Includes the events entering the timeframe before the entry expires
+        dashboard = _load_dashboard_of(user, now, cache_seconds)
+        cache.set(key, dashboard, timeout=cache_seconds)
+    return _with_events_at(dashboard, now)
+
+
+def upcoming_events(user, period_start):
+    """
+    The events shown at some point of the period starting at 'period_start'
+    and lasting `TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS`, in a compact form:
+    start (epoch seconds), name and calendar name.
+
+    For a given data version of 'user', they only depend on the period, so
+    the clients get the same events during the whole period, and filter them
+    with their own clock.
+    """
+    start_after, start_before = _timeframe(period_start)
+    period = timedelta(seconds=settings.TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS)
+    events = events_to_show(user, start_after, start_before + period) \
+        .values_list('start', 'name', 'calendar__name')
+    return [{'start': int(start.timestamp()),
+             'name': name,
+             'calendar': calendar_name}
+            for start, name, calendar_name in events]
+
+
+def period_start_of(now):
+    """
+    Start of the period of `upcoming_events` containing 'now'
+    """
+    period_seconds = settings.TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS
+    return datetime.fromtimestamp(
+            now.timestamp() // period_seconds * period_seconds,
+            tz=dt_timezone.utc
+    )
+
+
+def data_version_of(user):
+    """
+    None until the first sync of the calendar list of 'user'
+    """
+    return UserSyncState.objects \
+        .filter(user=user) \
+        .values_list('data_version', flat=True) \
+        .first()
+
+
+def bump_data_version(user_ids):
+    """
+    Invalidates the cached dashboards of the users, and the ETags of their
+    upcoming events. Their event streams are notified once committed.
+    """
+    user_ids = list(user_ids)
+    UserSyncState.objects \
+        .filter(user_id__in=user_ids) \
+        .update(data_version=F('data_version') + 1)
+    transaction.on_commit(lambda: broker().publish(user_ids))
+
+
+def events_to_show(user, start_after, start_before):
+    """
+    The events of the active calendars of 'user' starting in the timeframe,
+    found by a range scan of the `(user, start)` index of the active events,
+    without joining the calendars
+    """
+    return Event.objects.filter(
+            user=user,
+            active=True,
+            start__gte=start_after,
+            start__lt=start_before
+    ).order_by('start')
+
+
+def _load_dashboard_of(user, now, extra_future_seconds):
+    start_after, start_before = _timeframe(now)
+    return {
+        'active_calendars': list(Calendar.objects
+                                 .filter(active=True, user=user)
+                                 .values_list('name', flat=True)),
+        'events': list(events_to_show(
+                user,
+                start_after,
+                start_before + timedelta(seconds=extra_future_seconds)
+        ).only('name', 'start'))
+    }
+
+
+def _with_events_at(dashboard, now):
+    start_after, start_before = _timeframe(now)
+    return {
+        'active_calendars': dashboard['active_calendars'],
+        'events': [e for e in dashboard['events']
+                   if start_after <= e.start < start_before]
+    }
+
+
+def _timeframe(now):
+    return (now - timedelta(minutes=settings.TIMERS_SHOW_X_MIN_PAST),
+            now + timedelta(minutes=settings.TIMERS_SHOW_X_MIN_FUTURE))
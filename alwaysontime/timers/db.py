@@ -0,0 +1,20 @@
+"""
+Tuning of the SQLite connections, see `TIMERS_SQLITE_PRAGMAS`.
+
+With the default rollback journal, a write blocks every read of the database
+until it commits, so the syncs block the dashboards, and concurrent writes
+fail with "database is locked" once the busy timeout is over. In WAL mode,
+reads don't block writes and writes don't block reads.
+"""
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def set_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.TIMERS_SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
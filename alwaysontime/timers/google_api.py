@@ -1,71 +1,325 @@
-from datetime import timezone, timedelta
+import logging
+import threading
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
 
-import dateutil.parser
-from allauth.socialaccount.models import SocialApp
+import httplib2
 from django.conf import settings
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+
+from timers.google_events import decode_event
+
+logger = logging.getLogger(__name__)
+
+# The Google Calendar API doesn't accept more requests than that in a batch
+MAX_REQUESTS_PER_BATCH = 50
+
+
+# Errors of a call to the Google API: returned by Google, or of the connection
+# to it, e.g. 'socket.timeout' (an 'OSError')
+API_ERRORS = (HttpError, httplib2.HttpLib2Error, OSError)
+
+
+class SyncTokenExpired(Exception):
+    """
+    Google doesn't accept the sync token anymore (HTTP 410 Gone).
+    The only way to recover is to run a full sync.
+    """
+    pass
+
+
+@lru_cache(maxsize=None)
+def calendar_resource(name):
+    """
+    A collection of the Calendar v3 API, e.g. 'events' or 'calendarList'.
+
+    Building them is expensive (hundreds of methods, with their docstrings),
+    so it's only done once per process. They aren't bound to any
+    credentials: requests must be executed with the HTTP client of a user,
+    e.g. `calendar_resource('events').list(...).execute(http=api.http)`
+    """
+    return getattr(_calendar_service(), name)()
+
+
+@lru_cache(maxsize=None)
+def _calendar_service():
+    # Built from the discovery document shipped with 'googleapiclient'
+    return build('calendar', 'v3', http=build_http(), static_discovery=True)
 
 
 class GoogleCalendarApi:
-    def __init__(self, token, refresh_token):
-        google_app = SocialApp.objects.get(name=settings.GOOGLE_APP_NAME)
-
-        creds = Credentials(
-                token=token,
-                refresh_token=refresh_token,
-                token_uri='https://oauth2.googleapis.com/token',
-                client_id=google_app.client_id,
-                client_secret=google_app.secret,
-                scopes=settings.GOOGLE_SCOPES
-        )
-        if creds.expired:
-            creds.refresh(Request())
-        self.calendar_service = build('calendar', 'v3', credentials=creds)
+    def __init__(self, credentials):
+        """
+        'credentials': valid Google credentials of the user, see
+        `timers.tokens.credentials_from`
+        """
+        self.credentials = credentials
+        self._local = threading.local()
 
-    def events(self, calendar_id, before, after, order_by):
-        def to_google_format(dt):
-            return dt.astimezone(timezone(timedelta(0))).strftime(
-                    '%Y-%m-%dT%H:%M:%SZ')
+    @property
+    def http(self):
+        """
+        The HTTP client authorized with the credentials of the user.
+        'httplib2' isn't thread-safe, so every thread gets its own: that way
+        a client can be shared by concurrent requests of the same user.
+        """
+        if not hasattr(self._local, 'http'):
+            self._local.http = self._new_http()
+        return self._local.http
 
+    def events(self, calendar_id, before, after, order_by, page_size=None):
         if not before.tzinfo or not after.tzinfo:
             raise RuntimeError("Make sure to set 'tzinfo' in "
                                "'before' and 'after' parameters")
 
-        events_from_google = self.calendar_service.events().list(
+        events = PagedResults(
+                calendar_resource('events'),
+                self.http,
+                lambda item: self._map_event_to_domain(item, events.time_zone),
+                page_size,
+                calendarId=calendar_id,
+                timeMin=_to_google_format(before),
+                timeMax=_to_google_format(after),
+                singleEvents=True,
+                orderBy=order_by,
+                fields=list_fields(self.EVENT_FIELDS, self.EVENT_PAGE_FIELDS)
+        )
+        return list(events)
+
+    def sync_events(self, calendar_id, sync_token=None, before=None,
+                    after=None, page_size=None):
+        """
+        Without 'sync_token', returns all the events between 'before' and
+        'after'. With 'sync_token', only returns the events that changed
+        since the sync that returned that token, including deleted events.
+
+        Returns a `PagedResults`: events are fetched page by page while
+        iterating over it, then `next_sync_token` becomes available.
+        """
+        if sync_token:
+            params = {'syncToken': sync_token}
+        else:
+            if not before.tzinfo or not after.tzinfo:
+                raise RuntimeError("Make sure to set 'tzinfo' in "
+                                   "'before' and 'after' parameters")
+            params = {'timeMin': _to_google_format(before),
+                      'timeMax': _to_google_format(after)}
+
+        events = PagedResults(
+                calendar_resource('events'),
+                self.http,
+                # The all-day events are in the time zone of the calendar,
+                # which comes with each page
+                lambda item: self._map_event_to_domain(item, events.time_zone),
+                page_size,
                 calendarId=calendar_id,
-                timeMin=to_google_format(before),
-                timeMax=to_google_format(after),
-                maxResults=100,
                 singleEvents=True,
-                orderBy=order_by
-        ).execute().get('items', [])
+                fields=list_fields(self.EVENT_FIELDS, self.EVENT_PAGE_FIELDS),
+                **params
+        )
+        return events
+
+    def prefetch_first_pages(self, paged_results):
+        """
+        Fetches the first page of every `PagedResults` in Google batch
+        requests, instead of one HTTP request each when they are iterated
+        over. If the request of one of them failed, its error is raised when
+        iterating over it, the others are not affected. If a whole batch
+        failed, the first pages it didn't receive are fetched one by one
+        when iterating over them.
+        """
+        paged_results = list(paged_results)
+        if len(paged_results) < 2:
+            # Nothing to gain from a batch
+            return
+
+        for i in range(0, len(paged_results), MAX_REQUESTS_PER_BATCH):
+            batch = _calendar_service().new_batch_http_request()
+            for results in paged_results[i:i + MAX_REQUESTS_PER_BATCH]:
+                batch.add(results.first_page_request(),
+                          callback=results.receive_first_page)
+            try:
+                batch.execute(http=self.http)
+            except API_ERRORS:
+                logger.warning("Couldn't prefetch first pages in a batch",
+                               exc_info=True)
+
+    def prefetch_first_page(self, paged_results):
+        """
+        Fetches the first page of a `PagedResults` right away. It is safe to
+        call from several threads at once: each thread sends its requests on
+        its own HTTP connection. If the request failed, the error is raised
+        when iterating over 'paged_results'.
+        """
+        request = paged_results.first_page_request()
+        try:
+            paged_results.receive_first_page(
+                    None,
+                    request.execute(http=self.http),
+                    None
+            )
+        except API_ERRORS as error:
+            paged_results.receive_first_page(None, None, error)
+
+    def _new_http(self):
+        return AuthorizedHttp(self.credentials, http=build_http())
 
-        return [self._map_event_to_domain(e) for e in events_from_google]
+    def sync_calendars(self, sync_token=None):
+        """
+        Without 'sync_token', returns all the calendars. With 'sync_token',
+        only returns the calendars that changed since the sync that returned
+        that token, including deleted calendars.
+
+        Returns a tuple `(calendars, next_sync_token)`
+        """
+        params = {'syncToken': sync_token} if sync_token else {}
+        calendars = PagedResults(
+                calendar_resource('calendarList'),
+                self.http,
+                self._map_calendar_to_domain,
+                fields=list_fields(self.CALENDAR_FIELDS),
+                **params
+        )
+        return list(calendars), calendars.next_sync_token
 
     def calendars(self):
         calendars_from_google = \
-            self.calendar_service \
-                .calendarList() \
-                .list() \
-                .execute() \
+            calendar_resource('calendarList') \
+                .list(fields=list_fields(self.CALENDAR_FIELDS)) \
+                .execute(http=self.http) \
                 .get('items', [])
         return [self._map_calendar_to_domain(c) for c in calendars_from_google]
 
-    @staticmethod
-    def _map_event_to_domain(event):
-        def parse_date(date_str):
-            return dateutil.parser.isoparse(date_str)
+    def watch_events(self, calendar_id, channel_id, token, address, ttl):
+        """
+        Asks Google to POST a notification to 'address' whenever the events
+        of the calendar change, until the channel expires or is stopped.
+        Every notification carries 'channel_id' and 'token'.
 
+        Returns the channel: `{'id', 'resource_id', 'expires_at'}`
+        """
+        channel = calendar_resource('events').watch(
+                calendarId=calendar_id,
+                body={'id': channel_id,
+                      'type': 'web_hook',
+                      'address': address,
+                      'token': token,
+                      'params': {'ttl': str(int(ttl.total_seconds()))}},
+                fields='id,resourceId,expiration'
+        ).execute(http=self.http)
         return {
-            'id': event['id'],
-            'name': event['summary'],
-            'start': parse_date(event['start']['dateTime']),
-            'end': parse_date(event['end']['dateTime'])
+            'id': channel['id'],
+            'resource_id': channel['resourceId'],
+            # Milliseconds since the epoch
+            'expires_at': datetime.fromtimestamp(
+                    int(channel['expiration']) / 1000,
+                    tz=timezone.utc
+            )
         }
 
+    def stop_channel(self, channel_id, resource_id):
+        calendar_resource('channels') \
+            .stop(body={'id': channel_id, 'resourceId': resource_id}) \
+            .execute(http=self.http)
+
+    # What the mappers below read of the Google resources. The responses are
+    # restricted to it, instead of also carrying the descriptions, attendees,
+    # conference data, reminders, etc.
+    EVENT_FIELDS = 'id,status,summary,start(date,dateTime),end(date,dateTime)'
+    # The time zone of the calendar, the one of its all-day events
+    EVENT_PAGE_FIELDS = 'timeZone'
+    CALENDAR_FIELDS = 'id,deleted,summary'
+
+    # Returns a `GoogleEvent`
+    _map_event_to_domain = staticmethod(decode_event)
+
     @staticmethod
     def _map_calendar_to_domain(calendar):
+        if calendar.get('deleted'):
+            return {'id': calendar['id'], 'deleted': True}
         return {'id': calendar['id'],
                 'name': calendar['summary']}
+
+
+class PagedResults:
+    """
+    Lazily iterates over the items of a Google API 'list' call, following
+    'nextPageToken'. A page is only requested once the previous one has been
+    consumed, so items can be processed as they arrive.
+
+    Can only be iterated over once. 'next_sync_token' is set once the last
+    page has been received, 'time_zone' (of the calendar, for the events)
+    once the first one has.
+
+    The first page can also be fetched beforehand, see
+    `GoogleCalendarApi.prefetch_first_pages`.
+    """
+
+    def __init__(self, collection, http, map_item, page_size=None,
+                 **params):
+        self._collection = collection
+        self._http = http
+        self._map_item = map_item
+        self._params = {
+            **params,
+            'maxResults': page_size or settings.TIMERS_GOOGLE_API_PAGE_SIZE
+        }
+        self.next_sync_token = None
+        self.time_zone = None
+        self._first_page = None
+
+    def first_page_request(self):
+        return self._collection.list(**self._params)
+
+    def receive_first_page(self, request_id, response, error):
+        """Callback of the Google batch requests"""
+        self._first_page = (response, error)
+
+    def __iter__(self):
+        page_token = None
+        while True:
+            response = self._fetch_page(page_token)
+            self.time_zone = response.get('timeZone', self.time_zone)
+            for item in response.get('items', []):
+                yield self._map_item(item)
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                # Only the last page contains the 'nextSyncToken'
+                self.next_sync_token = response.get('nextSyncToken')
+                return
+
+    def _fetch_page(self, page_token):
+        try:
+            if not page_token and self._first_page:
+                response, error = self._first_page
+                self._first_page = None
+                if error:
+                    raise error
+                return response
+
+            params = {**self._params, 'pageToken': page_token} \
+                if page_token else self._params
+            return self._collection.list(**params).execute(http=self._http)
+        except HttpError as error:
+            if error.resp.status == 410:
+                raise SyncTokenExpired() from error
+            raise
+
+
+def list_fields(item_fields, page_fields=None):
+    """
+    The 'fields' parameter of a 'list' call, for a partial response whose
+    items only contain 'item_fields', and whose pages also contain
+    'page_fields' if given (see
+    https://developers.google.com/calendar/api/guides/performance)
+    """
+    page_fields = f'{page_fields},' if page_fields else ''
+    return f'nextPageToken,nextSyncToken,{page_fields}items({item_fields})'
+
+
+def _to_google_format(dt):
+    return dt.astimezone(timezone(timedelta(0))).strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -0,0 +1,91 @@
+"""
+DB leases on the rows of `ScheduledSync` models (`Calendar`,
+`UserSyncState`), so a row is only synced by one process at a time. The
+scheduler instances and the web workers share them.
+
+`TokenRefresh` rows are leased the same way, so a token is only refreshed by
+one process at a time.
+"""
+import os
+import socket
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+
+def new_owner():
+    """A lease owner unique across hosts and processes"""
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+
+
+def claim(rows, owner):
+    """
+    Takes the lease of the rows of the 'rows' queryset that nobody else
+    holds, and returns them.
+
+    Where the DB supports it (e.g. PostgreSQL), the rows another process is
+    claiming at the same time are skipped, instead of waiting for its
+    transaction to end.
+    """
+    now = timezone.now()
+    lease = {
+        'lease_owner': owner,
+        'lease_expires_at': now + timedelta(
+                seconds=settings.TIMERS_SYNC_LEASE_SECONDS
+        )
+    }
+    if connections[rows.db].features.has_select_for_update_skip_locked:
+        with transaction.atomic(using=rows.db):
+            claimable_ids = list(_not_leased(rows, now)
+                                 .select_for_update(skip_locked=True,
+                                                    of=('self',))
+                                 .values_list('id', flat=True))
+            rows.model.objects \
+                .using(rows.db) \
+                .filter(id__in=claimable_ids) \
+                .update(**lease)
+    else:
+        _not_leased(rows, now).update(**lease)
+    return list(rows.filter(lease_owner=owner))
+
+
+def release(rows, owner, **fields):
+    """
+    Releases the lease of the 'rows' instances, and updates 'fields' at the
+    same time
+    """
+    if not rows:
+        return
+    type(rows[0]).objects \
+        .filter(id__in=[r.id for r in rows], lease_owner=owner) \
+        .update(lease_owner=None, lease_expires_at=None, **fields)
+
+
+def wait_for_release(rows, timeout):
+    """
+    Waits until nobody holds the lease of the rows of the 'rows' queryset.
+    Returns False if they're still leased after 'timeout' seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while leased(rows).exists():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(settings.TIMERS_SYNC_LEASE_POLL_SECONDS)
+    return True
+
+
+def leased(rows):
+    """
+    The rows of the 'rows' queryset someone holds the lease of
+    """
+    return rows.filter(lease_expires_at__gt=timezone.now())
+
+
+def _not_leased(rows, now):
+    return rows.filter(Q(lease_expires_at__isnull=True)
+                       | Q(lease_expires_at__lte=now))
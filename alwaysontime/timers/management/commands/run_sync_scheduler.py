@@ -0,0 +1,28 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from timers.scheduler import SyncScheduler
+
+
+class Command(BaseCommand):
+    help = "Syncs the calendars and events of all the users with Google, " \
+           "in the background. Several instances can run at once."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once',
+                            action='store_true',
+                            help="Run the syncs due now, then exit")
+
+    def handle(self, *args, once=False, **options):
+        scheduler = SyncScheduler()
+        if once:
+            synced = scheduler.run_due_syncs()
+            self.stdout.write(f'Synced {synced} calendars and calendar lists')
+            return
+
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signal_number, lambda *_: scheduler.stop())
+        self.stdout.write(f"Scheduler '{scheduler.owner}' started")
+        scheduler.run_forever()
+        self.stdout.write(f"Scheduler '{scheduler.owner}' stopped")
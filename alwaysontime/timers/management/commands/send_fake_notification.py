@@ -0,0 +1,47 @@
+import secrets
+import uuid
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from timers.models import Calendar
+
+LOCAL_WEBHOOK_URL = 'http://localhost:8100/calendars/notifications/'
+
+
+class Command(BaseCommand):
+    help = "Posts a notification to the webhook, like Google does when the " \
+           "events of a calendar change. A calendar without a channel gets " \
+           "a fake one, so the whole path can be tested offline."
+
+    def add_arguments(self, parser):
+        parser.add_argument('calendar_id',
+                            type=int,
+                            help="ID of the calendar in the DB")
+        parser.add_argument('--url',
+                            default=settings.TIMERS_WATCH_CHANNELS_WEBHOOK_URL
+                                    or LOCAL_WEBHOOK_URL,
+                            help="URL of the webhook")
+        parser.add_argument('--state',
+                            default='exists',
+                            help="Value of 'X-Goog-Resource-State'")
+
+    def handle(self, *args, calendar_id, url, state, **options):
+        cal = Calendar.objects.get(id=calendar_id)
+        if not cal.channel_id:
+            cal.channel_id = f'fake-{uuid.uuid4().hex}'
+            cal.channel_resource_id = 'fake_resource_id'
+            cal.channel_token = secrets.token_urlsafe(32)
+            cal.save(update_fields=['channel_id',
+                                    'channel_resource_id',
+                                    'channel_token'])
+
+        response = requests.post(url, headers={
+            'X-Goog-Channel-ID': cal.channel_id,
+            'X-Goog-Channel-Token': cal.channel_token,
+            'X-Goog-Resource-ID': cal.channel_resource_id,
+            'X-Goog-Resource-State': state,
+            'X-Goog-Message-Number': '1'
+        })
+        self.stdout.write(f'{response.status_code} {response.text}')
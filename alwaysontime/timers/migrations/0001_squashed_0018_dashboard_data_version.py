@@ -0,0 +1,108 @@
+# Generated by Django 4.0.10 on 2026-10-18 14:56
+#
+# The schema of the migrations it replaces, for the new databases. Some of
+# them change the primary keys in a way only SQLite supports.
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    replaces = [
+        ('timers', '0001_initial'),
+        ('timers', '0002_calendar'),
+        ('timers', '0003_event_calendar'),
+        ('timers', '0004_delete_all_existing_events'),
+        ('timers', '0005_alter_event_calendar'),
+        ('timers', '0006_delete_all_existing_events_and_calendars'),
+        ('timers', '0007_calendar_id_event_id'),
+        ('timers', '0008_alter_calendar_id_alter_event_id'),
+        ('timers', '0009_alter_calendar_google_id_alter_calendar_id_and_more'),
+        ('timers', '0010_rename_summary_event_name'),
+        ('timers', "0011_calendar_unique 'google_id' per user"),
+        ('timers', "0012_event_unique 'google_id' per calendar"),
+        ('timers', '0013_sync_tokens'),
+        ('timers', '0014_sync_scheduler'),
+        ('timers', '0015_watch_channels'),
+        ('timers', '0016_sync_freshness'),
+        ('timers', '0017_event_dashboard_indexes'),
+        ('timers', '0018_dashboard_data_version'),
+    ]
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Calendar',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('last_sync_status', models.CharField(blank=True, choices=[('ok', 'Ok'), ('failed', 'Failed')], max_length=10, null=True)),
+                ('next_sync_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('lease_owner', models.CharField(blank=True, max_length=100, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('google_id', models.CharField(max_length=100)),
+                ('name', models.CharField(max_length=100)),
+                ('active', models.BooleanField(default=False)),
+                ('sync_token', models.CharField(blank=True, max_length=255, null=True)),
+                ('synced_until', models.DateTimeField(blank=True, null=True)),
+                ('channel_id', models.CharField(blank=True, max_length=64, null=True, unique=True)),
+                ('channel_resource_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('channel_token', models.CharField(blank=True, max_length=64, null=True)),
+                ('channel_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('last_sync_status', models.CharField(blank=True, choices=[('ok', 'Ok'), ('failed', 'Failed')], max_length=10, null=True)),
+                ('next_sync_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('lease_owner', models.CharField(blank=True, max_length=100, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('calendar_list_sync_token', models.CharField(blank=True, max_length=255, null=True)),
+                ('data_version', models.PositiveIntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('google_id', models.CharField(max_length=100)),
+                ('name', models.CharField(max_length=100)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('active', models.BooleanField(default=False)),
+                ('calendar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='timers.calendar')),
+                ('user', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['calendar', 'start'], name='event_calendar_start'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(condition=models.Q(('active', True)), fields=['user', 'start'], name='event_active_user_start'),
+        ),
+        migrations.AddConstraint(
+            model_name='event',
+            constraint=models.UniqueConstraint(fields=('google_id', 'calendar'), name="Unique 'google_id' per calendar"),
+        ),
+        migrations.AddConstraint(
+            model_name='calendar',
+            constraint=models.UniqueConstraint(fields=('google_id', 'user'), name="Unique 'google_id' per user"),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.10 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timers', '0014_sync_scheduler'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendar',
+            name='channel_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='calendar',
+            name='channel_id',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='calendar',
+            name='channel_resource_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='calendar',
+            name='channel_token',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.10 on 2026-10-18 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timers', '0015_watch_channels'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendar',
+            name='last_sync_status',
+            field=models.CharField(blank=True, choices=[('ok', 'Ok'), ('failed', 'Failed')], max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='calendar',
+            name='last_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usersyncstate',
+            name='last_sync_status',
+            field=models.CharField(blank=True, choices=[('ok', 'Ok'), ('failed', 'Failed')], max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='usersyncstate',
+            name='last_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.0.10 on 2026-10-18 14:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_user_and_active_from_calendars(apps, schema_editor):
+    Calendar = apps.get_model('timers', 'Calendar')
+    Event = apps.get_model('timers', 'Event')
+    db_alias = schema_editor.connection.alias
+    for cal in Calendar.objects.using(db_alias).all():
+        Event.objects.using(db_alias) \
+            .filter(calendar=cal) \
+            .update(user_id=cal.user_id, active=cal.active)
+
+
+def do_nothing(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('timers', '0016_sync_freshness'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='active',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, db_index=False, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['calendar', 'start'], name='event_calendar_start'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(condition=models.Q(('active', True)), fields=['user', 'start'], name='event_active_user_start'),
+        ),
+        migrations.RunPython(copy_user_and_active_from_calendars, do_nothing),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 14:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timers', '0017_event_dashboard_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usersyncstate',
+            name='data_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
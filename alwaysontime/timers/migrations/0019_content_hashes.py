@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timers', '0001_squashed_0018_dashboard_data_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendar',
+            name='content_hash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='content_hash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
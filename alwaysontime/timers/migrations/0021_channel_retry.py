@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timers', '0019_content_hashes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendar',
+            name='channel_retry_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
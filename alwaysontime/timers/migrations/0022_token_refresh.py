@@ -0,0 +1,24 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialaccount', '0003_extra_data_default_dict'),
+        ('timers', '0021_channel_retry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenRefresh',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lease_owner', models.CharField(blank=True, max_length=100, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('social_token', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='socialaccount.socialtoken')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timers', '0022_token_refresh'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='calendar',
+            name='google_id',
+            field=models.CharField(max_length=1024),
+        ),
+        migrations.AlterField(
+            model_name='calendar',
+            name='name',
+            field=models.TextField(),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='google_id',
+            field=models.CharField(max_length=1024),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='name',
+            field=models.TextField(),
+        ),
+    ]
@@ -1,3 +1,4 @@
+from allauth.socialaccount.models import SocialToken
 from django.contrib.auth.models import User
 from django.db import models
 
@@ -5,11 +6,57 @@ from django.db import models
 # Create your models here.
 
 
-class Calendar(models.Model):
-    google_id = models.CharField(max_length=100)
-    name = models.CharField(max_length=100)
+class ScheduledSync(models.Model):
+    """
+    When the row was last synced with Google, when it's due to be synced by
+    the background scheduler (see `timers.scheduler`), and which process
+    holds the lease to sync it (see `timers.leases`)
+    """
+    SYNC_OK = 'ok'
+    SYNC_FAILED = 'failed'
+    SYNC_STATUSES = [(SYNC_OK, 'Ok'), (SYNC_FAILED, 'Failed')]
+
+    # Last successful sync
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    # Status of the last sync, successful or not
+    last_sync_status = models.CharField(max_length=10,
+                                        choices=SYNC_STATUSES,
+                                        null=True,
+                                        blank=True)
+    next_sync_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    lease_owner = models.CharField(max_length=100, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+
+class Calendar(ScheduledSync):
+    # Up to 1024 characters for Google
+    google_id = models.CharField(max_length=1024)
+    # Titles are unbounded
+    name = models.TextField()
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     active = models.BooleanField(default=False)
+    # Incremental sync of the events, see `timers.calendar.refresh_events`
+    sync_token = models.CharField(max_length=255, null=True, blank=True)
+    synced_until = models.DateTimeField(null=True, blank=True)
+    # Fingerprint of the name, to only write the calendars which changed, see
+    # `timers.calendar._save_calendars`
+    content_hash = models.BigIntegerField(null=True, blank=True)
+    # Channel Google notifies when the events change, see `timers.channels`
+    channel_id = models.CharField(max_length=64,
+                                  null=True,
+                                  blank=True,
+                                  unique=True)
+    channel_resource_id = models.CharField(max_length=255,
+                                           null=True,
+                                           blank=True)
+    channel_token = models.CharField(max_length=64, null=True, blank=True)
+    channel_expires_at = models.DateTimeField(null=True, blank=True)
+    # Google refused to watch the calendar: not tried again before then, see
+    # `timers.channels.renew_channels`
+    channel_retry_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         constraints = [
@@ -20,12 +67,52 @@ class Calendar(models.Model):
         ]
 
 
+class UserSyncState(ScheduledSync):
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # Incremental sync of the calendar list, see
+    # `timers.calendar.refresh_calendars`
+    calendar_list_sync_token = models.CharField(max_length=255,
+                                                null=True,
+                                                blank=True)
+    # Bumped when the calendars or the events of the user change, see
+    # `timers.dashboard`
+    data_version = models.PositiveIntegerField(default=0)
+
+
+class TokenRefresh(models.Model):
+    """
+    Which process holds the lease to refresh the `SocialToken`, see
+    `timers.tokens.refresh_token`
+    """
+    social_token = models.OneToOneField(SocialToken,
+                                        on_delete=models.CASCADE,
+                                        related_name='+')
+    lease_owner = models.CharField(max_length=100, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+
+
 class Event(models.Model):
-    google_id = models.CharField(max_length=100)
-    name = models.CharField(max_length=100)
+    # Up to 1024 characters for Google
+    google_id = models.CharField(max_length=1024)
+    # Titles are unbounded
+    name = models.TextField()
     start = models.DateTimeField()
     end = models.DateTimeField()
     calendar = models.ForeignKey(Calendar, on_delete=models.CASCADE)
+    # Copies of 'calendar.user' and 'calendar.active', so the events to show
+    # are found without joining the calendars, see `timers.dashboard`.
+    # Kept in sync by `timers.calendar.set_calendars_active`.
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             null=True,
+                             blank=True,
+                             related_name='+',
+                             # Starts the '(user, start)' index
+                             db_index=False)
+    active = models.BooleanField(default=False)
+    # Fingerprint of the name, start and end, to only write the events which
+    # changed, see `timers.calendar._save_events`
+    content_hash = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         constraints = [
@@ -34,3 +121,17 @@ class Event(models.Model):
                     name="Unique 'google_id' per calendar"
             )
         ]
+        indexes = [
+            models.Index(fields=('calendar', 'start'),
+                         name='event_calendar_start'),
+            # Only the events to show, see `timers.dashboard.events_to_show`
+            models.Index(fields=('user', 'start'),
+                         condition=models.Q(active=True),
+                         name='event_active_user_start')
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.user_id is None:
+            self.user_id = self.calendar.user_id
+            self.active = self.calendar.active
+        super().save(*args, **kwargs)
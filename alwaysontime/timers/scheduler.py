@@ -0,0 +1,191 @@
+"""
+Background sync with Google, so the web views only read from the DB.
+Run with `manage.py run_sync_scheduler`.
+
+Every scheduler instance keeps the due times of the syncs in a priority
+queue, reloaded from the DB every `TIMERS_SCHEDULER_POLL_SECONDS`. That's
+also when the watch channels are renewed, and when the calendars notified by
+Google since the last reload are picked up. Before syncing a row, an
+instance takes a lease on it in the DB (see `timers.leases`), so several
+instances share the work without syncing the same row twice.
+"""
+import heapq
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections
+from django.db.models import Q, Case, When, Value, F
+from django.utils import timezone
+
+from timers import leases
+from timers.calendar import refresh_events, refresh_calendars
+from timers.channels import renew_channels, is_watched
+from timers.models import Calendar, UserSyncState
+
+logger = logging.getLogger(__name__)
+
+EVENTS = 'events'
+CALENDAR_LIST = 'calendar_list'
+
+
+class SyncScheduler:
+    def __init__(self, owner=None):
+        self.owner = owner or leases.new_owner()
+        # (due at, EVENTS or CALENDAR_LIST, id of the Calendar or
+        # UserSyncState)
+        self._queue = []
+        self._next_poll_at = None
+        self._stopped = threading.Event()
+
+    def run_forever(self):
+        while not self._stopped.is_set():
+            close_old_connections()
+            try:
+                self.run_due_syncs()
+                seconds_to_wait = self._seconds_until_next_sync()
+            except Exception:
+                # e.g. 'database is locked': do not stop the scheduler, retry
+                # at the next poll
+                logger.exception("Couldn't run the due syncs")
+                seconds_to_wait = settings.TIMERS_SCHEDULER_POLL_SECONDS
+            self._stopped.wait(seconds_to_wait)
+
+    def stop(self):
+        self._stopped.set()
+
+    def run_due_syncs(self):
+        """
+        Runs the syncs due now, and returns how many rows were synced
+        """
+        now = timezone.now()
+        if self._next_poll_at is None or self._next_poll_at <= now:
+            try:
+                renew_channels()
+            except Exception:
+                # The calendars are still polled in the meantime
+                logger.exception("Couldn't renew the watch channels")
+            self._load_queue(now)
+
+        due = defaultdict(list)
+        while self._queue and self._queue[0][0] <= now:
+            _, kind, row_id = heapq.heappop(self._queue)
+            due[kind].append(row_id)
+
+        return self._sync_calendar_lists(due[CALENDAR_LIST], now) \
+            + self._sync_events(due[EVENTS], now)
+
+    def _load_queue(self, now):
+        # Users whose calendar list was never synced don't have a sync state
+        UserSyncState.objects.bulk_create(
+                [UserSyncState(user_id=user_id) for user_id in User.objects
+                    .filter(socialaccount__socialtoken__isnull=False,
+                            usersyncstate__isnull=True)
+                    .values_list('id', flat=True)],
+                ignore_conflicts=True
+        )
+
+        self._queue = [
+            (next_sync_at or now, CALENDAR_LIST, row_id)
+            for row_id, next_sync_at in UserSyncState.objects
+                .values_list('id', 'next_sync_at')
+        ] + [
+            (next_sync_at or now, EVENTS, row_id)
+            for row_id, next_sync_at in Calendar.objects
+                .filter(active=True)
+                .values_list('id', 'next_sync_at')
+        ]
+        heapq.heapify(self._queue)
+        self._next_poll_at = \
+            now + timedelta(seconds=settings.TIMERS_SCHEDULER_POLL_SECONDS)
+
+    def _sync_calendar_lists(self, sync_state_ids, now):
+        sync_states = self._claim(
+                UserSyncState.objects
+                    .filter(id__in=sync_state_ids)
+                    .select_related('user'),
+                now
+        )
+        # The syncs are forced: rows are due when the scheduler says so, e.g.
+        # right after a notification from Google
+        for sync_state in sync_states:
+            self._sync(CALENDAR_LIST,
+                       [sync_state],
+                       lambda: refresh_calendars(sync_state.user,
+                                                 force=True))
+        return len(sync_states)
+
+    def _sync_events(self, calendar_ids, now):
+        calendars = self._claim(
+                Calendar.objects
+                    .filter(id__in=calendar_ids, active=True)
+                    .select_related('user'),
+                now
+        )
+        # All the calendars of a user are refreshed at once, which allows to
+        # fetch their events at once
+        calendars_per_user = defaultdict(list)
+        for cal in calendars:
+            calendars_per_user[cal.user_id].append(cal)
+        for user_calendars in calendars_per_user.values():
+            self._sync(EVENTS,
+                       user_calendars,
+                       lambda: refresh_events(user_calendars[0].user,
+                                              user_calendars,
+                                              force=True))
+        return len(calendars)
+
+    def _claim(self, rows, now):
+        """
+        Takes the lease of the rows due to be synced that nobody else holds,
+        and returns them
+        """
+        return leases.claim(
+                rows.filter(Q(next_sync_at__isnull=True)
+                            | Q(next_sync_at__lte=now)),
+                self.owner
+        )
+
+    def _sync(self, kind, rows, sync):
+        try:
+            sync()
+            failed = False
+        except Exception:
+            # Do not stop the scheduler, retry later
+            logger.exception("Couldn't sync %s of %s", kind, rows)
+            failed = True
+
+        now = timezone.now()
+        for row in rows:
+            next_sync_at = now + timedelta(
+                    seconds=self._interval(kind, row, failed, now)
+            )
+            leases.release(
+                    [row],
+                    self.owner,
+                    # Unless a notification from Google asked for another
+                    # sync in the meantime, see `timers.channels`
+                    next_sync_at=Case(When(next_sync_at=row.next_sync_at,
+                                           then=Value(next_sync_at)),
+                                      default=F('next_sync_at'))
+            )
+            heapq.heappush(self._queue, (next_sync_at, kind, row.id))
+
+    @staticmethod
+    def _interval(kind, row, failed, now):
+        if failed:
+            return settings.TIMERS_SCHEDULER_RETRY_SECONDS
+        if kind == CALENDAR_LIST:
+            return settings.TIMERS_SCHEDULER_CALENDAR_LIST_INTERVAL_SECONDS
+        if is_watched(row, now):
+            return settings.TIMERS_SCHEDULER_WATCHED_EVENTS_INTERVAL_SECONDS
+        return settings.TIMERS_SCHEDULER_EVENTS_INTERVAL_SECONDS
+
+    def _seconds_until_next_sync(self):
+        next_wake_up = self._next_poll_at
+        if self._queue:
+            next_wake_up = min(next_wake_up, self._queue[0][0])
+        return max((next_wake_up - timezone.now()).total_seconds(), 0)
@@ -0,0 +1,160 @@
+"""
+Coalesces concurrent refreshes of the same data: while a refresh runs, the
+callers asking for the same one wait for it instead of starting another.
+
+- Across the threads of a process: the callers wait for the first one, and
+  get its result or its error.
+- Across processes: the refresh holds the DB leases of the rows it syncs
+  (see `timers.leases`). The callers of other processes, including the
+  scheduler, skip the rows leased by someone else and wait for their release.
+
+How many calls were coalesced is counted in the cache, see `counters`.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from timers import leases
+from timers.calendar import refresh_events, refresh_calendars, is_stale, \
+    only_stale
+from timers.models import Calendar, UserSyncState
+
+logger = logging.getLogger(__name__)
+
+# - 'started': refreshes that actually ran
+# - 'coalesced_in_process': calls that waited for a refresh of another thread
+# - 'coalesced_across_processes': calls that waited for a refresh of another
+#   process, for at least one of their rows
+COUNTERS = ('started', 'coalesced_in_process', 'coalesced_across_processes')
+_COUNTERS_CACHE_KEY = 'timers:singleflight:{}'
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def refresh_events_once(user, force=False):
+    """
+    See `refresh_events`. Calendars refreshed by another process count as
+    not refreshed.
+    """
+    return run_once(('events', user.id, force),
+                    lambda: _refresh_events_under_leases(user, force))
+
+
+def refresh_calendars_once(user, force=False):
+    """
+    See `refresh_calendars`
+    """
+    return run_once(('calendars', user.id, force),
+                    lambda: _refresh_calendars_under_lease(user, force))
+
+
+def run_once(key, func):
+    """
+    Runs 'func', unless another thread is already running it for the same
+    'key': then waits for it, and returns its result or raises its error.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _flights[key] = _Flight()
+
+    if not is_leader:
+        _increment('coalesced_in_process')
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = func()
+        return flight.result
+    except Exception as error:
+        flight.error = error
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def counters():
+    """
+    How many calls were coalesced, in all the processes sharing the cache
+    """
+    values = cache.get_many([_COUNTERS_CACHE_KEY.format(c) for c in COUNTERS])
+    return {c: values.get(_COUNTERS_CACHE_KEY.format(c), 0) for c in COUNTERS}
+
+
+def _refresh_events_under_leases(user, force):
+    calendars = Calendar.objects.filter(user=user, active=True)
+    if not force:
+        # Not even taking the leases when everything is fresh
+        calendars = only_stale(calendars,
+                               settings.TIMERS_EVENTS_MAX_STALENESS_SECONDS)
+        if not calendars.exists():
+            return 0
+
+    owner = leases.new_owner()
+    claimed = leases.claim(calendars, owner)
+    refreshed = 0
+    try:
+        if claimed:
+            _increment('started')
+            refreshed = refresh_events(user, claimed, force=force)
+    finally:
+        leases.release(claimed, owner)
+
+    leased_by_others = calendars.exclude(id__in=[c.id for c in claimed])
+    _wait_for_others(leased_by_others)
+    return refreshed
+
+
+def _refresh_calendars_under_lease(user, force):
+    sync_state, _ = UserSyncState.objects.get_or_create(user=user)
+    if not force and not is_stale(
+            sync_state,
+            settings.TIMERS_CALENDARS_MAX_STALENESS_SECONDS
+    ):
+        return False
+
+    owner = leases.new_owner()
+    claimed = leases.claim(UserSyncState.objects.filter(id=sync_state.id),
+                           owner)
+    if not claimed:
+        _wait_for_others(UserSyncState.objects.filter(id=sync_state.id))
+        return False
+
+    try:
+        _increment('started')
+        return refresh_calendars(user, force=force)
+    finally:
+        leases.release(claimed, owner)
+
+
+def _wait_for_others(rows):
+    # Not the rows nobody holds the lease of, e.g. stale calendars whose
+    # refresh by another process already ended
+    rows = leases.leased(rows)
+    if not rows.exists():
+        return
+    _increment('coalesced_across_processes')
+    timeout = settings.TIMERS_SINGLE_FLIGHT_TIMEOUT_SECONDS
+    if not leases.wait_for_release(rows, timeout):
+        logger.warning("Gave up waiting for the refresh of %s", rows)
+
+
+def _increment(counter):
+    key = _COUNTERS_CACHE_KEY.format(counter)
+    cache.add(key, 0, timeout=None)
+    cache.incr(key)
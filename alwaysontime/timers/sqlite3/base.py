@@ -0,0 +1,26 @@
+"""
+The SQLite backend of Django, starting the transactions in the mode of the
+'transaction_mode' option, like Django 5.1 does: e.g.
+
+    'OPTIONS': {'transaction_mode': 'IMMEDIATE'}
+
+A transaction started with a plain 'BEGIN' only takes the write lock on its
+first write. If another connection holds it by then, SQLite can't wait for
+it without risking a deadlock, and fails right away with "database is
+locked", whatever the busy timeout. 'BEGIN IMMEDIATE' takes the write lock
+upfront, waiting up to the busy timeout for it.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.transaction_mode = params.pop('transaction_mode', None)
+        return params
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
+        else:
+            super()._start_transaction_under_autocommit()
@@ -0,0 +1,173 @@
+"""
+Server-Sent Events stream of the upcoming events of the logged in user, for
+the dashboards to update as soon as a sync changes them, without polling.
+
+Django 4.0 iterates streaming responses synchronously, which would block the
+event loop, so the stream is served by a plain ASGI app mounted in front of
+Django (see `alwaysontime.asgi`). An idle stream only costs a coroutine
+waiting for its subscription (see `timers.brokers`), no thread.
+
+Every message is the payload of `timers.views.events_upcoming`. One is sent
+when the stream opens, when the data of the user changes, and at the start
+of every period of `TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS`. The streams of a
+user (e.g. several tabs) woken at once share the same message, computed once.
+"""
+import asyncio
+import json
+from http.cookies import SimpleCookie
+from importlib import import_module
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.http import HttpRequest
+from django.utils import timezone
+
+from timers.brokers import broker
+from timers.dashboard import period_start_of, upcoming_events
+
+STREAM_PATH = '/events/stream/'
+
+# (user id, changes, period start) -> task computing the message, while it runs
+_messages = {}
+
+
+def with_event_streams(django_application):
+    """
+    ASGI app serving the streams at `STREAM_PATH`, and everything else with
+    'django_application'
+    """
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == STREAM_PATH:
+            await events_stream(scope, receive, send)
+        else:
+            await django_application(scope, receive, send)
+
+    return application
+
+
+async def events_stream(scope, receive, send):
+    user = await sync_to_async(_user_of)(_session_key_of(scope))
+    if not user.is_authenticated:
+        await _respond(send, 401, b'Please log in!')
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream'),
+                    (b'cache-control', b'no-cache'),
+                    # Otherwise proxies like nginx buffer the stream
+                    (b'x-accel-buffering', b'no')]
+    })
+    tasks = [asyncio.ensure_future(_wait_for_disconnect(receive)),
+             asyncio.ensure_future(_stream_upcoming_events(user, send))]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Lets the stream unsubscribe
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+async def _stream_upcoming_events(user, send):
+    async with broker().subscribe(user.id) as subscription:
+        changed = True
+        period_start = None
+        while True:
+            now = timezone.now()
+            if changed or period_start_of(now) != period_start:
+                period_start = period_start_of(now)
+                await _send_upcoming_events(send, user, period_start)
+            else:
+                # Keeps the connection open through proxies
+                await _send(send, b': heartbeat\n\n')
+            changed = await subscription.wait(
+                    _seconds_until_next_message(now, period_start)
+            )
+
+
+def _seconds_until_next_message(now, period_start):
+    until_next_period = \
+        settings.TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS \
+        - (now - period_start).total_seconds()
+    return max(0, min(until_next_period,
+                      settings.TIMERS_STREAM_HEARTBEAT_SECONDS))
+
+
+async def _send_upcoming_events(send, user, period_start):
+    await _send(send, await _upcoming_events_message(user, period_start))
+
+
+async def _upcoming_events_message(user, period_start):
+    """
+    Shared by the streams of 'user' asking for it while it's computed for
+    the same period, and after the same change of the data of the user
+    """
+    key = (user.id, broker().changes_of(user.id), period_start)
+    task = _messages.get(key)
+    if task is None:
+        task = asyncio.ensure_future(
+                _compute_upcoming_events_message(user, period_start)
+        )
+        _messages[key] = task
+        task.add_done_callback(lambda _: _messages.pop(key, None))
+    # A stream closed in the meantime doesn't cancel it for the others
+    return await asyncio.shield(task)
+
+
+async def _compute_upcoming_events_message(user, period_start):
+    events = await sync_to_async(_upcoming_events)(user, period_start)
+    data = json.dumps({'events': events}, separators=(',', ':'))
+    return f'data: {data}\n\n'.encode()
+
+
+def _upcoming_events(user, period_start):
+    try:
+        return upcoming_events(user, period_start)
+    finally:
+        # The stream outlives the requests Django would close them after
+        close_old_connections()
+
+
+async def _send(send, body):
+    await send({'type': 'http.response.body',
+                'body': body,
+                'more_body': True})
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _respond(send, status, body):
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _session_key_of(scope):
+    cookies = SimpleCookie()
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            cookies.load(value.decode('latin1'))
+    cookie = cookies.get(settings.SESSION_COOKIE_NAME)
+    return cookie.value if cookie else None
+
+
+def _user_of(session_key):
+    request = HttpRequest()
+    request.session = \
+        import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    try:
+        return get_user(request)
+    finally:
+        close_old_connections()
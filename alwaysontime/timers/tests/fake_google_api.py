@@ -0,0 +1,253 @@
+"""
+A local stand-in for the Google Calendar API, to run the tests and the
+benchmarks offline.
+
+Answers `events().list()`, `calendarList().list()` and batch requests with
+generated data, after waiting 'latency' seconds per HTTP request to simulate
+the round trip to Google. The lists are paginated with 'maxResults', and the
+sync token 'expired' is answered with a 410 like Google does. Like Google,
+the responses are restricted to the 'fields' mask, and compressed when the
+client accepts gzip.
+"""
+import gzip
+import json
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, unquote, parse_qs
+
+import httplib2
+from google.auth.credentials import AnonymousCredentials
+
+from timers.async_google_api import AsyncGoogleCalendarApi
+from timers.google_api import GoogleCalendarApi
+
+# A real page of events: 50 events of a team calendar, with their
+# descriptions, attendees, conference data, etc.
+EVENTS_LIST = Path(__file__).parent / 'fixtures' / 'events_list.json'
+
+
+def google_event(event_id):
+    return {'id': event_id,
+            'status': 'confirmed',
+            'summary': f'Event {event_id}',
+            'start': {'dateTime': '2021-12-24T19:30:00Z'},
+            'end': {'dateTime': '2021-12-24T20:30:00Z'}}
+
+
+def apply_fields_mask(resource, fields):
+    """
+    The part of 'resource' selected by the 'fields' mask of a partial
+    response, e.g. 'nextPageToken,items(id,start/dateTime)'
+    """
+    selection, _ = _parse_fields_mask(fields, 0)
+    return _select(resource, selection)
+
+
+def _parse_fields_mask(fields, i):
+    """
+    Returns the selection starting at 'i', `{name: selection or None}`,
+    and the index of its end
+    """
+    selection = {}
+    while i < len(fields):
+        j = i
+        while j < len(fields) and fields[j] not in ',()':
+            j += 1
+        *parents, name = fields[i:j].split('/')
+        sub_selection = None
+        if j < len(fields) and fields[j] == '(':
+            sub_selection, j = _parse_fields_mask(fields, j + 1)
+        node = selection
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[name] = sub_selection
+        if j < len(fields) and fields[j] == ')':
+            return selection, j + 1
+        i = j + 1
+    return selection, i
+
+
+def _select(value, selection):
+    if selection is None:
+        return value
+    if isinstance(value, list):
+        return [_select(v, selection) for v in value]
+    return {name: _select(value[name], sub_selection)
+            for name, sub_selection in selection.items()
+            if name in value}
+
+
+class FakeGoogleCalendarApi(GoogleCalendarApi):
+    def __init__(self, url):
+        super().__init__(AnonymousCredentials())
+        self.url = url
+
+    def _new_http(self):
+        return RedirectingHttp(self.url)
+
+
+class RedirectingHttp(httplib2.Http):
+    """Sends the requests meant for Google to 'url' instead"""
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+
+    def request(self, uri, *args, **kwargs):
+        uri = uri.replace('https://www.googleapis.com/', self.url)
+        return super().request(uri, *args, **kwargs)
+
+
+class FakeGoogleApi:
+    def __init__(self, latency=0.05, events_per_calendar=20):
+        self.latency = latency
+        self.events_per_calendar = events_per_calendar
+        # Status of the batch requests as a whole, e.g. 500 to fail them
+        self.batch_status = 200
+        self.http_requests = 0
+        # Bytes of the bodies of the HTTP responses
+        self.bytes_sent = 0
+        # Query parameters of the API calls, and headers of the HTTP requests
+        self.received_params = []
+        self.received_headers = []
+        # Most HTTP requests answered at the same time
+        self.max_concurrent_requests = 0
+        self._concurrent_requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                           self._request_handler())
+        self.url = f'http://127.0.0.1:{self._server.server_port}/'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def __exit__(self, *_):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def calendar_api(self):
+        """A `GoogleCalendarApi` sending its requests to this server"""
+        return FakeGoogleCalendarApi(self.url)
+
+    def async_calendar_api(self):
+        """An `AsyncGoogleCalendarApi` sending its requests to this server"""
+        return AsyncGoogleCalendarApi(AnonymousCredentials(),
+                                      url=self.url + 'calendar/v3/')
+
+    def respond(self, method, url):
+        """Returns the JSON body answering a single API call"""
+        path = unquote(urlparse(url).path)
+        params = {name: values[0]
+                  for name, values in parse_qs(urlparse(url).query).items()}
+        with self._lock:
+            self.received_params.append(params)
+        if params.get('syncToken') == 'expired':
+            return 410, {'error': {'code': 410, 'message': 'Gone'}}
+        events_path = re.fullmatch(r'.*/calendars/(.+)/events', path)
+        if method == 'GET' and events_path:
+            calendar_id = events_path.group(1)
+            items = [google_event(f'{calendar_id}-{i}')
+                     for i in range(self.events_per_calendar)]
+        elif method == 'GET' and path.endswith('/users/me/calendarList'):
+            items = [{'id': f'cal{i}', 'summary': f'Calendar {i}'}
+                     for i in range(10)]
+        else:
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+        start = int(params.get('pageToken', 0))
+        end = start + int(params.get('maxResults', len(items)))
+        if end < len(items):
+            response = {'items': items[start:end], 'nextPageToken': str(end)}
+        else:
+            response = {'items': items[start:],
+                        'nextSyncToken': 'fake_sync_token'}
+        if events_path:
+            response['timeZone'] = 'UTC'
+        if 'fields' in params:
+            response = apply_fields_mask(response, params['fields'])
+        return 200, response
+
+    def respond_to_batch(self, content_type, body):
+        message = BytesParser(policy=HTTP).parsebytes(
+                b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body
+        )
+        boundary = 'fake_batch_boundary'
+        parts = []
+        for part in message.iter_parts():
+            request_line = part.get_payload(decode=True) \
+                .decode() \
+                .splitlines()[0]
+            method, url, _ = request_line.split(' ')
+            status, response = self.respond(method, url)
+            content_id = part['Content-ID'].strip('<>')
+            parts.append(
+                    f'--{boundary}\r\n'
+                    f'Content-Type: application/http\r\n'
+                    f'Content-ID: <response-{content_id}>\r\n\r\n'
+                    f'HTTP/1.1 {status} OK\r\n'
+                    f'Content-Type: application/json\r\n\r\n'
+                    f'{json.dumps(response)}\r\n'
+            )
+        parts.append(f'--{boundary}--\r\n')
+        return f'multipart/mixed; boundary={boundary}', ''.join(parts)
+
+    def _request_handler(self):
+        fake_api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._answer(*fake_api.respond('GET', self.path))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                if fake_api.batch_status != 200:
+                    self.rfile.read(length)
+                    self._answer(fake_api.batch_status,
+                                 {'error': {'code': fake_api.batch_status}})
+                    return
+                content_type, body = fake_api.respond_to_batch(
+                        self.headers['Content-Type'],
+                        self.rfile.read(length)
+                )
+                self._send(200, content_type, body.encode())
+
+            def _answer(self, status, response):
+                self._send(status,
+                           'application/json',
+                           json.dumps(response).encode())
+
+            def _send(self, status, content_type, body):
+                compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+                if compress:
+                    body = gzip.compress(body)
+                with fake_api._lock:
+                    fake_api.received_headers.append(dict(self.headers))
+                    fake_api.bytes_sent += len(body)
+                    fake_api.http_requests += 1
+                    fake_api._concurrent_requests += 1
+                    fake_api.max_concurrent_requests = max(
+                            fake_api.max_concurrent_requests,
+                            fake_api._concurrent_requests
+                    )
+                time.sleep(fake_api.latency)
+                with fake_api._lock:
+                    fake_api._concurrent_requests -= 1
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                if compress:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        return Handler
@@ -0,0 +1,151 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from asgiref.sync import async_to_sync
+from googleapiclient.errors import HttpError
+
+import timers.async_google_api as async_google_api
+from timers.google_api import GoogleCalendarApi, SyncTokenExpired, \
+    list_fields
+from timers.google_events import GoogleEvent
+
+
+def run(coroutine_function):
+    return async_to_sync(coroutine_function)()
+
+
+class TestSyncEvents:
+    def test_returns_events_mapped_to_domain(self, fake_google_api):
+        fake_google_api.events_per_calendar = 1
+        calendar_api = fake_google_api.async_calendar_api()
+
+        async def sync_events():
+            return await calendar_api.sync_events(
+                    'cal1',
+                    before=datetime(2021, 12, 24, tzinfo=timezone.utc),
+                    after=datetime(2021, 12, 25, tzinfo=timezone.utc)
+            ).fetch_all()
+
+        events = run(sync_events)
+
+        assert events == [GoogleEvent(
+                id='cal1-0',
+                name='Event cal1-0',
+                start=datetime(2021, 12, 24, 19, 30, tzinfo=timezone.utc),
+                end=datetime(2021, 12, 24, 20, 30, tzinfo=timezone.utc)
+        )]
+        assert events.next_sync_token == 'fake_sync_token'
+
+    def test_follows_next_page_tokens(self, fake_google_api):
+        fake_google_api.events_per_calendar = 5
+        calendar_api = fake_google_api.async_calendar_api()
+
+        async def sync_events():
+            return await calendar_api.sync_events(
+                    'cal1',
+                    sync_token='sync_token',
+                    page_size=2
+            ).fetch_all()
+
+        events = run(sync_events)
+
+        assert [e.id for e in events] == [f'cal1-{i}' for i in range(5)]
+        assert fake_google_api.http_requests == 3
+        assert events.next_sync_token == 'fake_sync_token'
+
+    def test_raises_sync_token_expired_when_google_returns_410(
+            self, fake_google_api
+    ):
+        calendar_api = fake_google_api.async_calendar_api()
+
+        async def sync_events():
+            return await calendar_api.sync_events(
+                    'cal1',
+                    sync_token='expired'
+            ).fetch_all()
+
+        with pytest.raises(SyncTokenExpired):
+            run(sync_events)
+
+    def test_raises_http_errors_like_the_sync_client(self, fake_google_api):
+        calendar_api = fake_google_api.async_calendar_api()
+
+        async def get_unknown_resource():
+            return await calendar_api.get('unknown', {})
+
+        with pytest.raises(HttpError) as error:
+            run(get_unknown_resource)
+        assert error.value.resp.status == 404
+
+    def test_requires_timezone_aware_timeframe(self, fake_google_api):
+        with pytest.raises(RuntimeError):
+            fake_google_api.async_calendar_api().sync_events(
+                    'cal1',
+                    before=datetime(2021, 12, 24),
+                    after=datetime(2021, 12, 25)
+            )
+
+
+class TestSyncCalendars:
+    def test_returns_calendars_and_next_sync_token(self, fake_google_api):
+        calendar_api = fake_google_api.async_calendar_api()
+
+        calendars, sync_token = run(calendar_api.sync_calendars)
+
+        assert calendars[0] == {'id': 'cal0', 'name': 'Calendar 0'}
+        assert len(calendars) == 10
+        assert sync_token == 'fake_sync_token'
+
+
+class TestHttpClient:
+    def test_shared_within_an_event_loop(self):
+        async def two_clients():
+            return async_google_api.http_client(), \
+                   async_google_api.http_client()
+
+        client, same_client = run(two_clients)
+
+        assert client is same_client
+
+    def test_every_event_loop_gets_its_own(self):
+        async def client_of_another_loop():
+            return await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    asyncio.run,
+                    get_client()
+            )
+
+        async def get_client():
+            return async_google_api.http_client()
+
+        async def both_clients():
+            return async_google_api.http_client(), \
+                   await client_of_another_loop()
+
+        client, other_client = run(both_clients)
+
+        assert client is not other_client
+
+
+class TestPartialResponses:
+    def test_requests_partial_gzip_encoded_responses(self, fake_google_api):
+        fake_google_api.events_per_calendar = 1
+        calendar_api = fake_google_api.async_calendar_api()
+
+        async def sync_events():
+            return await calendar_api.sync_events(
+                    'cal1',
+                    sync_token='token'
+            ).fetch_all()
+
+        events = run(sync_events)
+
+        assert [e.id for e in events] == ['cal1-0']
+        assert events.time_zone == 'UTC'
+        assert fake_google_api.received_params[0]['fields'] \
+               == list_fields(GoogleCalendarApi.EVENT_FIELDS,
+                              GoogleCalendarApi.EVENT_PAGE_FIELDS)
+        headers = fake_google_api.received_headers[0]
+        assert 'gzip' in headers['accept-encoding']
+        assert '(gzip)' in headers['user-agent']
@@ -1,31 +1,49 @@
+import logging
+import socket
+import threading
+from collections import Counter
 from datetime import datetime, timezone, timedelta
-from unittest.mock import patch, ANY, call
+from unittest.mock import patch, ANY, call, AsyncMock
 
+import httplib2
 import pytest
+from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from googleapiclient.errors import HttpError
 
 import timers.calendar as calendar
-from conftest import TEST_GOOGLE_TOKEN, TEST_GOOGLE_REFRESH_TOKEN, TEST_USERNAME
-from timers.models import Calendar, Event
+import timers.clients as clients
+from conftest import TEST_GOOGLE_TOKEN, TEST_GOOGLE_REFRESH_TOKEN, \
+    TEST_USERNAME, only_on_postgresql
+from timers.google_api import SyncTokenExpired
+from timers.google_events import GoogleEvent
+from timers.models import Calendar, Event, UserSyncState
 
 pytestmark = pytest.mark.django_db
 
 
 @pytest.fixture
 def GoogleCalendarApiMock():
-    with patch.object(calendar, 'GoogleCalendarApi') as GoogleCalendarApiMock:
+    with patch.object(clients, 'GoogleCalendarApi') as GoogleCalendarApiMock:
+        api_mock = GoogleCalendarApiMock()
+        api_mock.credentials.expiry = None
+        api_mock.sync_events.return_value = FakePagedResults([])
+        api_mock.sync_calendars.return_value = ([], 'next_sync_token')
+        GoogleCalendarApiMock.reset_mock()
         yield GoogleCalendarApiMock
 
 
 class TestRefreshEvents:
     def test_instantiate_google_api_with_user_tokens(
-            self, GoogleCalendarApiMock, test_user
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
     ):
         calendar.refresh_events(test_user)
-        GoogleCalendarApiMock.assert_called_once_with(
-                token=TEST_GOOGLE_TOKEN,
-                refresh_token=TEST_GOOGLE_REFRESH_TOKEN
-        )
+        GoogleCalendarApiMock.assert_called_once_with(ANY)
+        credentials = GoogleCalendarApiMock.call_args.args[0]
+        assert credentials.token == TEST_GOOGLE_TOKEN
+        assert credentials.refresh_token == TEST_GOOGLE_REFRESH_TOKEN
 
     def test_gets_events_for_all_active_calendars(
             self, GoogleCalendarApiMock, test_user
@@ -37,14 +55,264 @@ class TestRefreshEvents:
 
         calendar.refresh_events(test_user)
 
-        assert api_mock.events.call_count == 2
-        api_mock.events.assert_has_calls([
-            call('cal1', before=ANY, after=ANY, order_by=ANY),
-            call('cal3', before=ANY, after=ANY, order_by=ANY),
+        assert api_mock.sync_events.call_count == 2
+        api_mock.sync_events.assert_has_calls([
+            call('cal1', before=ANY, after=ANY),
+            call('cal3', before=ANY, after=ANY),
         ], any_order=True)
 
+    def test_can_refresh_only_some_calendars(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        create_test_calendar('cal1', active=True)
+        cal2 = create_test_calendar('cal2', active=True)
+
+        calendar.refresh_events(test_user, [cal2])
+
+        api_mock.sync_events.assert_called_once_with('cal2',
+                                                     before=ANY,
+                                                     after=ANY)
+
+    def test_prefetches_first_page_of_all_calendars_at_once(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        events_cal1 = FakePagedResults([])
+        events_cal2 = FakePagedResults([])
+        api_mock.sync_events.side_effect = [events_cal1, events_cal2]
+        create_test_calendar('cal1', active=True)
+        create_test_calendar('cal2', active=True)
+
+        calendar.refresh_events(test_user)
+
+        api_mock.prefetch_first_pages.assert_called_once_with(
+                [events_cal1, events_cal2]
+        )
+
+    def test_can_prefetch_first_pages_on_a_thread_pool(
+            self, GoogleCalendarApiMock, test_user, settings
+    ):
+        settings.TIMERS_SYNC_FETCH_MODE = 'threads'
+        api_mock = GoogleCalendarApiMock()
+        events_cal1 = FakePagedResults([api_event('id1')])
+        events_cal2 = FakePagedResults([api_event('id2')])
+        api_mock.sync_events.side_effect = [events_cal1, events_cal2]
+        create_test_calendar('cal1', active=True)
+        create_test_calendar('cal2', active=True)
+
+        calendar.refresh_events(test_user)
+
+        api_mock.prefetch_first_pages.assert_not_called()
+        api_mock.prefetch_first_page.assert_has_calls(
+                [call(events_cal1), call(events_cal2)],
+                any_order=True
+        )
+        assert Event.objects.count() == 2
+
+    def test_slow_calendar_does_not_delay_saving_others_on_thread_pool(
+            self, GoogleCalendarApiMock, test_user, settings
+    ):
+        settings.TIMERS_SYNC_FETCH_MODE = 'threads'
+        api_mock = GoogleCalendarApiMock()
+        events_slow_cal = FakePagedResults([api_event('slow')])
+        events_fast_cal = FakePagedResults([api_event('fast')])
+        api_mock.sync_events.side_effect = [events_slow_cal, events_fast_cal]
+        fast_calendar_saved = threading.Event()
+
+        def prefetch_first_page(events):
+            if events is events_slow_cal:
+                assert fast_calendar_saved.wait(timeout=5)
+
+        api_mock.prefetch_first_page.side_effect = prefetch_first_page
+        create_test_calendar('slow_cal', active=True)
+        create_test_calendar('fast_cal', active=True)
+        save_all_events = calendar._save_all_events
+
+        def save_all_events_and_notify(cal, synced_until, events):
+            counts = save_all_events(cal, synced_until, events)
+            if cal.google_id == 'fast_cal':
+                fast_calendar_saved.set()
+            return counts
+
+        with patch.object(calendar, '_save_all_events',
+                          save_all_events_and_notify):
+            calendar.refresh_events(test_user)
+
+        assert Event.objects.count() == 2
+
+    def test_error_on_one_calendar_does_not_prevent_refreshing_others(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        error = HttpError(httplib2.Response({'status': 500}), b'Error')
+        api_mock.sync_events.side_effect = [
+            FakePagedResults([], error=error),
+            FakePagedResults([api_event('id1')])
+        ]
+        create_test_calendar('cal1', active=True)
+        cal2 = create_test_calendar('cal2', active=True)
+
+        calendar.refresh_events(test_user)
+
+        assert Event.objects.get(google_id='id1').calendar == cal2
+
+    def test_network_error_on_one_calendar_does_not_stop_the_others(
+            self, GoogleCalendarApiMock, test_user, settings
+    ):
+        settings.TIMERS_SYNC_FETCH_MODE = 'threads'
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.side_effect = [
+            FakePagedResults([], error=socket.timeout('timed out')),
+            FakePagedResults([api_event('id2')]),
+            FakePagedResults([api_event('id3')])
+        ]
+        failing = create_test_calendar('cal1', active=True)
+        create_test_calendar('cal2', active=True)
+        create_test_calendar('cal3', active=True)
+
+        refreshed = calendar.refresh_events(test_user)
+
+        assert refreshed == 2
+        assert Event.objects.count() == 2
+        failing.refresh_from_db()
+        assert failing.last_sync_status == Calendar.SYNC_FAILED
+
+    def test_failed_prefetch_on_a_thread_does_not_prevent_refreshing_others(
+            self, GoogleCalendarApiMock, test_user, settings
+    ):
+        settings.TIMERS_SYNC_FETCH_MODE = 'threads'
+        api_mock = GoogleCalendarApiMock()
+        failing_events = FakePagedResults([api_event('id1')])
+        api_mock.sync_events.side_effect = [
+            failing_events,
+            FakePagedResults([api_event('id2')])
+        ]
+
+        def prefetch_first_page(events):
+            if events is failing_events:
+                raise Exception('Boom')
+
+        api_mock.prefetch_first_page.side_effect = prefetch_first_page
+        failing = create_test_calendar('cal1', active=True)
+        create_test_calendar('cal2', active=True)
+
+        refreshed = calendar.refresh_events(test_user)
+
+        assert refreshed == 1
+        assert Event.objects.get().google_id == 'id2'
+        failing.refresh_from_db()
+        assert failing.last_sync_status == Calendar.SYNC_FAILED
+
+    def test_created_events_copy_user_and_active_of_their_calendar(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = FakePagedResults([api_event('id1')])
+
+        calendar.refresh_events(test_user)
+
+        event = Event.objects.get()
+        assert event.user == test_user
+        assert event.active
+
+    def test_created_events_copy_active_of_their_calendar_when_saved(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = FakePagedResults([api_event('id1')])
+        cal = create_test_calendar('cal1', active=True)
+        # Deactivated while its events were being fetched
+        Calendar.objects.filter(id=cal.id).update(active=False)
+
+        calendar.refresh_events(test_user, calendars=[cal])
+
+        assert not Event.objects.get().active
+
+    def test_invalidates_cached_dashboard(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = FakePagedResults([api_event('id1')])
+        UserSyncState.objects.create(user=test_user)
+
+        calendar.refresh_events(test_user)
+
+        assert UserSyncState.objects.get().data_version == 1
+
+    def test_keeps_cached_dashboard_when_no_event_changed(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = FakePagedResults([api_event('id1')])
+        UserSyncState.objects.create(user=test_user)
+        calendar.refresh_events(test_user)
+
+        calendar.refresh_events(test_user, force=True)
+
+        assert UserSyncState.objects.get().data_version == 1
+
+    def test_records_failed_sync(self, GoogleCalendarApiMock, test_user):
+        api_mock = GoogleCalendarApiMock()
+        error = HttpError(httplib2.Response({'status': 500}), b'Error')
+        api_mock.sync_events.return_value = FakePagedResults([], error=error)
+        create_test_calendar('cal1', active=True)
+
+        assert calendar.refresh_events(test_user) == 0
+
+        assert Calendar.objects.get().last_sync_status == Calendar.SYNC_FAILED
+
+    def test_records_successful_sync(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        before = datetime.now(tz=timezone.utc)
+
+        assert calendar.refresh_events(test_user) == 1
+
+        test_user_calendar.refresh_from_db()
+        assert test_user_calendar.last_synced_at >= before
+        assert test_user_calendar.last_sync_status == Calendar.SYNC_OK
+
+    def test_skips_calendars_synced_recently(
+            self, GoogleCalendarApiMock, test_user, settings
+    ):
+        settings.TIMERS_EVENTS_MAX_STALENESS_SECONDS = 60
+        api_mock = GoogleCalendarApiMock()
+        create_test_calendar('fresh', active=True, last_synced_at=(
+                datetime.now(tz=timezone.utc) - timedelta(seconds=30)
+        ))
+        create_test_calendar('stale', active=True, last_synced_at=(
+                datetime.now(tz=timezone.utc) - timedelta(seconds=90)
+        ))
+
+        assert calendar.refresh_events(test_user) == 1
+
+        api_mock.sync_events.assert_called_once_with('stale',
+                                                     before=ANY,
+                                                     after=ANY)
+
+    def test_no_google_client_when_all_calendars_are_fresh(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        create_test_calendar('fresh',
+                             active=True,
+                             last_synced_at=datetime.now(tz=timezone.utc))
+
+        assert calendar.refresh_events(test_user) == 0
+
+        GoogleCalendarApiMock.assert_not_called()
+
+    def test_refreshes_fresh_calendars_when_forced(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        create_test_calendar('fresh',
+                             active=True,
+                             last_synced_at=datetime.now(tz=timezone.utc))
+
+        assert calendar.refresh_events(test_user, force=True) == 1
+
     @patch.object(calendar, 'timezone')
-    def test_gets_events_in_the_right_timeframe_and_sorted_by_start_date(
+    def test_gets_events_in_the_right_timeframe(
             self, timezone_mock, GoogleCalendarApiMock, test_user
     ):
         api_mock = GoogleCalendarApiMock()
@@ -54,11 +322,12 @@ class TestRefreshEvents:
 
         calendar.refresh_events(test_user)
 
-        api_mock.events.assert_called_once_with(
+        # Events are shown for the next 2 days, but a full sync fetches
+        # 1 extra day to allow incremental syncs during that day
+        api_mock.sync_events.assert_called_once_with(
                 'cal1',
                 before=now - timedelta(hours=1),
-                after=now + timedelta(days=2),
-                order_by='startTime'
+                after=now + timedelta(days=3)
         )
 
     def test_save_events_to_the_db(
@@ -72,11 +341,11 @@ class TestRefreshEvents:
         end1 = datetime(2021, 10, 15, 13, 5, tzinfo=timezone.utc)
         end2 = datetime(2021, 10, 15, 14, 5, tzinfo=timezone.utc)
         end3 = datetime(2021, 10, 15, 15, 5, tzinfo=timezone.utc)
-        api_mock.events.return_value = [
-            {'id': 'id1', 'name': 's1', 'start': start1, 'end': end1},
-            {'id': 'id2', 'name': 's2', 'start': start2, 'end': end2},
-            {'id': 'id3', 'name': 's3', 'start': start3, 'end': end3},
-        ]
+        api_mock.sync_events.return_value = FakePagedResults([
+            GoogleEvent('id1', 's1', start1, end1),
+            GoogleEvent('id2', 's2', start2, end2),
+            GoogleEvent('id3', 's3', start3, end3),
+        ], 'next_sync_token')
 
         calendar.refresh_events(test_user)
 
@@ -123,9 +392,9 @@ class TestRefreshEvents:
 
         start1 = datetime(year=2021, month=10, day=15, hour=10, minute=5)
         end1 = datetime(year=2021, month=10, day=15, hour=13, minute=5)
-        api_mock.events.return_value = [
-            {'id': 'id1', 'name': 'UPDATED', 'start': start1, 'end': end1},
-        ]
+        api_mock.sync_events.return_value = FakePagedResults([
+            GoogleEvent('id1', 'UPDATED', start1, end1),
+        ], 'next_sync_token')
 
         calendar.refresh_events(test_user)
 
@@ -159,9 +428,9 @@ class TestRefreshEvents:
 
         start2 = datetime(year=2021, month=10, day=15, hour=11, minute=5)
         end2 = datetime(year=2021, month=10, day=15, hour=14, minute=5)
-        api_mock.events.return_value = [
-            {'id': 'id2', 'name': 's2', 'start': start2, 'end': end2}
-        ]
+        api_mock.sync_events.return_value = FakePagedResults([
+            GoogleEvent('id2', 's2', start2, end2)
+        ], 'next_sync_token')
 
         calendar.refresh_events(test_user)
 
@@ -178,33 +447,467 @@ class TestRefreshEvents:
                 calendar=test_cal
         ).exists()
 
+    def test_deletes_events_not_returned_without_listing_returned_ones(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        create_test_event('not returned', test_user_calendar)
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = FakePagedResults(
+                [api_event(f'id{i}') for i in range(300)]
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            calendar.refresh_events(test_user)
+
+        deletes = [q['sql'] for q in queries if q['sql'].startswith('DELETE')]
+        assert len(deletes) == 1
+        assert "'id1'" not in deletes[0]
+        assert not Event.objects.filter(google_id='not returned').exists()
+        assert Event.objects.count() == 300
+
+    def test_keeps_events_returned_by_consecutive_full_syncs(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.side_effect = lambda *args, **kwargs: \
+            FakePagedResults([api_event('id1'), api_event('id2')])
+
+        calendar.refresh_events(test_user, force=True)
+        Calendar.objects.update(sync_token=None)
+        calendar.refresh_events(test_user, force=True)
+
+        assert set(Event.objects.values_list('google_id', flat=True)) \
+               == {'id1', 'id2'}
+
+    def test_only_writes_events_which_changed(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = FakePagedResults(
+                [api_event('id1'), api_event('id2')]
+        )
+        calendar.refresh_events(test_user)
+        renamed_event = api_event('id2')._replace(name='renamed')
+        api_mock.sync_events.return_value = FakePagedResults(
+                [api_event('id1'), renamed_event, api_event('id3')]
+        )
+        Calendar.objects.update(sync_token=None)
+
+        with CaptureQueriesContext(connection) as queries:
+            calendar.refresh_events(test_user, force=True)
+
+        event_writes = [q['sql'] for q in queries
+                        if q['sql'].startswith(('INSERT', 'UPDATE'))
+                        and 'timers_event' in q['sql']]
+        written = ' '.join(event_writes)
+        assert "'id1'" not in written
+        assert "'id2'" in written or 'renamed' in written
+        assert "'id3'" in written
+        assert Event.objects.get(google_id='id2').name == 'renamed'
+        assert Event.objects.count() == 3
+
+    def test_rewrites_events_saved_without_content_hash(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        create_test_event('id1', test_user_calendar)
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = FakePagedResults(
+                [api_event('id1')]
+        )
+
+        calendar.refresh_events(test_user)
+
+        assert Event.objects.get().content_hash is not None
+
+    def test_logs_how_many_events_changed(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar,
+            caplog
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = FakePagedResults(
+                [api_event('id1'), api_event('id2')]
+        )
+        calendar.refresh_events(test_user)
+        create_test_event('deleted', test_user_calendar)
+        api_mock.sync_events.return_value = FakePagedResults(
+                [api_event('id1'), api_event('id2')._replace(name='renamed')]
+        )
+        Calendar.objects.update(sync_token=None)
+        caplog.set_level(logging.INFO, logger='timers.calendar')
+
+        calendar.refresh_events(test_user, force=True)
+
+        assert "Synced the events of calendar 'test_calendar_id': " \
+               "0 inserted, 1 updated, 1 unchanged, 1 deleted" in caplog.text
+
+    def test_number_of_queries_only_grows_with_the_write_batches(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar,
+            settings
+    ):
+        api_mock = GoogleCalendarApiMock()
+
+        def count_queries_to_refresh(number_of_events):
+            Event.objects.all().delete()
+            Calendar.objects.update(sync_token=None,
+                                    synced_until=None,
+                                    last_synced_at=None)
+            clients.forget_all_calendar_apis()
+            # Half of the events already exist and will be updated, the other
+            # half is new and will be created
+            for i in range(0, number_of_events, 2):
+                create_test_event(f'id{i}', test_user_calendar)
+            api_mock.sync_events.return_value = FakePagedResults(
+                [api_event(f'id{i}') for i in range(number_of_events)]
+            )
+            with CaptureQueriesContext(connection) as queries:
+                calendar.refresh_events(test_user)
+            assert Event.objects.count() == number_of_events
+            return len(queries)
+
+        # A few queries per batch of events written, none per event
+        batch_size = settings.TIMERS_SYNC_WRITE_BATCH_SIZE
+        one_batch = count_queries_to_refresh(4)
+        per_batch = count_queries_to_refresh(batch_size + 4) - one_batch
+        assert count_queries_to_refresh(2 * batch_size + 50) \
+               == one_batch + 2 * per_batch
+        assert count_queries_to_refresh(batch_size) == one_batch
+
+    def test_no_query_to_set_up_the_client_of_a_hot_user(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        calendar.refresh_events(test_user)
+
+        with CaptureQueriesContext(connection) as queries:
+            calendar.refresh_events(test_user, force=True)
+
+        assert not [q for q in queries if 'socialaccount' in q['sql']]
+        GoogleCalendarApiMock.assert_called_once()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_fetches_all_pages_before_the_transaction_saving_them(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        in_transaction = []
+
+        class PagesInTransaction(FakePagedResults):
+            def __iter__(self):
+                in_transaction.append(connection.in_atomic_block)
+                return super().__iter__()
+
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = \
+            PagesInTransaction([api_event('id1')])
+        create_test_calendar('cal1', active=True)
+
+        calendar.refresh_events(test_user)
+
+        assert in_transaction == [False]
+        assert Event.objects.count() == 1
+
+    def test_writes_events_to_the_db_in_batches(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar,
+            settings
+    ):
+        settings.TIMERS_SYNC_WRITE_BATCH_SIZE = 2
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = FakePagedResults(
+                [api_event(f'id{i}') for i in range(5)]
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            calendar.refresh_events(test_user)
+
+        inserts = [q for q in queries if q['sql'].startswith('INSERT')]
+        assert len(inserts) == 3
+        assert Event.objects.count() == 5
+
+    def test_does_not_fail_if_events_are_inserted_by_a_concurrent_refresh(
+            self, GoogleCalendarApiMock, test_user, test_user_calendar
+    ):
+        class EventsInsertedConcurrentlyWhileIterating(FakePagedResults):
+            def __iter__(self):
+                # Simulate another refresh inserting the events after the
+                # existing events have been loaded from the DB
+                if not Event.objects.exists():
+                    create_test_event('id1', test_user_calendar)
+                return super().__iter__()
+
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_events.return_value = \
+            EventsInsertedConcurrentlyWhileIterating([api_event('id1')])
+
+        calendar.refresh_events(test_user)
+
+        assert Event.objects.filter(google_id='id1').count() == 1
+
+    class TestIncrementalSync:
+        @pytest.fixture
+        def now(self):
+            now = datetime.now(tz=timezone.utc)
+            with patch.object(calendar, 'timezone') as timezone_mock:
+                timezone_mock.now.return_value = now
+                yield now
+
+        def test_saves_sync_token_and_end_of_timeframe_after_full_sync(
+                self, now, GoogleCalendarApiMock, test_user, test_user_calendar
+        ):
+            api_mock = GoogleCalendarApiMock()
+            api_mock.sync_events.return_value = \
+                FakePagedResults([], 'the_sync_token')
+
+            calendar.refresh_events(test_user)
+
+            test_user_calendar.refresh_from_db()
+            assert test_user_calendar.sync_token == 'the_sync_token'
+            assert test_user_calendar.synced_until == now + timedelta(days=3)
+
+        def test_uses_sync_token_if_synced_timeframe_covers_the_window(
+                self, now, GoogleCalendarApiMock, test_user, test_user_calendar
+        ):
+            set_sync_state(test_user_calendar,
+                           sync_token='the_sync_token',
+                           synced_until=now + timedelta(days=2))
+            api_mock = GoogleCalendarApiMock()
+            api_mock.sync_events.return_value = \
+                FakePagedResults([], 'the_next_sync_token')
+
+            calendar.refresh_events(test_user)
+
+            api_mock.sync_events.assert_called_once_with(
+                    test_user_calendar.google_id,
+                    sync_token='the_sync_token'
+            )
+            test_user_calendar.refresh_from_db()
+            assert test_user_calendar.sync_token == 'the_next_sync_token'
+            assert test_user_calendar.synced_until == now + timedelta(days=2)
+
+        def test_runs_full_sync_if_synced_timeframe_does_not_cover_the_window(
+                self, now, GoogleCalendarApiMock, test_user, test_user_calendar
+        ):
+            set_sync_state(test_user_calendar,
+                           sync_token='the_sync_token',
+                           synced_until=now + timedelta(days=1))
+            api_mock = GoogleCalendarApiMock()
+
+            calendar.refresh_events(test_user)
+
+            api_mock.sync_events.assert_called_once_with(
+                    test_user_calendar.google_id,
+                    before=ANY,
+                    after=ANY
+            )
+
+        def test_runs_full_sync_if_sync_token_expired(
+                self, now, GoogleCalendarApiMock, test_user, test_user_calendar
+        ):
+            set_sync_state(test_user_calendar,
+                           sync_token='expired_sync_token',
+                           synced_until=now + timedelta(days=2))
+            create_test_event('not returned by full sync', test_user_calendar)
+            api_mock = GoogleCalendarApiMock()
+            api_mock.sync_events.side_effect = [
+                FakePagedResults([], error=SyncTokenExpired()),
+                FakePagedResults([api_event('id1')], 'new_sync_token')
+            ]
+
+            calendar.refresh_events(test_user)
+
+            assert api_mock.sync_events.call_args_list == [
+                call(test_user_calendar.google_id,
+                     sync_token='expired_sync_token'),
+                call(test_user_calendar.google_id, before=ANY, after=ANY)
+            ]
+            assert list(Event.objects.values_list('google_id', flat=True)) \
+                   == ['id1']
+            test_user_calendar.refresh_from_db()
+            assert test_user_calendar.sync_token == 'new_sync_token'
+
+        def test_applies_changes_and_keeps_unchanged_events(
+                self, now, GoogleCalendarApiMock, test_user, test_user_calendar
+        ):
+            set_sync_state(test_user_calendar,
+                           sync_token='the_sync_token',
+                           synced_until=now + timedelta(days=2))
+            create_test_event('unchanged', test_user_calendar)
+            create_test_event('updated', test_user_calendar)
+            create_test_event('deleted', test_user_calendar)
+            create_test_event('moved outside timeframe', test_user_calendar)
+            moved_event = api_event('moved outside timeframe')._replace(
+                    start=now + timedelta(days=10)
+            )
+            api_mock = GoogleCalendarApiMock()
+            api_mock.sync_events.return_value = FakePagedResults([
+                api_event('updated')._replace(name='UPDATED'),
+                api_event('created'),
+                GoogleEvent('deleted', deleted=True),
+                moved_event
+            ], 'the_next_sync_token')
+
+            calendar.refresh_events(test_user)
+
+            assert set(Event.objects.values_list('google_id', flat=True)) \
+                   == {'unchanged', 'updated', 'created'}
+            assert Event.objects.get(google_id='updated').name == 'UPDATED'
+
+
+@only_on_postgresql
+class TestUpsertEvents:
+    def test_saved_with_a_single_statement_on_postgresql(
+            self, test_user_calendar
+    ):
+        with CaptureQueriesContext(connection) as queries:
+            calendar._save_events(test_user_calendar,
+                                  [api_event('id1'), api_event('id2')])
+
+        assert len(queries) == 1
+        assert 'ON CONFLICT' in queries[0]['sql']
+        assert Event.objects.count() == 2
+
+    def test_inserts_new_events_and_updates_existing_ones(
+            self, test_user_calendar
+    ):
+        existing = create_test_event('existing', test_user_calendar)
+        updated = api_event('existing')._replace(name='UPDATED')
+
+        counts = calendar._save_events(test_user_calendar,
+                                       [updated, api_event('new')])
+
+        assert counts == {'inserted': 1, 'updated': 1, 'unchanged': 0}
+
+        assert Event.objects.get(id=existing.id).name == 'UPDATED'
+        new_event = Event.objects.get(google_id='new')
+        assert new_event.user_id == test_user_calendar.user_id
+        assert new_event.active
+
+    def test_saves_long_titles(self, test_user_calendar):
+        long_title = 'x' * 300
+
+        calendar._save_events(test_user_calendar,
+                              [api_event('id1')._replace(name=long_title)])
+
+        assert Event.objects.get().name == long_title
+
+    def test_keeps_the_last_of_duplicated_events(self, test_user_calendar):
+        calendar._save_events(test_user_calendar, [
+            api_event('id1'),
+            api_event('id1')._replace(name='LAST')
+        ])
+
+        assert Event.objects.get(google_id='id1').name == 'LAST'
+
+    def test_leaves_unchanged_events_untouched(self, test_user_calendar):
+        calendar._save_events(test_user_calendar, [api_event('id1')])
+
+        counts = calendar._save_events(test_user_calendar, [
+            api_event('id1'),
+            api_event('id2')
+        ])
+
+        assert counts == {'inserted': 1, 'updated': 0, 'unchanged': 1}
+
 
 class TestCalendars:
     def test_instantiate_google_api_with_user_tokens(
             self, GoogleCalendarApiMock, test_user
     ):
         calendar.refresh_calendars(test_user)
-        GoogleCalendarApiMock.assert_called_once_with(
-                token=TEST_GOOGLE_TOKEN,
-                refresh_token=TEST_GOOGLE_REFRESH_TOKEN
-        )
+        GoogleCalendarApiMock.assert_called_once_with(ANY)
+        credentials = GoogleCalendarApiMock.call_args.args[0]
+        assert credentials.token == TEST_GOOGLE_TOKEN
+        assert credentials.refresh_token == TEST_GOOGLE_REFRESH_TOKEN
 
     def test_gets_all_calendars(
             self, GoogleCalendarApiMock, test_user
     ):
         api_mock = GoogleCalendarApiMock()
         calendar.refresh_calendars(test_user)
-        api_mock.calendars.assert_called_once_with()
+        api_mock.sync_calendars.assert_called_once_with()
+
+    def test_deactivates_events_of_calendars_not_returned_by_google(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_calendars.return_value = ([], 'next_sync_token')
+        create_test_event('id1', create_test_calendar('cal1', active=True))
+
+        calendar.refresh_calendars(test_user)
+
+        assert not Event.objects.get().active
+
+    def test_invalidates_cached_dashboard(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_calendars.return_value = (
+            [{'id': 'id1', 'name': 'cal1'}], 'next_sync_token'
+        )
+        calendar.refresh_calendars(test_user)
+        assert UserSyncState.objects.get().data_version == 1
+
+    def test_keeps_cached_dashboard_when_no_calendar_changed(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_calendars.return_value = (
+            [{'id': 'id1', 'name': 'cal1'}], 'next_sync_token'
+        )
+        calendar.refresh_calendars(test_user)
+
+        calendar.refresh_calendars(test_user, force=True)
+
+        assert UserSyncState.objects.get().data_version == 1
+
+    def test_skips_calendar_list_synced_recently(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        UserSyncState.objects.create(
+                user=test_user,
+                last_synced_at=datetime.now(tz=timezone.utc)
+        )
+
+        assert not calendar.refresh_calendars(test_user)
+
+        GoogleCalendarApiMock.assert_not_called()
+
+    def test_refreshes_calendar_list_synced_recently_when_forced(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        UserSyncState.objects.create(
+                user=test_user,
+                last_synced_at=datetime.now(tz=timezone.utc)
+        )
+
+        assert calendar.refresh_calendars(test_user, force=True)
+
+        api_mock.sync_calendars.assert_called_once_with()
+
+    def test_records_sync_of_calendar_list(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        error = HttpError(httplib2.Response({'status': 500}), b'Error')
+        api_mock.sync_calendars.side_effect = error
+
+        with pytest.raises(HttpError):
+            calendar.refresh_calendars(test_user)
+        assert UserSyncState.objects.get().last_sync_status \
+               == UserSyncState.SYNC_FAILED
+
+        api_mock.sync_calendars.side_effect = None
+        calendar.refresh_calendars(test_user, force=True)
+        assert UserSyncState.objects.get().last_sync_status \
+               == UserSyncState.SYNC_OK
 
     def test_save_calendars_as_inactive_to_the_db(
             self, GoogleCalendarApiMock, test_user
     ):
         api_mock = GoogleCalendarApiMock()
-        api_mock.calendars.return_value = [
+        api_mock.sync_calendars.return_value = ([
             {'id': 'id1', 'name': 'cal1'},
             {'id': 'id2', 'name': 'cal2'},
             {'id': 'id3', 'name': 'cal3'}
-        ]
+        ], 'next_sync_token')
 
         calendar.refresh_calendars(test_user)
 
@@ -240,10 +943,10 @@ class TestCalendars:
                 active=True
         )
         api_mock = GoogleCalendarApiMock()
-        api_mock.calendars.return_value = [
+        api_mock.sync_calendars.return_value = ([
             {'id': 'id1', 'name': 'exists in db and is active - UPDATE'},
             {'id': 'id2', 'name': 'cal2'}
-        ]
+        ], 'next_sync_token')
 
         calendar.refresh_calendars(test_user)
 
@@ -269,9 +972,9 @@ class TestCalendars:
                 active=True
         )
         api_mock = GoogleCalendarApiMock()
-        api_mock.calendars.return_value = [
+        api_mock.sync_calendars.return_value = ([
             {'id': 'shared_google_id', 'name': 'UPDATED'}
-        ]
+        ], 'next_sync_token')
 
         calendar.refresh_calendars(test_user)
 
@@ -302,10 +1005,10 @@ class TestCalendars:
                                 user=another_user,
                                 active=True)
         api_mock = GoogleCalendarApiMock()
-        api_mock.calendars.return_value = [
+        api_mock.sync_calendars.return_value = ([
             {'id': 'id1', 'name': 'still active'}
             # calendar 'id2' is not returned by the api
-        ]
+        ], 'next_sync_token')
 
         calendar.refresh_calendars(test_user)
 
@@ -319,12 +1022,312 @@ class TestCalendars:
                 user=another_user
         ).active
 
+    def test_number_of_queries_does_not_grow_with_the_number_of_calendars(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        UserSyncState.objects.create(user=test_user)
+
+        def count_queries_to_refresh(number_of_calendars):
+            Calendar.objects.all().delete()
+            UserSyncState.objects.update(calendar_list_sync_token=None)
+            clients.forget_all_calendar_apis()
+            create_test_calendar('not returned', active=True)
+            # Half of the calendars already exist and were renamed, the other
+            # half is new
+            for i in range(0, number_of_calendars, 2):
+                create_test_calendar(f'id{i}', active=True)
+            api_mock.sync_calendars.return_value = (
+                [{'id': f'id{i}', 'name': f'renamed{i}'}
+                 for i in range(number_of_calendars)],
+                'next_sync_token'
+            )
+            with CaptureQueriesContext(connection) as queries:
+                calendar.refresh_calendars(test_user, force=True)
+            assert Calendar.objects.filter(name__startswith='renamed') \
+                       .count() == number_of_calendars
+            assert not Calendar.objects.get(google_id='not returned').active
+            return len(queries)
+
+        # Below the number of rows Django inserts per query on SQLite
+        assert count_queries_to_refresh(4) == count_queries_to_refresh(60)
+
+    def test_deactivates_calendars_without_listing_returned_ones(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        create_test_calendar('not returned', active=True)
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_calendars.return_value = (
+            [{'id': f'id{i}', 'name': f'cal{i}'} for i in range(20)],
+            'next_sync_token'
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            calendar.refresh_calendars(test_user)
+
+        assert not any('NOT IN' in q['sql'] for q in queries)
+        assert not any("'id1'" in q['sql'] for q in queries
+                       if q['sql'].startswith('UPDATE'))
+        assert not Calendar.objects.get(google_id='not returned').active
+
+    def test_only_writes_calendars_which_changed(
+            self, GoogleCalendarApiMock, test_user
+    ):
+        api_mock = GoogleCalendarApiMock()
+        api_mock.sync_calendars.return_value = (
+            [{'id': 'id1', 'name': 'cal1'}, {'id': 'id2', 'name': 'cal2'}],
+            'next_sync_token'
+        )
+        calendar.refresh_calendars(test_user)
+        api_mock.sync_calendars.return_value = (
+            [{'id': 'id1', 'name': 'cal1'}, {'id': 'id2', 'name': 'renamed'}],
+            'next_sync_token'
+        )
+        UserSyncState.objects.update(calendar_list_sync_token=None)
+
+        with CaptureQueriesContext(connection) as queries:
+            calendar.refresh_calendars(test_user, force=True)
+
+        calendar_writes = [q['sql'] for q in queries
+                           if q['sql'].startswith(('INSERT', 'UPDATE'))
+                           and 'timers_calendar' in q['sql']]
+        assert len(calendar_writes) == 1
+        assert Calendar.objects.get(google_id='id2').name == 'renamed'
+
+    class TestIncrementalSync:
+        def test_saves_sync_token_after_full_sync(
+                self, GoogleCalendarApiMock, test_user
+        ):
+            api_mock = GoogleCalendarApiMock()
+            api_mock.sync_calendars.return_value = ([], 'the_sync_token')
+
+            calendar.refresh_calendars(test_user)
+
+            assert UserSyncState.objects.get(user=test_user) \
+                       .calendar_list_sync_token == 'the_sync_token'
+
+        def test_uses_sync_token_and_applies_changes(
+                self, GoogleCalendarApiMock, test_user
+        ):
+            UserSyncState.objects.create(
+                    user=test_user,
+                    calendar_list_sync_token='the_sync_token'
+            )
+            create_test_calendar('unchanged', active=True)
+            create_test_calendar('renamed', active=True)
+            create_test_calendar('deleted', active=True)
+            api_mock = GoogleCalendarApiMock()
+            api_mock.sync_calendars.return_value = ([
+                {'id': 'renamed', 'name': 'RENAMED'},
+                {'id': 'created', 'name': 'created'},
+                {'id': 'deleted', 'deleted': True}
+            ], 'the_next_sync_token')
+
+            calendar.refresh_calendars(test_user)
+
+            api_mock.sync_calendars.assert_called_once_with(
+                    sync_token='the_sync_token'
+            )
+            active_by_google_id = dict(
+                    Calendar.objects.values_list('google_id', 'active')
+            )
+            assert active_by_google_id == {'unchanged': True,
+                                           'renamed': True,
+                                           'created': False,
+                                           'deleted': False}
+            assert Calendar.objects.get(google_id='renamed').name == 'RENAMED'
+            assert UserSyncState.objects.get(user=test_user) \
+                       .calendar_list_sync_token == 'the_next_sync_token'
+
+        def test_runs_full_sync_if_sync_token_expired(
+                self, GoogleCalendarApiMock, test_user
+        ):
+            UserSyncState.objects.create(
+                    user=test_user,
+                    calendar_list_sync_token='expired_sync_token'
+            )
+            create_test_calendar('not returned by full sync', active=True)
+            api_mock = GoogleCalendarApiMock()
+            api_mock.sync_calendars.side_effect = [
+                SyncTokenExpired(),
+                ([{'id': 'id1', 'name': 'cal1'}], 'new_sync_token')
+            ]
+
+            calendar.refresh_calendars(test_user)
+
+            assert api_mock.sync_calendars.call_args_list == [
+                call(sync_token='expired_sync_token'),
+                call()
+            ]
+            assert not Calendar.objects \
+                .get(google_id='not returned by full sync') \
+                .active
+            assert UserSyncState.objects.get(user=test_user) \
+                       .calendar_list_sync_token == 'new_sync_token'
+
+
+class TestRefreshEventsAsync:
+    @pytest.fixture(autouse=True)
+    def async_calendar_api(self, fake_google_api):
+        with patch.object(calendar,
+                          'async_calendar_api_for',
+                          new_callable=AsyncMock) as async_calendar_api_for:
+            async_calendar_api_for.return_value = \
+                fake_google_api.async_calendar_api()
+            yield
+
+    def test_saves_the_events_of_all_active_calendars(self, test_user):
+        create_test_calendar('cal1', active=True)
+        create_test_calendar('cal2', active=False)
+        create_test_calendar('cal3', active=True)
+
+        refreshed = async_to_sync(calendar.refresh_events_async)(test_user)
+
+        assert refreshed == 2
+        assert Event.objects.filter(calendar__google_id='cal1').count() == 20
+        assert Event.objects.filter(calendar__google_id='cal3').count() == 20
+        assert Calendar.objects.get(google_id='cal1').sync_token \
+               == 'fake_sync_token'
+
+    def test_fetches_calendars_concurrently_within_the_limit(
+            self, test_user, fake_google_api, settings
+    ):
+        settings.TIMERS_SYNC_MAX_PARALLEL_CALENDARS = 2
+        fake_google_api.latency = 0.1
+        for i in range(5):
+            create_test_calendar(f'cal{i}', active=True)
+
+        async_to_sync(calendar.refresh_events_async)(test_user)
+
+        assert fake_google_api.max_concurrent_requests == 2
+
+    def test_invalidates_cached_dashboard_only_when_events_changed(
+            self, test_user
+    ):
+        create_test_calendar('cal1', active=True)
+        UserSyncState.objects.create(user=test_user)
+
+        async_to_sync(calendar.refresh_events_async)(test_user)
+        async_to_sync(calendar.refresh_events_async)(test_user, force=True)
+
+        assert UserSyncState.objects.get().data_version == 1
+
+    def test_full_sync_when_sync_token_expired(self, test_user):
+        cal = create_test_calendar('cal1', active=True)
+        set_sync_state(cal, 'expired', datetime.now(tz=timezone.utc)
+                       + timedelta(days=7))
+
+        async_to_sync(calendar.refresh_events_async)(test_user)
+
+        cal.refresh_from_db()
+        assert cal.sync_token == 'fake_sync_token'
+        assert Event.objects.filter(calendar=cal).count() == 20
+
+    def test_other_calendars_refreshed_when_one_fails(self, test_user):
+        failing = create_test_calendar('cal1', active=True)
+        create_test_calendar('cal2', active=True)
+        error = HttpError(httplib2.Response({'status': 500}), b'Error')
+
+        with patch.object(calendar,
+                          '_sync_events_async',
+                          side_effect=[error, Counter()]):
+            refreshed = async_to_sync(calendar.refresh_events_async)(
+                    test_user
+            )
+
+        assert refreshed == 1
+        failing.refresh_from_db()
+        assert failing.last_sync_status == Calendar.SYNC_FAILED
+
+
+class TestRefreshCalendarsAsync:
+    @pytest.fixture(autouse=True)
+    def async_calendar_api(self, fake_google_api):
+        with patch.object(calendar,
+                          'async_calendar_api_for',
+                          new_callable=AsyncMock) as async_calendar_api_for:
+            async_calendar_api_for.return_value = \
+                fake_google_api.async_calendar_api()
+            yield
+
+    def test_saves_the_calendar_list(self, test_user):
+        create_test_calendar('not returned by google', active=True)
+
+        refreshed = async_to_sync(calendar.refresh_calendars_async)(
+                test_user,
+                force=True
+        )
+
+        assert refreshed
+        assert Calendar.objects.filter(user=test_user, active=False) \
+                   .count() == 11
+        assert UserSyncState.objects.get(user=test_user) \
+                   .calendar_list_sync_token == 'fake_sync_token'
+
+    def test_full_sync_when_sync_token_expired(self, test_user):
+        UserSyncState.objects.create(user=test_user,
+                                     calendar_list_sync_token='expired')
+
+        async_to_sync(calendar.refresh_calendars_async)(test_user,
+                                                        force=True)
+
+        assert Calendar.objects.filter(user=test_user).count() == 10
+
+    def test_skips_calendar_list_synced_recently(
+            self, test_user, fake_google_api
+    ):
+        async_to_sync(calendar.refresh_calendars_async)(test_user)
+
+        refreshed = async_to_sync(calendar.refresh_calendars_async)(
+                test_user
+        )
+
+        assert not refreshed
+        assert fake_google_api.http_requests == 1
+
+
+class FakePagedResults(list):
+    """Stands for the `PagedResults` returned by `GoogleCalendarApi`"""
+
+    def __init__(self, items, next_sync_token='next_sync_token', error=None):
+        super().__init__(items)
+        self.next_sync_token = next_sync_token
+        self.error = error
+
+    def __iter__(self):
+        if self.error:
+            raise self.error
+        return super().__iter__()
+
+
+def set_sync_state(cal, sync_token, synced_until):
+    cal.sync_token = sync_token
+    cal.synced_until = synced_until
+    cal.save()
+
+
+def create_test_event(google_id, cal):
+    return Event.objects.create(google_id=google_id,
+                                name='name_' + google_id,
+                                start=datetime.now(tz=timezone.utc),
+                                end=datetime.now(tz=timezone.utc),
+                                calendar=cal)
+
+
+def api_event(google_id):
+    start = datetime(2021, 10, 15, 10, 5, tzinfo=timezone.utc)
+    return GoogleEvent(google_id,
+                       'name_' + google_id,
+                       start,
+                       start + timedelta(hours=1))
+
 
-def create_test_calendar(google_id, active):
+def create_test_calendar(google_id, active, **kwargs):
     test_user = User.objects.get(username=TEST_USERNAME)
     return Calendar.objects.create(
             google_id=google_id,
             name='name_' + google_id,
             user=test_user,
-            active=active
+            active=active,
+            **kwargs
     )
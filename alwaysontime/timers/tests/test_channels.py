@@ -0,0 +1,280 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, ANY, Mock
+
+import httplib2
+import pytest
+from django.core.management import call_command
+from django.utils import timezone as django_timezone
+from googleapiclient.errors import HttpError
+
+import timers.channels as channels
+import timers.management.commands.send_fake_notification as fake_notification
+from conftest import create_calendar
+from timers.models import Calendar
+
+pytestmark = pytest.mark.django_db
+
+WEBHOOK_URL = 'https://example.com/calendars/notifications/'
+CHANNEL_EXPIRES_AT = datetime(2030, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def calendar_api_mock():
+    with patch.object(channels, 'calendar_api_for') as calendar_api_for_mock:
+        api_mock = calendar_api_for_mock()
+        api_mock.watch_events.side_effect = \
+            lambda calendar_id, channel_id, **_: {
+                'id': channel_id,
+                'resource_id': f'resource_{calendar_id}',
+                'expires_at': CHANNEL_EXPIRES_AT
+            }
+        yield api_mock
+
+
+@pytest.fixture
+def webhook_url(settings):
+    settings.TIMERS_WATCH_CHANNELS_WEBHOOK_URL = WEBHOOK_URL
+
+
+def create_watched_calendar(user, google_id='cal1', active=True,
+                            expires_at=CHANNEL_EXPIRES_AT):
+    return create_calendar(user,
+                           google_id,
+                           active=active,
+                           channel_id=f'channel_{google_id}',
+                           channel_resource_id=f'resource_{google_id}',
+                           channel_token='secret_token',
+                           channel_expires_at=expires_at)
+
+
+class TestHandleNotification:
+    def test_marks_calendar_as_due(self, test_user):
+        cal = create_watched_calendar(test_user)
+        before = django_timezone.now()
+
+        assert channels.handle_notification(cal.channel_id,
+                                            'secret_token',
+                                            'exists')
+
+        cal.refresh_from_db()
+        assert before <= cal.next_sync_at <= django_timezone.now()
+
+    def test_ignores_notification_confirming_channel_creation(
+            self, test_user
+    ):
+        cal = create_watched_calendar(test_user)
+
+        assert channels.handle_notification(cal.channel_id,
+                                            'secret_token',
+                                            'sync')
+
+        cal.refresh_from_db()
+        assert cal.next_sync_at is None
+
+    @pytest.mark.parametrize('token', ['wrong_token', 'tökén', '', None])
+    def test_rejects_wrong_token(self, test_user, token):
+        cal = create_watched_calendar(test_user)
+
+        assert not channels.handle_notification(cal.channel_id,
+                                                token,
+                                                'exists')
+
+        cal.refresh_from_db()
+        assert cal.next_sync_at is None
+
+    def test_rejects_unknown_channel(self, test_user):
+        create_watched_calendar(test_user)
+        assert not channels.handle_notification('unknown_channel',
+                                                'secret_token',
+                                                'exists')
+
+
+class TestRenewChannels:
+    def test_does_nothing_without_webhook_url(
+            self, calendar_api_mock, test_user, settings
+    ):
+        settings.TIMERS_WATCH_CHANNELS_WEBHOOK_URL = None
+        create_calendar(test_user, 'cal1')
+
+        channels.renew_channels()
+
+        calendar_api_mock.watch_events.assert_not_called()
+
+    def test_watches_active_calendars(
+            self, calendar_api_mock, webhook_url, test_user, settings
+    ):
+        settings.TIMERS_WATCH_CHANNELS_TTL_SECONDS = 60 * 60
+        cal = create_calendar(test_user, 'cal1')
+        create_calendar(test_user, 'inactive', active=False)
+
+        channels.renew_channels()
+
+        calendar_api_mock.watch_events.assert_called_once_with(
+                'cal1',
+                channel_id=ANY,
+                token=ANY,
+                address=WEBHOOK_URL,
+                ttl=timedelta(hours=1)
+        )
+        cal.refresh_from_db()
+        assert cal.channel_id \
+               == calendar_api_mock.watch_events.call_args.kwargs['channel_id']
+        assert cal.channel_token \
+               == calendar_api_mock.watch_events.call_args.kwargs['token']
+        assert cal.channel_resource_id == 'resource_cal1'
+        assert cal.channel_expires_at == CHANNEL_EXPIRES_AT
+
+    def test_every_channel_has_its_own_token(
+            self, calendar_api_mock, webhook_url, test_user
+    ):
+        create_calendar(test_user, 'cal1')
+        create_calendar(test_user, 'cal2')
+
+        channels.renew_channels()
+
+        cal1, cal2 = Calendar.objects.order_by('google_id')
+        assert cal1.channel_token != cal2.channel_token
+
+    def test_does_not_renew_channels_far_from_expiring(
+            self, calendar_api_mock, webhook_url, test_user
+    ):
+        create_watched_calendar(test_user)
+
+        channels.renew_channels()
+
+        calendar_api_mock.watch_events.assert_not_called()
+
+    def test_replaces_channels_about_to_expire(
+            self, calendar_api_mock, webhook_url, test_user, settings
+    ):
+        settings.TIMERS_WATCH_CHANNELS_RENEWAL_MARGIN_SECONDS = 60 * 60
+        cal = create_watched_calendar(
+                test_user,
+                expires_at=django_timezone.now() + timedelta(minutes=59)
+        )
+
+        channels.renew_channels()
+
+        calendar_api_mock.stop_channel.assert_called_once_with(
+                'channel_cal1', 'resource_cal1'
+        )
+        cal.refresh_from_db()
+        assert cal.channel_id != 'channel_cal1'
+        assert cal.channel_expires_at == CHANNEL_EXPIRES_AT
+
+    def test_stops_channels_of_inactive_calendars(
+            self, calendar_api_mock, webhook_url, test_user
+    ):
+        cal = create_watched_calendar(test_user, active=False)
+
+        channels.renew_channels()
+
+        calendar_api_mock.stop_channel.assert_called_once_with(
+                'channel_cal1', 'resource_cal1'
+        )
+        cal.refresh_from_db()
+        assert cal.channel_id is None
+        assert cal.channel_token is None
+
+    def test_forgets_channel_even_if_google_fails_to_stop_it(
+            self, calendar_api_mock, webhook_url, test_user
+    ):
+        calendar_api_mock.stop_channel.side_effect = Exception('Not found')
+        cal = create_watched_calendar(test_user, active=False)
+
+        channels.renew_channels()
+
+        cal.refresh_from_db()
+        assert cal.channel_id is None
+
+    def test_a_failing_calendar_does_not_prevent_watching_the_others(
+            self, calendar_api_mock, webhook_url, test_user
+    ):
+        watch_events = calendar_api_mock.watch_events.side_effect
+        calendar_api_mock.watch_events.side_effect = [
+            Exception('Boom'),
+            watch_events('cal2', channel_id='channel')
+        ]
+        create_calendar(test_user, 'cal1')
+        create_calendar(test_user, 'cal2')
+
+        channels.renew_channels()
+
+        assert Calendar.objects.filter(channel_id__isnull=False).count() == 1
+
+    def test_does_not_retry_calendars_google_refused_to_watch(
+            self, calendar_api_mock, webhook_url, test_user, caplog
+    ):
+        calendar_api_mock.watch_events.side_effect = HttpError(
+                httplib2.Response({'status': 400}),
+                b'pushNotSupportedForRequestedResource'
+        )
+        cal = create_calendar(test_user, 'cal1')
+
+        with caplog.at_level(logging.WARNING, logger='timers.channels'):
+            channels.renew_channels()
+            channels.renew_channels()
+
+        calendar_api_mock.watch_events.assert_called_once()
+        cal.refresh_from_db()
+        assert cal.channel_retry_at > django_timezone.now()
+        assert cal.channel_expires_at is None
+        assert [r.levelno for r in caplog.records] == [logging.WARNING]
+        assert caplog.records[0].exc_info is None
+
+    def test_retries_watching_calendars_after_a_while(
+            self, calendar_api_mock, webhook_url, test_user
+    ):
+        cal = create_calendar(
+                test_user,
+                'cal1',
+                channel_retry_at=django_timezone.now() - timedelta(seconds=1)
+        )
+
+        channels.renew_channels()
+
+        cal.refresh_from_db()
+        assert cal.channel_expires_at == CHANNEL_EXPIRES_AT
+        assert cal.channel_retry_at is None
+
+    def test_stops_new_channel_if_renewed_concurrently(
+            self, calendar_api_mock, webhook_url, test_user
+    ):
+        cal = create_calendar(test_user, 'cal1')
+        # Another scheduler instance renews the channel in the meantime
+        Calendar.objects.filter(id=cal.id).update(channel_id='concurrent')
+
+        channels.watch_calendar(cal)
+
+        new_channel_id = \
+            calendar_api_mock.watch_events.call_args.kwargs['channel_id']
+        calendar_api_mock.stop_channel.assert_called_once_with(
+                new_channel_id, 'resource_cal1'
+        )
+        assert Calendar.objects.get().channel_id == 'concurrent'
+
+
+class TestSendFakeNotification:
+    def test_notifies_webhook_offline(self, client, test_user, capsys):
+        cal = create_calendar(test_user, 'cal1')
+
+        def post(url, headers):
+            django_headers = {
+                'HTTP_' + name.upper().replace('-', '_'): value
+                for name, value in headers.items()
+            }
+            response = client.post(url, **django_headers)
+            return Mock(status_code=response.status_code,
+                        text=response.content.decode())
+
+        with patch.object(fake_notification.requests, 'post',
+                          side_effect=post) as post_mock:
+            call_command('send_fake_notification', cal.id,
+                         '--url', '/calendars/notifications/')
+
+        post_mock.assert_called_once()
+        assert capsys.readouterr().out == '200 Ok\n'
+        cal.refresh_from_db()
+        assert cal.channel_id is not None
+        assert cal.next_sync_at is not None
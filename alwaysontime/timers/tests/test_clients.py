@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+from allauth.socialaccount.models import SocialToken
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+import timers.clients as clients
+from conftest import TEST_GOOGLE_TOKEN
+
+pytestmark = pytest.mark.django_db
+
+NOW = datetime(2021, 12, 24, 19, 30, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def now():
+    with patch.object(clients, 'timezone') as timezone_mock:
+        timezone_mock.now.return_value = NOW
+        yield timezone_mock.now
+
+
+def create_other_user_with_token(token):
+    other_user = User.objects.create_user(username='other_user')
+    SocialToken.objects.create(
+            account=other_user.socialaccount_set.create(uid='other_user'),
+            app=SocialToken.objects.get().app,
+            token=token
+    )
+    return other_user
+
+
+class TestCalendarApiFor:
+    def test_client_is_authorized_with_user_token(self, test_user):
+        calendar_api = clients.calendar_api_for(test_user)
+        assert calendar_api.credentials.token == TEST_GOOGLE_TOKEN
+
+    def test_reuse_client_without_querying_the_db(self, test_user):
+        calendar_api = clients.calendar_api_for(test_user)
+
+        with CaptureQueriesContext(connection) as queries:
+            assert clients.calendar_api_for(test_user) is calendar_api
+
+        assert len(queries) == 0
+
+    def test_one_client_per_user(self, test_user):
+        other_user = create_other_user_with_token('other_token')
+
+        assert clients.calendar_api_for(test_user).credentials.token \
+               == TEST_GOOGLE_TOKEN
+        assert clients.calendar_api_for(other_user).credentials.token \
+               == 'other_token'
+
+    def test_build_client_again_after_ttl(self, test_user, now, settings):
+        settings.TIMERS_API_CLIENT_CACHE_TTL_SECONDS = 60
+        calendar_api = clients.calendar_api_for(test_user)
+
+        now.return_value = NOW + timedelta(seconds=59)
+        assert clients.calendar_api_for(test_user) is calendar_api
+        now.return_value = NOW + timedelta(seconds=60)
+        assert clients.calendar_api_for(test_user) is not calendar_api
+
+    def test_build_client_again_when_token_is_about_to_expire(
+            self, test_user, now, settings
+    ):
+        settings.TIMERS_API_CLIENT_CACHE_TTL_SECONDS = 60 * 60
+        settings.TIMERS_TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+        # Far enough in the future not to be refreshed right away
+        SocialToken.objects.update(
+                expires_at=datetime.now(tz=timezone.utc) + timedelta(hours=1)
+        )
+        calendar_api = clients.calendar_api_for(test_user)
+
+        now.return_value = datetime.now(tz=timezone.utc) \
+                           + timedelta(minutes=56)
+        assert clients.calendar_api_for(test_user) is not calendar_api
+
+    def test_only_keep_most_recently_used_clients(
+            self, test_user, settings
+    ):
+        settings.TIMERS_API_CLIENT_CACHE_SIZE = 1
+        other_user = create_other_user_with_token('other_token')
+        calendar_api = clients.calendar_api_for(test_user)
+
+        clients.calendar_api_for(other_user)
+
+        assert clients.calendar_api_for(test_user) is not calendar_api
+
+    def test_build_client_again_when_token_changes(self, test_user):
+        calendar_api = clients.calendar_api_for(test_user)
+
+        social_token = SocialToken.objects.get()
+        social_token.token = 'new_token'
+        social_token.save()
+
+        new_calendar_api = clients.calendar_api_for(test_user)
+        assert new_calendar_api is not calendar_api
+        assert new_calendar_api.credentials.token == 'new_token'
+
+    def test_build_client_again_when_token_is_deleted(self, test_user):
+        clients.calendar_api_for(test_user)
+
+        SocialToken.objects.get().delete()
+
+        with pytest.raises(SocialToken.DoesNotExist):
+            clients.calendar_api_for(test_user)
+
+    def test_forget_client_of_user(self, test_user):
+        calendar_api = clients.calendar_api_for(test_user)
+
+        clients.forget_calendar_api_of(test_user)
+
+        assert clients.calendar_api_for(test_user) is not calendar_api
@@ -0,0 +1,158 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import timers.dashboard as dashboard
+from timers.calendar import set_calendars_active
+from timers.models import Calendar, Event, UserSyncState
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def sync_state(test_user):
+    return UserSyncState.objects.create(user=test_user)
+
+
+def create_event(cal, google_id, start):
+    return Event.objects.create(google_id=google_id,
+                                name=google_id,
+                                start=start,
+                                end=start + timedelta(hours=1),
+                                calendar=cal)
+
+
+def event_names(user_dashboard):
+    return [e.name for e in user_dashboard['events']]
+
+
+class TestDashboardOf:
+    def test_returns_active_calendars_and_events_to_show(
+            self, test_user, test_user_calendar, sync_state, settings
+    ):
+        settings.TIMERS_SHOW_X_MIN_FUTURE = 60
+        Calendar.objects.create(google_id='inactive',
+                                name='inactive',
+                                user=test_user)
+        create_event(test_user_calendar,
+                     'later',
+                     timezone.now() + timedelta(minutes=30))
+        create_event(test_user_calendar,
+                     'next',
+                     timezone.now() + timedelta(minutes=10))
+        create_event(test_user_calendar,
+                     'too far',
+                     timezone.now() + timedelta(minutes=90))
+
+        user_dashboard = dashboard.dashboard_of(test_user)
+
+        assert user_dashboard['active_calendars'] == ['test_calendar']
+        assert event_names(user_dashboard) == ['next', 'later']
+
+    def test_only_queries_the_data_version_when_cached(
+            self, test_user, test_user_calendar, sync_state
+    ):
+        dashboard.dashboard_of(test_user)
+
+        with CaptureQueriesContext(connection) as queries:
+            dashboard.dashboard_of(test_user)
+
+        assert len(queries) == 1
+
+    def test_new_data_version_is_not_cached_yet(
+            self, test_user, test_user_calendar, sync_state
+    ):
+        dashboard.dashboard_of(test_user)
+        create_event(test_user_calendar, 'new', timezone.now())
+
+        dashboard.bump_data_version([test_user.id])
+
+        assert event_names(dashboard.dashboard_of(test_user)) == ['new']
+
+    def test_events_enter_and_leave_the_timeframe_while_cached(
+            self, test_user, test_user_calendar, sync_state, settings
+    ):
+        settings.TIMERS_SHOW_X_MIN_PAST = 10
+        settings.TIMERS_SHOW_X_MIN_FUTURE = 60
+        settings.TIMERS_DASHBOARD_CACHE_SECONDS = 5 * 60
+        now = timezone.now()
+        create_event(test_user_calendar, 'started', now - timedelta(minutes=8))
+        create_event(test_user_calendar, 'coming', now + timedelta(minutes=62))
+        dashboard.dashboard_of(test_user)
+
+        with patch.object(dashboard, 'timezone') as timezone_mock:
+            timezone_mock.now.return_value = now + timedelta(minutes=3)
+            user_dashboard = dashboard.dashboard_of(test_user)
+
+        assert event_names(user_dashboard) == ['coming']
+
+    def test_not_cached_before_the_first_sync(
+            self, test_user, test_user_calendar
+    ):
+        dashboard.dashboard_of(test_user)
+        create_event(test_user_calendar, 'new', timezone.now())
+
+        assert event_names(dashboard.dashboard_of(test_user)) == ['new']
+
+    def test_not_cached_when_disabled(
+            self, test_user, test_user_calendar, sync_state, settings
+    ):
+        settings.TIMERS_DASHBOARD_CACHE_SECONDS = 0
+        dashboard.dashboard_of(test_user)
+        create_event(test_user_calendar, 'new', timezone.now())
+
+        assert event_names(dashboard.dashboard_of(test_user)) == ['new']
+
+
+class TestUpcomingEvents:
+    def test_includes_events_entering_the_timeframe_during_the_period(
+            self, test_user, test_user_calendar, settings
+    ):
+        settings.TIMERS_SHOW_X_MIN_FUTURE = 60
+        settings.TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS = 5 * 60
+        period_start = dashboard.period_start_of(timezone.now())
+        create_event(test_user_calendar,
+                     'entering',
+                     period_start + timedelta(minutes=64))
+        create_event(test_user_calendar,
+                     'too far',
+                     period_start + timedelta(minutes=66))
+
+        events = dashboard.upcoming_events(test_user, period_start)
+
+        assert [e['name'] for e in events] == ['entering']
+
+    def test_same_period_start_during_the_whole_period(self, settings):
+        settings.TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS = 60
+        period_start = dashboard.period_start_of(timezone.now())
+
+        assert dashboard.period_start_of(
+                period_start + timedelta(seconds=59)
+        ) == period_start
+        assert dashboard.period_start_of(
+                period_start + timedelta(seconds=60)
+        ) > period_start
+
+
+class TestBumpDataVersion:
+    def test_bumped_when_activating_calendars(
+            self, test_user, test_user_calendar, sync_state
+    ):
+        set_calendars_active(Calendar.objects.all(), False)
+
+        sync_state.refresh_from_db()
+        assert sync_state.data_version == 1
+
+    def test_only_bumps_the_given_users(
+            self, test_user, sync_state, another_user
+    ):
+        other_sync_state = UserSyncState.objects.create(user=another_user)
+
+        dashboard.bump_data_version([test_user.id])
+
+        other_sync_state.refresh_from_db()
+        assert other_sync_state.data_version == 0
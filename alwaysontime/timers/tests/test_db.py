@@ -0,0 +1,73 @@
+import pytest
+from django.db import connections, DEFAULT_DB_ALIAS, OperationalError
+
+from conftest import only_on_sqlite
+
+pytestmark = [pytest.mark.django_db, only_on_sqlite]
+
+
+@pytest.fixture
+def new_file_connection(tmp_path):
+    """Returns new connections to the same database file"""
+    file_connections = []
+
+    def new_file_connection():
+        connection = connections[DEFAULT_DB_ALIAS]
+        file_connection = type(connection)(
+                {**connection.settings_dict,
+                 'NAME': str(tmp_path / 'db.sqlite3')}
+        )
+        file_connections.append(file_connection)
+        return file_connection
+
+    yield new_file_connection
+    for file_connection in file_connections:
+        file_connection.close()
+
+
+@pytest.fixture
+def file_connection(new_file_connection):
+    return new_file_connection()
+
+
+def pragma(db_connection, name):
+    with db_connection.cursor() as cursor:
+        cursor.execute(f'PRAGMA {name}')
+        return cursor.fetchone()[0]
+
+
+class TestSqlitePragmas:
+    def test_set_on_new_connections(self, file_connection):
+        assert pragma(file_connection, 'journal_mode') == 'wal'
+        # NORMAL
+        assert pragma(file_connection, 'synchronous') == 1
+        assert pragma(file_connection, 'busy_timeout') == 5000
+        assert pragma(file_connection, 'cache_size') == -32 * 1024
+
+    def test_can_be_configured(self, file_connection, settings):
+        settings.TIMERS_SQLITE_PRAGMAS = {'busy_timeout': 100}
+
+        assert pragma(file_connection, 'busy_timeout') == 100
+        assert pragma(file_connection, 'journal_mode') == 'delete'
+
+
+class TestTransactionMode:
+    def test_transactions_take_the_write_lock_upfront(
+            self, new_file_connection, settings
+    ):
+        settings.TIMERS_SQLITE_PRAGMAS = {'busy_timeout': 0}
+        connection = new_file_connection()
+        other_connection = new_file_connection()
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE test (id INTEGER)')
+
+        # Starts a transaction like 'transaction.atomic()' does
+        connection.set_autocommit(
+                False,
+                force_begin_transaction_with_broken_autocommit=True
+        )
+
+        with pytest.raises(OperationalError, match='locked'):
+            with other_connection.cursor() as cursor:
+                cursor.execute('INSERT INTO test VALUES (1)')
+        connection.rollback()
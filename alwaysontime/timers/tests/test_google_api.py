@@ -1,84 +1,94 @@
+import json
+import socket
+import threading
 from datetime import datetime, timezone, timedelta
-from unittest.mock import patch
+from unittest.mock import patch, ANY, Mock
 
+import httplib2
 import pytest
 import pytz
+from googleapiclient.errors import HttpError
 
 import timers.google_api
-from alwaysontime.settings import GOOGLE_SCOPES
-from conftest import TEST_GOOGLE_APP_CLIENT_ID, TEST_GOOGLE_APP_SECRET
-from timers.google_api import GoogleCalendarApi
+from timers.google_api import GoogleCalendarApi, SyncTokenExpired, \
+    MAX_REQUESTS_PER_BATCH
+from timers.google_events import GoogleEvent
+from timers.tests.fake_google_api import apply_fields_mask, EVENTS_LIST
 
 pytestmark = pytest.mark.django_db
 
+# Only what the domain mappers read
+EVENTS_FIELDS = 'nextPageToken,nextSyncToken,timeZone,items(id,status,' \
+                'summary,start(date,dateTime),end(date,dateTime))'
+CALENDARS_FIELDS = 'nextPageToken,nextSyncToken,items(id,deleted,summary)'
+
 
 @pytest.fixture
-def CredentialsMock():
-    with patch.object(timers.google_api, 'Credentials') as CredentialsMock:
-        CredentialsMock().expired = False
-        CredentialsMock.reset_mock()
-        yield CredentialsMock
+def credentials():
+    return Mock()
 
 
 class TestInit:
-    def test_create_credentials_from_user_token_using_google_app(
-            self, CredentialsMock, test_user
+    @patch.object(timers.google_api, 'AuthorizedHttp')
+    def test_authorize_requests_with_credentials(
+            self, AuthorizedHttpMock, credentials
     ):
-        token = 'token'
-        refresh_token = 'refresh_token'
-
-        GoogleCalendarApi(token, refresh_token)
-
-        CredentialsMock.assert_called_once_with(
-                token=token,
-                refresh_token=refresh_token,
-                token_uri='https://oauth2.googleapis.com/token',
-                client_id=TEST_GOOGLE_APP_CLIENT_ID,
-                client_secret=TEST_GOOGLE_APP_SECRET,
-                scopes=GOOGLE_SCOPES
+        http = GoogleCalendarApi(credentials).http
+        AuthorizedHttpMock.assert_called_once_with(credentials, http=ANY)
+        assert http == AuthorizedHttpMock()
+
+    def test_every_thread_gets_its_own_http_client(self, credentials):
+        google_api = GoogleCalendarApi(credentials)
+        http_of_other_thread = []
+        thread = threading.Thread(
+                target=lambda: http_of_other_thread.append(google_api.http)
         )
+        thread.start()
+        thread.join()
 
-    @patch.object(timers.google_api, 'Request')
-    def test_refresh_credentials_if_expired(
-            self, RequestMock, CredentialsMock, test_user
-    ):
-        credentials_mock = CredentialsMock()
-        credentials_mock.expired = True
-
-        GoogleCalendarApi('not_used', 'not_used')
-
-        credentials_mock.refresh.assert_called_once_with(RequestMock())
-
-    def test_dont_refresh_credentials_if_not_expired(
-            self, CredentialsMock, test_user
-    ):
-        credentials_mock = CredentialsMock()
-        credentials_mock.expired = False
-
-        GoogleCalendarApi('not_used', 'not_used')
+        assert google_api.http is google_api.http
+        assert google_api.http is not http_of_other_thread[0]
 
-        credentials_mock.refresh.assert_not_called()
-
-    @patch.object(timers.google_api, 'build')
-    def test_build_calendar_service_with_credentials(
-            self, build_mock, CredentialsMock, test_user
+    def test_build_calendar_service_once_per_process_from_static_document(
+            self, build_mock, credentials
     ):
-        credentials_mock = CredentialsMock()
-        GoogleCalendarApi('not_used', 'not_used')
+        GoogleCalendarApi(credentials).calendars()
+        GoogleCalendarApi(credentials).calendars()
         build_mock.assert_called_once_with('calendar',
                                            'v3',
-                                           credentials=credentials_mock)
+                                           http=ANY,
+                                           static_discovery=True)
+
+    def test_execute_requests_with_user_credentials(
+            self, build_mock, credentials
+    ):
+        google_api = GoogleCalendarApi(credentials)
+        google_api.calendars()
+        service_mock = build_mock()
+        service_mock.calendarList().list().execute.assert_called_with(
+                http=google_api.http
+        )
 
 
 @pytest.fixture
 def build_mock():
+    def clear_service_cache():
+        timers.google_api.calendar_resource.cache_clear()
+        timers.google_api._calendar_service.cache_clear()
+
+    clear_service_cache()
     with patch.object(timers.google_api, 'build') as build_mock:
+        service_mock = build_mock()
+        service_mock.events().list().execute.return_value = {}
+        service_mock.calendarList().list().execute.return_value = {}
+        build_mock.reset_mock()
         yield build_mock
+    clear_service_cache()
 
 
 @pytest.fixture
-def google_api(CredentialsMock, build_mock):
-    return GoogleCalendarApi('not_used', 'not_used')
+def google_api(credentials, build_mock):
+    return GoogleCalendarApi(credentials)
 
 
 class TestEvents:
@@ -113,13 +123,55 @@ class TestEvents:
                 calendarId=calendar_id,
                 timeMin='2020-04-02T06:05:00Z',
                 timeMax='2020-04-02T13:45:00Z',
-                maxResults=100,
+                maxResults=250,
                 singleEvents=True,
+                fields=EVENTS_FIELDS,
                 orderBy=order_by
         )
 
         service_mock.events().list().execute.assert_called_once()
 
+    def test_returns_the_events_of_all_pages(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.events().list().execute.side_effect = [
+            {'items': [google_event('id1')], 'nextPageToken': 'page2'},
+            {'items': [google_event('id2')]}
+        ]
+
+        unused = None
+        unused_dt = datetime.now(tz=pytz.utc)
+        events = google_api.events(unused, unused_dt, unused_dt, unused)
+
+        assert [e.id for e in events] == ['id1', 'id2']
+        service_mock.events().list.assert_called_with(
+                calendarId=unused,
+                timeMin=ANY,
+                timeMax=ANY,
+                maxResults=250,
+                singleEvents=True,
+                fields=EVENTS_FIELDS,
+                orderBy=unused,
+                pageToken='page2'
+        )
+
+    def test_can_tune_the_page_size(self, test_user, google_api, build_mock):
+        unused = None
+        unused_dt = datetime.now(tz=pytz.utc)
+        google_api.events(unused, unused_dt, unused_dt, unused, page_size=10)
+
+        service_mock = build_mock()
+        service_mock.events().list.assert_called_with(
+                calendarId=unused,
+                timeMin=ANY,
+                timeMax=ANY,
+                maxResults=10,
+                singleEvents=True,
+                fields=EVENTS_FIELDS,
+                orderBy=unused
+        )
+
     def test_raises_if_called_with_naive_datetime(self,
                                                   test_user,
                                                   google_api,
@@ -157,18 +209,18 @@ class TestEvents:
         events = google_api.events(unused, unused_dt, unused_dt, unused)
 
         assert events == [
-            {
-                'id': 'event_id_1234',
-                'name': 'Some Event',
-                'start': datetime(
-                        2021, 12, 24, 19, 30,
-                        tzinfo=pytz.utc
-                ),
-                'end': datetime(
-                        2021, 12, 24, 20, 30,
-                        tzinfo=pytz.utc
-                )
-            }
+            GoogleEvent(
+                    id='event_id_1234',
+                    name='Some Event',
+                    start=datetime(
+                            2021, 12, 24, 19, 30,
+                            tzinfo=pytz.utc
+                    ),
+                    end=datetime(
+                            2021, 12, 24, 20, 30,
+                            tzinfo=pytz.utc
+                    )
+            )
         ]
 
     def test_returns_empty_list_if_no_events(
@@ -194,14 +246,320 @@ class TestEvents:
         pass
 
 
+class TestSyncEvents:
+    def test_full_sync_gets_all_events_in_timeframe(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.events().list().execute.return_value = {
+            'items': [google_event('id1')],
+            'nextSyncToken': 'next_sync_token'
+        }
+        before = datetime(2020, 4, 2, 6, 5, tzinfo=timezone.utc)
+        after = datetime(2020, 4, 2, 13, 45, tzinfo=timezone.utc)
+
+        events = google_api.sync_events('id', before=before, after=after)
+
+        assert [e.id for e in events] == ['id1']
+        assert events.next_sync_token == 'next_sync_token'
+        service_mock.events().list.assert_called_with(
+                calendarId='id',
+                singleEvents=True,
+                fields=EVENTS_FIELDS,
+                timeMin='2020-04-02T06:05:00Z',
+                timeMax='2020-04-02T13:45:00Z',
+                maxResults=250
+        )
+
+    def test_incremental_sync_uses_sync_token(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.events().list().execute.return_value = {
+            'nextSyncToken': 'next_sync_token'
+        }
+
+        list(google_api.sync_events('id', sync_token='sync_token'))
+
+        service_mock.events().list.assert_called_with(
+                calendarId='id',
+                singleEvents=True,
+                fields=EVENTS_FIELDS,
+                syncToken='sync_token',
+                maxResults=250
+        )
+
+    def test_returns_cancelled_events_as_deleted(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.events().list().execute.return_value = {
+            'items': [{'id': 'id1', 'status': 'cancelled'}]
+        }
+
+        events = google_api.sync_events('id', sync_token='sync_token')
+
+        assert list(events) == [GoogleEvent('id1', deleted=True)]
+
+    def test_all_day_events_are_in_the_time_zone_of_their_calendar(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.events().list().execute.return_value = {
+            'timeZone': 'America/New_York',
+            'items': [{'id': 'id1',
+                       'summary': 'Holidays',
+                       'start': {'date': '2021-12-24'},
+                       'end': {'date': '2021-12-26'}}]
+        }
+
+        events = google_api.sync_events('id', sync_token='sync_token')
+
+        [event] = list(events)
+        assert events.time_zone == 'America/New_York'
+        assert event.start == datetime(2021, 12, 24, 5, tzinfo=timezone.utc)
+        assert event.end == datetime(2021, 12, 26, 5, tzinfo=timezone.utc)
+
+    def test_fetches_pages_while_iterating_and_returns_last_sync_token(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        execute_mock = service_mock.events().list().execute
+        execute_mock.side_effect = [
+            {'items': [google_event('id1')], 'nextPageToken': 'page2'},
+            {'items': [google_event('id2')], 'nextSyncToken': 'sync_token'}
+        ]
+
+        paged_events = google_api.sync_events('id',
+                                              sync_token='sync_token',
+                                              page_size=1)
+        events = iter(paged_events)
+
+        assert next(events).id == 'id1'
+        assert execute_mock.call_count == 1
+        assert paged_events.next_sync_token is None
+        assert next(events).id == 'id2'
+        assert execute_mock.call_count == 2
+        assert list(events) == []
+        assert paged_events.next_sync_token == 'sync_token'
+        service_mock.events().list.assert_called_with(
+                calendarId='id',
+                singleEvents=True,
+                fields=EVENTS_FIELDS,
+                syncToken='sync_token',
+                maxResults=1,
+                pageToken='page2'
+        )
+
+    def test_raises_if_sync_token_expired(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.events().list().execute.side_effect = HttpError(
+                httplib2.Response({'status': 410}),
+                b'Sync token is no longer valid'
+        )
+
+        with pytest.raises(SyncTokenExpired):
+            list(google_api.sync_events('id', sync_token='expired_sync_token'))
+
+
+class TestPrefetchFirstPages:
+    def test_fetches_first_pages_in_a_single_batch(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        batch_mock = service_mock.new_batch_http_request()
+        service_mock.reset_mock()
+        paged_events = [google_api.sync_events(f'id{i}', sync_token='token')
+                        for i in range(3)]
+
+        google_api.prefetch_first_pages(paged_events)
+
+        service_mock.new_batch_http_request.assert_called_once_with()
+        assert batch_mock.add.call_count == 3
+        batch_mock.execute.assert_called_once_with(http=google_api.http)
+
+    def test_splits_batches_above_the_api_limit(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        batch_mock = service_mock.new_batch_http_request()
+        service_mock.reset_mock()
+        paged_events = [google_api.sync_events(f'id{i}', sync_token='token')
+                        for i in range(MAX_REQUESTS_PER_BATCH + 1)]
+
+        google_api.prefetch_first_pages(paged_events)
+
+        assert service_mock.new_batch_http_request.call_count == 2
+        assert batch_mock.execute.call_count == 2
+        assert batch_mock.add.call_count == MAX_REQUESTS_PER_BATCH + 1
+
+    def test_fetches_first_pages_one_by_one_if_the_batch_fails(
+            self, fake_google_api
+    ):
+        fake_google_api.batch_status = 500
+        calendar_api = fake_google_api.calendar_api()
+        paged_events = [calendar_api.sync_events(f'cal{i}', sync_token='token')
+                        for i in range(3)]
+
+        calendar_api.prefetch_first_pages(paged_events)
+
+        assert [len(list(events)) for events in paged_events] == [20, 20, 20]
+        # The batch, then one request per calendar
+        assert fake_google_api.http_requests == 4
+
+    def test_does_not_use_a_batch_for_a_single_calendar(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.reset_mock()
+
+        google_api.prefetch_first_pages(
+                [google_api.sync_events('id', sync_token='token')]
+        )
+
+        service_mock.new_batch_http_request.assert_not_called()
+
+    def test_uses_prefetched_pages_and_isolates_errors(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        batch_mock = service_mock.new_batch_http_request()
+        sync_token_expired = HttpError(httplib2.Response({'status': 410}),
+                                       b'Sync token is no longer valid')
+
+        def execute_batch(http):
+            callbacks = [c.kwargs['callback']
+                         for c in batch_mock.add.call_args_list]
+            callbacks[0]('1', {'items': [google_event('id1')]}, None)
+            callbacks[1]('2', None, sync_token_expired)
+
+        batch_mock.execute.side_effect = execute_batch
+        execute_mock = service_mock.events().list().execute
+        execute_mock.reset_mock()
+        events_cal1 = google_api.sync_events('cal1', sync_token='token')
+        events_cal2 = google_api.sync_events('cal2', sync_token='token')
+
+        google_api.prefetch_first_pages([events_cal1, events_cal2])
+
+        assert [e.id for e in events_cal1] == ['id1']
+        with pytest.raises(SyncTokenExpired):
+            list(events_cal2)
+        execute_mock.assert_not_called()
+
+
+class TestPrefetchFirstPage:
+    def test_fetches_first_page_right_away(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        execute_mock = service_mock.events().list().execute
+        execute_mock.return_value = {'items': [google_event('id1')]}
+        execute_mock.reset_mock()
+        events = google_api.sync_events('id', sync_token='token')
+
+        google_api.prefetch_first_page(events)
+
+        execute_mock.assert_called_once_with(http=google_api.http)
+        assert [e.id for e in events] == ['id1']
+        execute_mock.assert_called_once()
+
+    def test_raises_error_when_iterating(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.events().list().execute.side_effect = HttpError(
+                httplib2.Response({'status': 410}),
+                b'Sync token is no longer valid'
+        )
+        events = google_api.sync_events('id', sync_token='token')
+
+        google_api.prefetch_first_page(events)
+
+        with pytest.raises(SyncTokenExpired):
+            list(events)
+
+    def test_raises_transport_error_when_iterating(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.events().list().execute.side_effect = \
+            socket.timeout('timed out')
+        events = google_api.sync_events('id', sync_token='token')
+
+        google_api.prefetch_first_page(events)
+
+        with pytest.raises(socket.timeout):
+            list(events)
+
+
+class TestSyncCalendars:
+    def test_full_sync_gets_all_calendars(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.calendarList().list().execute.return_value = {
+            'items': [{'id': 'id1', 'summary': 'cal1'}],
+            'nextSyncToken': 'next_sync_token'
+        }
+
+        calendars, next_sync_token = google_api.sync_calendars()
+
+        service_mock.calendarList().list.assert_called_with(
+                fields=CALENDARS_FIELDS,
+                maxResults=250
+        )
+        assert calendars == [{'id': 'id1', 'name': 'cal1'}]
+        assert next_sync_token == 'next_sync_token'
+
+    def test_incremental_sync_uses_sync_token(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.calendarList().list().execute.return_value = {
+            'items': [{'id': 'id1', 'deleted': True}],
+        }
+
+        calendars, _ = google_api.sync_calendars(sync_token='sync_token')
+
+        service_mock.calendarList().list.assert_called_with(
+                fields=CALENDARS_FIELDS,
+                syncToken='sync_token',
+                maxResults=250
+        )
+        assert calendars == [{'id': 'id1', 'deleted': True}]
+
+    def test_raises_if_sync_token_expired(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.calendarList().list().execute.side_effect = HttpError(
+                httplib2.Response({'status': 410}),
+                b'Sync token is no longer valid'
+        )
+
+        with pytest.raises(SyncTokenExpired):
+            google_api.sync_calendars(sync_token='expired_sync_token')
+
+
+def google_event(event_id):
+    return {'id': event_id,
+            'summary': 'Some Event',
+            'start': {'dateTime': '2021-12-24T19:30:00Z'},
+            'end': {'dateTime': '2021-12-24T20:30:00Z'}}
+
+
 class TestCalendars:
-    def test_call_endpoint_with_no_parameters(
+    def test_call_endpoint_with_only_the_fields_mask(
             self, test_user, google_api, build_mock
     ):
         google_api.calendars()
 
         service_mock = build_mock()
-        service_mock.calendarList().list.assert_called_once_with()
+        service_mock.calendarList().list.assert_called_once_with(
+                fields=CALENDARS_FIELDS
+        )
         service_mock.calendarList().list().execute.assert_called_once()
 
     def test_returns_the_calendars(self, test_user, google_api, build_mock):
@@ -243,3 +601,113 @@ class TestCalendars:
         # - querying the service
         # Not sure if it can happen in all scenarios, but definitely in some
         pass
+
+
+class TestWatchEvents:
+    def test_call_endpoint_with_correct_parameters(
+            self, test_user, google_api, build_mock
+    ):
+        service_mock = build_mock()
+        service_mock.events().watch().execute.return_value = {
+            'id': 'channel_id', 'resourceId': 'resource_id',
+            'expiration': '1640374200000'
+        }
+        service_mock.events().watch.reset_mock()
+
+        google_api.watch_events('calendar_id',
+                                channel_id='channel_id',
+                                token='token',
+                                address='https://example.com/notifications/',
+                                ttl=timedelta(hours=1))
+
+        service_mock.events().watch.assert_called_once_with(
+                calendarId='calendar_id',
+                body={'id': 'channel_id',
+                      'type': 'web_hook',
+                      'address': 'https://example.com/notifications/',
+                      'token': 'token',
+                      'params': {'ttl': '3600'}},
+                fields='id,resourceId,expiration'
+        )
+        service_mock.events().watch().execute.assert_called_once_with(
+                http=google_api.http
+        )
+
+    def test_returns_the_channel(self, test_user, google_api, build_mock):
+        service_mock = build_mock()
+        service_mock.events().watch().execute.return_value = {
+            'kind': 'api#channel',
+            'id': 'channel_id',
+            'resourceId': 'resource_id',
+            'resourceUri': 'not_used',
+            'expiration': '1640374200000'
+        }
+
+        channel = google_api.watch_events('calendar_id',
+                                          channel_id='channel_id',
+                                          token='token',
+                                          address='not_used',
+                                          ttl=timedelta(hours=1))
+
+        assert channel == {
+            'id': 'channel_id',
+            'resource_id': 'resource_id',
+            'expires_at': datetime(2021, 12, 24, 19, 30, tzinfo=timezone.utc)
+        }
+
+
+class TestStopChannel:
+    def test_call_endpoint_with_correct_parameters(
+            self, test_user, google_api, build_mock
+    ):
+        google_api.stop_channel('channel_id', 'resource_id')
+
+        service_mock = build_mock()
+        service_mock.channels().stop.assert_called_once_with(
+                body={'id': 'channel_id', 'resourceId': 'resource_id'}
+        )
+        service_mock.channels().stop().execute.assert_called_once_with(
+                http=google_api.http
+        )
+
+
+class TestPartialResponses:
+    def test_events_are_mapped_from_the_fields_of_the_mask_only(self):
+        page = json.loads(EVENTS_LIST.read_text())
+
+        masked_page = apply_fields_mask(page, EVENTS_FIELDS)
+
+        map_event = GoogleCalendarApi._map_event_to_domain
+        assert [map_event(e) for e in masked_page['items']] \
+               == [map_event(e) for e in page['items']]
+        assert masked_page['nextSyncToken'] == page['nextSyncToken']
+
+    def test_calendars_are_mapped_from_the_fields_of_the_mask_only(self):
+        calendar = {'kind': 'calendar#calendarListEntry',
+                    'etag': '"1639934531418000"',
+                    'id': 'team@example.com',
+                    'summary': 'Team',
+                    'timeZone': 'Europe/Paris',
+                    'colorId': '14',
+                    'accessRole': 'owner',
+                    'defaultReminders': [{'method': 'popup', 'minutes': 10}]}
+
+        masked_page = apply_fields_mask({'items': [calendar]},
+                                        CALENDARS_FIELDS)
+
+        assert GoogleCalendarApi._map_calendar_to_domain(
+                masked_page['items'][0]
+        ) == GoogleCalendarApi._map_calendar_to_domain(calendar)
+
+    def test_requests_partial_gzip_encoded_responses(self, fake_google_api):
+        fake_google_api.events_per_calendar = 1
+        calendar_api = fake_google_api.calendar_api()
+
+        events = list(calendar_api.sync_events('cal1', sync_token='token'))
+
+        assert [e.id for e in events] == ['cal1-0']
+        assert fake_google_api.received_params[0]['fields'] == EVENTS_FIELDS
+        headers = fake_google_api.received_headers[0]
+        assert 'gzip' in headers['accept-encoding']
+        # Otherwise Google doesn't compress the responses
+        assert '(gzip)' in headers['user-agent']
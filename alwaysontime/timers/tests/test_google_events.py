@@ -0,0 +1,121 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import dateutil.parser
+import pytest
+from django.utils.timezone import get_default_timezone
+
+from timers.google_events import GoogleEvent, decode_event, parse_datetime
+from timers.tests.fake_google_api import EVENTS_LIST
+
+
+class TestDecodeEvent:
+    def test_decodes_events(self):
+        event = decode_event({
+            'id': 'id1',
+            'status': 'confirmed',
+            'summary': 'Some Event',
+            'start': {'dateTime': '2021-12-24T19:30:00Z'},
+            'end': {'dateTime': '2021-12-24T21:30:00+01:00'}
+        })
+
+        assert event == GoogleEvent(
+                id='id1',
+                name='Some Event',
+                start=datetime(2021, 12, 24, 19, 30, tzinfo=timezone.utc),
+                end=datetime(2021, 12, 24, 20, 30, tzinfo=timezone.utc)
+        )
+        assert not event.deleted
+        assert not event.all_day
+
+    def test_decodes_cancelled_events_as_deleted(self):
+        event = decode_event({'id': 'id1', 'status': 'cancelled'})
+
+        assert event == GoogleEvent('id1', deleted=True)
+
+    def test_decodes_all_day_events_from_midnight_to_midnight(
+            self, settings
+    ):
+        settings.TIME_ZONE = 'Europe/Paris'
+
+        event = decode_event({'id': 'id1',
+                              'summary': 'Holidays',
+                              'start': {'date': '2021-12-24'},
+                              'end': {'date': '2021-12-26'}})
+
+        paris = get_default_timezone()
+        assert event.start == datetime(2021, 12, 24, tzinfo=paris)
+        assert event.end == datetime(2021, 12, 26, tzinfo=paris)
+        assert event.all_day
+
+    def test_decodes_all_day_events_in_the_time_zone_of_their_calendar(
+            self, settings
+    ):
+        settings.TIME_ZONE = 'Europe/Paris'
+
+        event = decode_event({'id': 'id1',
+                              'summary': 'Holidays',
+                              'start': {'date': '2021-12-24'},
+                              'end': {'date': '2021-12-26'}},
+                             'America/New_York')
+
+        assert event.start == datetime(2021, 12, 24, 5, tzinfo=timezone.utc)
+        assert event.end == datetime(2021, 12, 26, 5, tzinfo=timezone.utc)
+
+    def test_decodes_all_day_events_of_unknown_time_zone_in_the_settings_one(
+            self, settings
+    ):
+        settings.TIME_ZONE = 'Europe/Paris'
+
+        event = decode_event({'id': 'id1',
+                              'summary': 'Holidays',
+                              'start': {'date': '2021-12-24'},
+                              'end': {'date': '2021-12-26'}},
+                             'Not/A_Time_Zone')
+
+        assert event.start == datetime(2021, 12, 24,
+                                       tzinfo=get_default_timezone())
+
+    def test_decodes_untitled_events(self):
+        event = decode_event({'id': 'id1',
+                              'start': {'dateTime': '2021-12-24T19:30:00Z'},
+                              'end': {'dateTime': '2021-12-24T20:30:00Z'}})
+
+        assert event.name == ''
+
+    def test_decodes_like_dateutil(self):
+        page = json.loads(EVENTS_LIST.read_text())
+
+        for item in page['items']:
+            event = decode_event(item)
+            assert event.start == \
+                   dateutil.parser.isoparse(item['start']['dateTime'])
+            assert event.end == \
+                   dateutil.parser.isoparse(item['end']['dateTime'])
+
+
+class TestParseDatetime:
+    @pytest.mark.parametrize('value, expected', [
+        ('2021-12-24T19:30:00Z',
+         datetime(2021, 12, 24, 19, 30, tzinfo=timezone.utc)),
+        ('2021-12-24T19:30:00.123Z',
+         datetime(2021, 12, 24, 19, 30, 0, 123000, tzinfo=timezone.utc)),
+        ('2021-12-24T19:30:00-08:00',
+         datetime(2021, 12, 25, 3, 30, tzinfo=timezone.utc)),
+        ('2021-12-24T19:30:00+05:45',
+         datetime(2021, 12, 24, 13, 45, tzinfo=timezone.utc)),
+        # Not parsed by `datetime.fromisoformat` before Python 3.11
+        ('2021-12-24T19:30:00.1Z',
+         datetime(2021, 12, 24, 19, 30, 0, 100000, tzinfo=timezone.utc)),
+        ('2021-12-24t19:30:00z',
+         datetime(2021, 12, 24, 19, 30, tzinfo=timezone.utc)),
+    ])
+    def test_parses_rfc_3339_date_times(self, value, expected):
+        assert parse_datetime(value) == expected
+
+    def test_date_times_share_the_time_zone_of_their_offset(self):
+        first = parse_datetime('2021-12-24T19:30:00+01:00')
+        second = parse_datetime('2021-12-25T08:00:00+01:00')
+
+        assert first.tzinfo is second.tzinfo
+        assert first.utcoffset() == timedelta(hours=1)
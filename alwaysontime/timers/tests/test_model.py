@@ -4,11 +4,19 @@ import pytest
 from django.db import IntegrityError, transaction
 from django.utils.timezone import now
 
+from conftest import only_on_sqlite
 from timers.models import Calendar, Event
+from timers.dashboard import events_to_show
 
 pytestmark = pytest.mark.django_db
 
 
+def is_unique_violation(error):
+    # Worded by SQLite, or by PostgreSQL
+    return 'UNIQUE constraint failed' in str(error) \
+           or 'violates unique constraint' in str(error)
+
+
 class TestCalendar:
     def test_can_not_save_2_calendars_with_same_google_id_for_same_user(
             self, test_user
@@ -23,7 +31,7 @@ class TestCalendar:
                                              " 'google_id'",
                                         user=test_user)
 
-        assert 'UNIQUE constraint failed' in str(e.value)
+        assert is_unique_violation(e.value)
         assert Calendar.objects.count() == 1
 
     def test_can_save_2_calendars_with_same_google_id_for_different_users(
@@ -61,7 +69,7 @@ class TestEvent:
                                      end=end,
                                      calendar=test_user_calendar)
 
-        assert 'UNIQUE constraint failed' in str(e.value)
+        assert is_unique_violation(e.value)
         assert Event.objects.count() == 1
 
     def test_can_save_2_events_with_same_google_id_for_different_calendars(
@@ -83,3 +91,27 @@ class TestEvent:
                              calendar=another_user_calendar)
 
         assert Event.objects.count() == 2
+
+    def test_copies_user_and_active_of_its_calendar(self, test_user_calendar):
+        start = now()
+        event = Event.objects.create(google_id='id',
+                                     name='event',
+                                     start=start,
+                                     end=start + timedelta(hours=1),
+                                     calendar=test_user_calendar)
+
+        assert event.user_id == test_user_calendar.user_id
+        assert event.active == test_user_calendar.active
+
+    @only_on_sqlite
+    def test_events_to_show_do_not_need_a_full_scan_or_a_sort(
+            self, test_user
+    ):
+        start = now()
+        query_plan = events_to_show(test_user,
+                                    start,
+                                    start + timedelta(hours=1)).explain()
+
+        assert 'USING INDEX event_active_user_start' in query_plan
+        assert 'SCAN' not in query_plan
+        assert 'TEMP B-TREE' not in query_plan
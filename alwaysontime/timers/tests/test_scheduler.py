@@ -0,0 +1,321 @@
+import threading
+from datetime import timedelta
+from unittest.mock import patch, call, ANY
+
+import pytest
+from django.core.management import call_command
+from django.db import connection, transaction, OperationalError
+from django.utils import timezone
+
+import timers.scheduler as scheduler
+from conftest import only_on_postgresql, create_calendar
+from timers import leases
+from timers.models import Calendar, UserSyncState
+from timers.scheduler import SyncScheduler
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def refresh_events_mock():
+    with patch.object(scheduler, 'refresh_events') as refresh_events_mock:
+        yield refresh_events_mock
+
+
+@pytest.fixture
+def refresh_calendars_mock():
+    with patch.object(scheduler, 'refresh_calendars') as mock:
+        yield mock
+
+
+@pytest.fixture
+def sync_scheduler(refresh_events_mock, refresh_calendars_mock):
+    return SyncScheduler(owner='test_scheduler')
+
+
+class TestRunDueSyncs:
+    def test_refreshes_events_of_all_active_calendars_of_a_user_at_once(
+            self, sync_scheduler, refresh_events_mock, test_user
+    ):
+        cal1 = create_calendar(test_user, 'cal1')
+        cal2 = create_calendar(test_user, 'cal2')
+        create_calendar(test_user, 'inactive', active=False)
+
+        sync_scheduler.run_due_syncs()
+
+        refresh_events_mock.assert_called_once_with(test_user, ANY, force=True)
+        assert set(refresh_events_mock.call_args.args[1]) == {cal1, cal2}
+
+    def test_refreshes_events_of_every_user_separately(
+            self, sync_scheduler, refresh_events_mock, test_user,
+            another_user
+    ):
+        create_calendar(test_user, 'cal1')
+        create_calendar(another_user, 'cal2')
+
+        sync_scheduler.run_due_syncs()
+
+        refresh_events_mock.assert_has_calls(
+                [call(test_user, ANY, force=True),
+                 call(another_user, ANY, force=True)],
+                any_order=True
+        )
+
+    def test_refreshes_calendar_list_of_users_with_google_account(
+            self, sync_scheduler, refresh_calendars_mock, test_user,
+            another_user
+    ):
+        sync_scheduler.run_due_syncs()
+
+        refresh_calendars_mock.assert_called_once_with(test_user, force=True)
+
+    def test_does_not_refresh_calendars_not_due_yet(
+            self, sync_scheduler, refresh_events_mock, test_user
+    ):
+        create_calendar(test_user,
+                        'cal1',
+                        next_sync_at=timezone.now() + timedelta(minutes=1))
+
+        sync_scheduler.run_due_syncs()
+
+        refresh_events_mock.assert_not_called()
+
+    def test_schedules_next_sync_and_releases_lease(
+            self, sync_scheduler, test_user, settings
+    ):
+        settings.TIMERS_SCHEDULER_EVENTS_INTERVAL_SECONDS = 60
+        cal = create_calendar(test_user, 'cal1')
+        before = timezone.now()
+
+        sync_scheduler.run_due_syncs()
+
+        cal.refresh_from_db()
+        assert cal.next_sync_at >= before + timedelta(seconds=60)
+        assert cal.lease_owner is None
+        assert cal.lease_expires_at is None
+
+    def test_does_not_refresh_again_before_next_sync_is_due(
+            self, sync_scheduler, refresh_events_mock, test_user
+    ):
+        create_calendar(test_user, 'cal1')
+
+        assert sync_scheduler.run_due_syncs() == 2
+        assert sync_scheduler.run_due_syncs() == 0
+
+        refresh_events_mock.assert_called_once()
+
+    def test_skips_calendars_leased_by_another_scheduler(
+            self, sync_scheduler, refresh_events_mock, test_user
+    ):
+        create_calendar(
+                test_user,
+                'cal1',
+                lease_owner='another_scheduler',
+                lease_expires_at=timezone.now() + timedelta(minutes=1)
+        )
+
+        sync_scheduler.run_due_syncs()
+
+        refresh_events_mock.assert_not_called()
+        assert Calendar.objects.get().lease_owner == 'another_scheduler'
+
+    @only_on_postgresql
+    @pytest.mark.django_db(transaction=True)
+    def test_skips_calendars_being_claimed_by_another_scheduler(
+            self, test_user
+    ):
+        cal1 = create_calendar(test_user, 'cal1')
+        create_calendar(test_user, 'cal2')
+        claiming = threading.Event()
+        claimed = threading.Event()
+
+        def claim_cal1_slowly():
+            try:
+                with transaction.atomic():
+                    Calendar.objects.select_for_update().get(id=cal1.id)
+                    claiming.set()
+                    claimed.wait(timeout=5)
+            finally:
+                connection.close()
+
+        other_scheduler = threading.Thread(target=claim_cal1_slowly)
+        other_scheduler.start()
+        claiming.wait(timeout=5)
+
+        # Doesn't wait for the other scheduler
+        calendars = leases.claim(Calendar.objects.all(), 'test_scheduler')
+        claimed.set()
+        other_scheduler.join()
+
+        assert [c.google_id for c in calendars] == ['cal2']
+
+    def test_takes_over_expired_lease(
+            self, sync_scheduler, refresh_events_mock, test_user
+    ):
+        create_calendar(
+                test_user,
+                'cal1',
+                lease_owner='dead_scheduler',
+                lease_expires_at=timezone.now() - timedelta(minutes=1)
+        )
+
+        sync_scheduler.run_due_syncs()
+
+        refresh_events_mock.assert_called_once()
+        assert Calendar.objects.get().lease_owner is None
+
+    def test_schedulers_share_the_work(
+            self, refresh_events_mock, refresh_calendars_mock, test_user
+    ):
+        create_calendar(test_user, 'cal1')
+        scheduler1 = SyncScheduler(owner='scheduler1')
+        scheduler2 = SyncScheduler(owner='scheduler2')
+        scheduler1._load_queue(timezone.now())
+        scheduler2._load_queue(timezone.now())
+
+        assert scheduler1.run_due_syncs() + scheduler2.run_due_syncs() == 2
+
+        refresh_events_mock.assert_called_once()
+        refresh_calendars_mock.assert_called_once()
+
+    def test_retries_failed_sync_later_without_stopping(
+            self, sync_scheduler, refresh_events_mock, refresh_calendars_mock,
+            test_user, settings
+    ):
+        settings.TIMERS_SCHEDULER_RETRY_SECONDS = 5 * 60
+        refresh_calendars_mock.side_effect = Exception('Token revoked')
+        create_calendar(test_user, 'cal1')
+        before = timezone.now()
+
+        sync_scheduler.run_due_syncs()
+
+        refresh_events_mock.assert_called_once()
+        sync_state = UserSyncState.objects.get(user=test_user)
+        assert sync_state.next_sync_at >= before + timedelta(minutes=5)
+        assert sync_state.lease_owner is None
+
+    def test_syncs_watched_calendars_less_often(
+            self, sync_scheduler, test_user, settings
+    ):
+        settings.TIMERS_SCHEDULER_EVENTS_INTERVAL_SECONDS = 60
+        settings.TIMERS_SCHEDULER_WATCHED_EVENTS_INTERVAL_SECONDS = 60 * 60
+        watched = create_calendar(
+                test_user,
+                'watched',
+                channel_id='channel_id',
+                channel_expires_at=timezone.now() + timedelta(days=1)
+        )
+        polled = create_calendar(test_user, 'polled')
+        before = timezone.now()
+
+        sync_scheduler.run_due_syncs()
+
+        watched.refresh_from_db()
+        polled.refresh_from_db()
+        assert watched.next_sync_at >= before + timedelta(hours=1)
+        assert polled.next_sync_at < before + timedelta(hours=1)
+
+    def test_keeps_sync_requested_by_google_during_a_sync(
+            self, sync_scheduler, refresh_events_mock, test_user
+    ):
+        cal = create_calendar(test_user, 'cal1')
+        notified_at = timezone.now()
+
+        def notification_from_google(*_, **__):
+            Calendar.objects.filter(id=cal.id).update(next_sync_at=notified_at)
+
+        refresh_events_mock.side_effect = notification_from_google
+
+        sync_scheduler.run_due_syncs()
+
+        cal.refresh_from_db()
+        assert cal.next_sync_at == notified_at
+        assert cal.lease_owner is None
+
+    def test_renews_watch_channels_when_reloading_schedule(
+            self, sync_scheduler
+    ):
+        with patch.object(scheduler, 'renew_channels') as renew_channels_mock:
+            sync_scheduler.run_due_syncs()
+        renew_channels_mock.assert_called_once()
+
+    def test_syncs_even_if_renewing_watch_channels_fails(
+            self, sync_scheduler, refresh_events_mock, test_user
+    ):
+        create_calendar(test_user, 'cal1')
+
+        with patch.object(scheduler,
+                          'renew_channels',
+                          side_effect=OperationalError('database is locked')):
+            sync_scheduler.run_due_syncs()
+
+        refresh_events_mock.assert_called_once()
+
+    def test_picks_up_calendars_activated_since_last_poll(
+            self, sync_scheduler, refresh_events_mock, test_user, settings
+    ):
+        settings.TIMERS_SCHEDULER_POLL_SECONDS = 0
+        sync_scheduler.run_due_syncs()
+        refresh_events_mock.assert_not_called()
+
+        create_calendar(test_user, 'cal1')
+        sync_scheduler.run_due_syncs()
+
+        refresh_events_mock.assert_called_once()
+
+
+class TestRunForever:
+    @patch.object(scheduler, 'close_old_connections')
+    def test_keeps_running_after_an_error(self, _, sync_scheduler, settings):
+        settings.TIMERS_SCHEDULER_POLL_SECONDS = 0
+        runs = []
+
+        def run_due_syncs():
+            runs.append(1)
+            if len(runs) == 1:
+                raise OperationalError('database is locked')
+            sync_scheduler.stop()
+            return 0
+
+        with patch.object(sync_scheduler, 'run_due_syncs', run_due_syncs), \
+                patch.object(sync_scheduler,
+                             '_seconds_until_next_sync',
+                             return_value=0):
+            sync_scheduler.run_forever()
+
+        assert len(runs) == 2
+
+
+class TestSecondsUntilNextSync:
+    def test_wakes_up_for_next_due_sync(
+            self, sync_scheduler, test_user, settings
+    ):
+        settings.TIMERS_SCHEDULER_POLL_SECONDS = 60
+        create_calendar(test_user,
+                        'cal1',
+                        next_sync_at=timezone.now() + timedelta(seconds=10))
+        UserSyncState.objects.create(
+                user=test_user,
+                next_sync_at=timezone.now() + timedelta(seconds=20)
+        )
+        sync_scheduler.run_due_syncs()
+
+        assert 9 < sync_scheduler._seconds_until_next_sync() <= 10
+
+    def test_wakes_up_for_next_poll(self, sync_scheduler, settings):
+        settings.TIMERS_SCHEDULER_POLL_SECONDS = 30
+        sync_scheduler.run_due_syncs()
+
+        assert 29 < sync_scheduler._seconds_until_next_sync() <= 30
+
+
+def test_command_can_run_due_syncs_once(
+        refresh_events_mock, refresh_calendars_mock, test_user, capsys
+):
+    create_calendar(test_user, 'cal1')
+
+    call_command('run_sync_scheduler', '--once')
+
+    refresh_events_mock.assert_called_once()
+    refresh_calendars_mock.assert_called_once_with(test_user, force=True)
+    assert 'Synced 2' in capsys.readouterr().out
@@ -0,0 +1,260 @@
+import threading
+from datetime import timedelta
+from unittest.mock import patch, Mock
+
+import pytest
+from django.utils import timezone
+
+import timers.singleflight as singleflight
+from conftest import create_calendar
+from timers.models import Calendar, UserSyncState
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def refresh_events_mock():
+    with patch.object(singleflight, 'refresh_events') as refresh_events_mock:
+        yield refresh_events_mock
+
+
+@pytest.fixture
+def refresh_calendars_mock():
+    with patch.object(singleflight, 'refresh_calendars') as mock:
+        yield mock
+
+
+def leased_by_another_process(expires_in=timedelta(minutes=1)):
+    return {'lease_owner': 'another_process',
+            'lease_expires_at': timezone.now() + expires_in}
+
+
+def run_in_thread(func):
+    result = {}
+
+    def run():
+        try:
+            result['value'] = func()
+        except Exception as error:
+            result['error'] = error
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, result
+
+
+class TestRunOnce:
+    def test_concurrent_calls_wait_for_the_running_one(self):
+        started = threading.Event()
+        finish = threading.Event()
+
+        def refresh():
+            started.set()
+            finish.wait()
+            return 'result'
+
+        func = Mock(side_effect=refresh)
+        leader, leader_result = run_in_thread(
+                lambda: singleflight.run_once('key', func)
+        )
+        started.wait()
+        follower, follower_result = run_in_thread(
+                lambda: singleflight.run_once('key', func)
+        )
+        while singleflight.counters()['coalesced_in_process'] == 0:
+            pass
+        finish.set()
+        leader.join()
+        follower.join()
+
+        func.assert_called_once()
+        assert leader_result['value'] == 'result'
+        assert follower_result['value'] == 'result'
+
+    def test_concurrent_calls_get_the_error_of_the_running_one(self):
+        started = threading.Event()
+        finish = threading.Event()
+
+        def refresh():
+            started.set()
+            finish.wait()
+            raise ValueError('Boom')
+
+        leader, leader_result = run_in_thread(
+                lambda: singleflight.run_once('key', refresh)
+        )
+        started.wait()
+        follower, follower_result = run_in_thread(
+                lambda: singleflight.run_once('key', refresh)
+        )
+        while singleflight.counters()['coalesced_in_process'] == 0:
+            pass
+        finish.set()
+        leader.join()
+        follower.join()
+
+        assert isinstance(leader_result['error'], ValueError)
+        assert follower_result['error'] is leader_result['error']
+
+    def test_runs_again_once_finished(self):
+        func = Mock(return_value='result')
+
+        singleflight.run_once('key', func)
+        singleflight.run_once('key', func)
+
+        assert func.call_count == 2
+        assert singleflight.counters()['coalesced_in_process'] == 0
+
+    def test_calls_with_different_keys_run_concurrently(self):
+        other_key_ran = threading.Event()
+
+        def refresh():
+            thread, _ = run_in_thread(lambda: singleflight.run_once(
+                    'other_key', other_key_ran.set
+            ))
+            thread.join()
+
+        singleflight.run_once('key', refresh)
+
+        assert other_key_ran.is_set()
+
+
+class TestRefreshEventsOnce:
+    def test_refreshes_active_calendars_under_lease(
+            self, refresh_events_mock, test_user
+    ):
+        cal = create_calendar(test_user, 'cal1')
+
+        def refresh_events(user, calendars, force):
+            assert Calendar.objects.get(id=cal.id).lease_owner is not None
+
+        refresh_events_mock.side_effect = refresh_events
+
+        singleflight.refresh_events_once(test_user)
+
+        refresh_events_mock.assert_called_once_with(test_user,
+                                                    [cal],
+                                                    force=False)
+        assert Calendar.objects.get(id=cal.id).lease_owner is None
+        assert singleflight.counters()['started'] == 1
+
+    def test_releases_leases_if_refresh_fails(
+            self, refresh_events_mock, test_user
+    ):
+        refresh_events_mock.side_effect = Exception('Boom')
+        cal = create_calendar(test_user, 'cal1')
+
+        with pytest.raises(Exception):
+            singleflight.refresh_events_once(test_user)
+
+        assert Calendar.objects.get(id=cal.id).lease_owner is None
+
+    def test_waits_for_calendars_refreshed_by_another_process(
+            self, refresh_events_mock, test_user, settings
+    ):
+        settings.TIMERS_SYNC_LEASE_POLL_SECONDS = 0.01
+        free = create_calendar(test_user, 'free')
+        create_calendar(
+                test_user,
+                'leased',
+                **leased_by_another_process(timedelta(milliseconds=100))
+        )
+
+        singleflight.refresh_events_once(test_user)
+
+        refresh_events_mock.assert_called_once_with(test_user,
+                                                    [free],
+                                                    force=False)
+        assert singleflight.counters()['coalesced_across_processes'] == 1
+
+    def test_does_not_wait_for_calendars_nobody_holds_the_lease_of(
+            self, refresh_events_mock, test_user
+    ):
+        create_calendar(test_user, 'free')
+        leased = create_calendar(test_user,
+                                 'leased',
+                                 **leased_by_another_process())
+
+        def refresh_events(user, calendars, force):
+            # The other process is done in the meantime
+            Calendar.objects \
+                .filter(id=leased.id) \
+                .update(lease_owner=None, lease_expires_at=None)
+
+        refresh_events_mock.side_effect = refresh_events
+
+        singleflight.refresh_events_once(test_user)
+
+        assert singleflight.counters()['coalesced_across_processes'] == 0
+
+    def test_gives_up_waiting_after_timeout(
+            self, refresh_events_mock, test_user, settings
+    ):
+        settings.TIMERS_SINGLE_FLIGHT_TIMEOUT_SECONDS = 0
+        create_calendar(test_user, 'leased', **leased_by_another_process())
+
+        singleflight.refresh_events_once(test_user)
+
+        refresh_events_mock.assert_not_called()
+
+    def test_does_not_take_leases_when_all_calendars_are_fresh(
+            self, refresh_events_mock, test_user
+    ):
+        create_calendar(test_user, 'cal1', last_synced_at=timezone.now())
+
+        assert singleflight.refresh_events_once(test_user) == 0
+
+        refresh_events_mock.assert_not_called()
+        assert singleflight.counters()['started'] == 0
+
+    def test_refreshes_fresh_calendars_when_forced(
+            self, refresh_events_mock, test_user
+    ):
+        cal = create_calendar(test_user, 'cal1', last_synced_at=timezone.now())
+
+        singleflight.refresh_events_once(test_user, force=True)
+
+        refresh_events_mock.assert_called_once_with(test_user,
+                                                    [cal],
+                                                    force=True)
+
+
+class TestRefreshCalendarsOnce:
+    def test_refreshes_calendar_list_under_lease(
+            self, refresh_calendars_mock, test_user
+    ):
+        def refresh_calendars(user, force):
+            assert UserSyncState.objects.get().lease_owner is not None
+
+        refresh_calendars_mock.side_effect = refresh_calendars
+
+        singleflight.refresh_calendars_once(test_user)
+
+        refresh_calendars_mock.assert_called_once_with(test_user,
+                                                       force=False)
+        assert UserSyncState.objects.get().lease_owner is None
+
+    def test_waits_for_refresh_of_another_process(
+            self, refresh_calendars_mock, test_user, settings
+    ):
+        settings.TIMERS_SINGLE_FLIGHT_TIMEOUT_SECONDS = 0
+        UserSyncState.objects.create(user=test_user,
+                                     **leased_by_another_process())
+
+        singleflight.refresh_calendars_once(test_user)
+
+        refresh_calendars_mock.assert_not_called()
+        assert singleflight.counters()['coalesced_across_processes'] == 1
+
+    def test_does_not_wait_for_an_expired_lease_of_another_process(
+            self, refresh_calendars_mock, test_user
+    ):
+        UserSyncState.objects.create(
+                user=test_user,
+                **leased_by_another_process(timedelta(minutes=-1))
+        )
+
+        with patch.object(singleflight.leases, 'claim', return_value=[]):
+            singleflight.refresh_calendars_once(test_user)
+
+        assert singleflight.counters()['coalesced_across_processes'] == 0
@@ -0,0 +1,252 @@
+import json
+from datetime import timedelta
+from unittest.mock import patch, AsyncMock
+
+import pytest
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings as django_settings
+from django.utils import timezone
+
+import timers.brokers as brokers
+import timers.streams as streams
+from timers.dashboard import bump_data_version
+from timers.models import Event, UserSyncState
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture(autouse=True)
+def fresh_broker():
+    brokers.broker.cache_clear()
+    yield
+    brokers.broker.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def no_connection_closing():
+    # Would close the connection of the test, in the middle of its transaction
+    with patch.object(streams, 'close_old_connections'):
+        yield
+
+
+@pytest.fixture
+def django_application():
+    return AsyncMock()
+
+
+@pytest.fixture
+def application(django_application):
+    return streams.with_event_streams(django_application)
+
+
+@pytest.fixture
+def session_key(client, logged_in_test_user):
+    UserSyncState.objects.create(user=logged_in_test_user)
+    return client.cookies[django_settings.SESSION_COOKIE_NAME].value
+
+
+def run(scenario):
+    async_to_sync(scenario)()
+
+
+async def open_stream(application, session_key=None, path='/events/stream/'):
+    headers = []
+    if session_key:
+        headers.append((
+            b'cookie',
+            f'{django_settings.SESSION_COOKIE_NAME}={session_key}'.encode()
+        ))
+    stream = ApplicationCommunicator(application, {'type': 'http',
+                                                   'method': 'GET',
+                                                   'path': path,
+                                                   'headers': headers})
+    await stream.send_input({'type': 'http.request'})
+    return stream
+
+
+async def next_body(stream):
+    return (await stream.receive_output(timeout=2))['body'].decode()
+
+
+async def next_events(stream):
+    body = await next_body(stream)
+    assert body.startswith('data: ')
+    return json.loads(body[len('data: '):])['events']
+
+
+async def close(stream):
+    await stream.send_input({'type': 'http.disconnect'})
+    await stream.wait(timeout=2)
+
+
+class TestEventsStream:
+    def test_returns_error_if_user_not_logged_in(self, application):
+        async def scenario():
+            stream = await open_stream(application)
+            start = await stream.receive_output(timeout=2)
+            assert start['status'] == 401
+
+        run(scenario)
+
+    def test_sends_upcoming_events_when_opened(
+            self, application, session_key, test_user_calendar
+    ):
+        start = timezone.now().replace(microsecond=0) + timedelta(minutes=5)
+        Event(google_id='1',
+              name='Soon',
+              calendar=test_user_calendar,
+              start=start,
+              end=start + timedelta(hours=1)).save()
+
+        async def scenario():
+            stream = await open_stream(application, session_key)
+            response_start = await stream.receive_output(timeout=2)
+            assert response_start['status'] == 200
+            assert (b'content-type', b'text/event-stream') \
+                   in response_start['headers']
+            assert await next_events(stream) == [{
+                'start': int(start.timestamp()),
+                'name': 'Soon',
+                'calendar': 'test_calendar'
+            }]
+            await close(stream)
+
+        run(scenario)
+
+    def test_pushes_upcoming_events_when_a_sync_changes_them(
+            self, application, session_key, logged_in_test_user,
+            test_user_calendar, django_capture_on_commit_callbacks
+    ):
+        async def scenario():
+            stream = await open_stream(application, session_key)
+            await stream.receive_output(timeout=2)
+            assert await next_events(stream) == []
+
+            await sync_to_async(sync)()
+
+            assert [e['name'] for e in await next_events(stream)] == ['New']
+            await close(stream)
+
+        def sync():
+            Event(google_id='1',
+                  name='New',
+                  calendar=test_user_calendar,
+                  start=timezone.now(),
+                  end=timezone.now()).save()
+            with django_capture_on_commit_callbacks(execute=True):
+                bump_data_version([logged_in_test_user.id])
+
+        run(scenario)
+
+    def test_streams_of_a_user_share_the_events_pushed_after_a_sync(
+            self, application, session_key, logged_in_test_user,
+            test_user_calendar, django_capture_on_commit_callbacks
+    ):
+        async def scenario():
+            streams_of_user = [await open_stream(application, session_key)
+                               for _ in range(3)]
+            for stream in streams_of_user:
+                await stream.receive_output(timeout=2)
+                await next_events(stream)
+
+            with patch.object(streams,
+                              'upcoming_events',
+                              wraps=streams.upcoming_events) as query_mock:
+                await sync_to_async(sync)()
+                for stream in streams_of_user:
+                    assert [e['name'] for e in await next_events(stream)] \
+                           == ['New']
+
+            query_mock.assert_called_once()
+            for stream in streams_of_user:
+                await close(stream)
+
+        def sync():
+            Event(google_id='1',
+                  name='New',
+                  calendar=test_user_calendar,
+                  start=timezone.now(),
+                  end=timezone.now()).save()
+            with django_capture_on_commit_callbacks(execute=True):
+                bump_data_version([logged_in_test_user.id])
+
+        run(scenario)
+
+    def test_sends_heartbeats_while_idle(
+            self, application, session_key, settings
+    ):
+        settings.TIMERS_STREAM_HEARTBEAT_SECONDS = 0.01
+
+        async def scenario():
+            stream = await open_stream(application, session_key)
+            await stream.receive_output(timeout=2)
+            await next_events(stream)
+            assert await next_body(stream) == ': heartbeat\n\n'
+            await close(stream)
+
+        run(scenario)
+
+    def test_unsubscribes_when_disconnected(self, application, session_key):
+        async def scenario():
+            stream = await open_stream(application, session_key)
+            await stream.receive_output(timeout=2)
+            await next_events(stream)
+            assert brokers.broker().subscribed_user_ids()
+
+            await close(stream)
+
+            assert not brokers.broker().subscribed_user_ids()
+
+        run(scenario)
+
+    def test_leaves_other_requests_to_django(
+            self, application, django_application
+    ):
+        async def scenario():
+            stream = await open_stream(application, path='/')
+            await stream.wait(timeout=2)
+
+        run(scenario)
+
+        django_application.assert_awaited_once()
+
+
+class TestPollingBroker:
+    def test_notices_changes_made_by_other_processes(
+            self, test_user, settings
+    ):
+        settings.TIMERS_STREAM_POLL_SECONDS = 0.01
+        sync_state = UserSyncState.objects.create(user=test_user)
+        broker = brokers.PollingBroker()
+
+        async def scenario():
+            async with broker.subscribe(test_user.id) as subscription:
+                assert not await subscription.wait(0.05)
+
+                # Not published: as if bumped by another process
+                await sync_to_async(
+                        UserSyncState.objects
+                        .filter(id=sync_state.id)
+                        .update
+                )(data_version=1)
+
+                assert await subscription.wait(1)
+
+        run(scenario)
+
+
+class TestLocalBroker:
+    def test_counts_the_changes_of_the_users_with_a_subscription(self):
+        broker = brokers.LocalBroker()
+
+        async def scenario():
+            async with broker.subscribe(1):
+                broker.publish([1, 2])
+                broker.publish([1])
+
+                assert broker.changes_of(1) == 2
+                assert broker.changes_of(2) == 0
+            assert broker.changes_of(1) == 0
+
+        run(scenario)
@@ -0,0 +1,241 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+from allauth.socialaccount.models import SocialToken
+from django.db import connection
+from django.utils import timezone as django_timezone
+
+import timers.tokens as tokens
+from alwaysontime.settings import GOOGLE_SCOPES
+from conftest import TEST_GOOGLE_TOKEN, TEST_GOOGLE_REFRESH_TOKEN, \
+    TEST_GOOGLE_APP_CLIENT_ID, TEST_GOOGLE_APP_SECRET
+from timers.models import TokenRefresh
+
+pytestmark = pytest.mark.django_db
+
+NOW = datetime(2021, 12, 24, 19, 30, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def now():
+    with patch.object(tokens, 'timezone') as timezone_mock:
+        timezone_mock.now.return_value = NOW
+        timezone_mock.make_naive.side_effect = \
+            lambda dt, tz: dt.astimezone(tz).replace(tzinfo=None)
+        yield
+
+
+@pytest.fixture
+def refresh_mock():
+    def refresh(credentials, request):
+        credentials.token = 'refreshed_token'
+        credentials.expiry = NOW.replace(tzinfo=None) + timedelta(hours=1)
+
+    with patch.object(tokens.Credentials,
+                      'refresh',
+                      autospec=True,
+                      side_effect=refresh) as refresh_mock:
+        yield refresh_mock
+
+
+@pytest.fixture
+def start_background_refresh_mock():
+    with patch.object(tokens, '_start_background_refresh') as mock:
+        yield mock
+
+
+def credentials_for(user):
+    return tokens.credentials_from(tokens.social_token_of(user))
+
+
+def set_token_expiry(expires_at):
+    SocialToken.objects.update(expires_at=expires_at)
+
+
+class TestCredentialsFrom:
+    def test_create_credentials_from_user_token_using_google_app(
+            self, test_user
+    ):
+        set_token_expiry(NOW + timedelta(hours=1))
+
+        credentials = credentials_for(test_user)
+
+        assert credentials.token == TEST_GOOGLE_TOKEN
+        assert credentials.refresh_token == TEST_GOOGLE_REFRESH_TOKEN
+        assert credentials.token_uri == 'https://oauth2.googleapis.com/token'
+        assert credentials.client_id == TEST_GOOGLE_APP_CLIENT_ID
+        assert credentials.client_secret == TEST_GOOGLE_APP_SECRET
+        assert credentials.scopes == GOOGLE_SCOPES
+        assert credentials.expiry == datetime(2021, 12, 24, 20, 30)
+
+    def test_dont_refresh_token_far_from_expiring(
+            self, test_user, refresh_mock, start_background_refresh_mock
+    ):
+        set_token_expiry(NOW + timedelta(hours=1))
+
+        credentials_for(test_user)
+
+        refresh_mock.assert_not_called()
+        start_background_refresh_mock.assert_not_called()
+
+    def test_dont_refresh_token_without_expiry(
+            self, test_user, refresh_mock, start_background_refresh_mock
+    ):
+        credentials_for(test_user)
+
+        refresh_mock.assert_not_called()
+        start_background_refresh_mock.assert_not_called()
+
+    def test_refresh_expired_token_and_save_it(
+            self, test_user, refresh_mock
+    ):
+        set_token_expiry(NOW - timedelta(minutes=1))
+
+        credentials = credentials_for(test_user)
+
+        refresh_mock.assert_called_once()
+        assert credentials.token == 'refreshed_token'
+        social_token = SocialToken.objects.get()
+        assert social_token.token == 'refreshed_token'
+        assert social_token.token_secret == TEST_GOOGLE_REFRESH_TOKEN
+        assert social_token.expires_at == NOW + timedelta(hours=1)
+
+    def test_refresh_token_about_to_expire_in_the_background(
+            self, test_user, refresh_mock, start_background_refresh_mock,
+            settings
+    ):
+        settings.TIMERS_TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+        set_token_expiry(NOW + timedelta(minutes=4))
+
+        credentials = credentials_for(test_user)
+
+        start_background_refresh_mock.assert_called_once_with(
+                SocialToken.objects.get().id
+        )
+        refresh_mock.assert_not_called()
+        assert credentials.token == TEST_GOOGLE_TOKEN
+
+
+class TestRefreshToken:
+    def test_dont_refresh_token_already_refreshed_by_a_concurrent_call(
+            self, test_user, refresh_mock
+    ):
+        set_token_expiry(NOW + timedelta(hours=1))
+
+        social_token = tokens.refresh_token(SocialToken.objects.get().id)
+
+        refresh_mock.assert_not_called()
+        assert social_token.token == TEST_GOOGLE_TOKEN
+
+    def test_save_new_refresh_token_if_google_sends_one(self, test_user):
+        def refresh(credentials, request):
+            credentials.token = 'refreshed_token'
+            credentials._refresh_token = 'new_refresh_token'
+            credentials.expiry = NOW.replace(tzinfo=None)
+
+        set_token_expiry(NOW - timedelta(minutes=1))
+        with patch.object(tokens.Credentials,
+                          'refresh',
+                          autospec=True,
+                          side_effect=refresh):
+            tokens.refresh_token(SocialToken.objects.get().id)
+
+        assert SocialToken.objects.get().token_secret == 'new_refresh_token'
+
+    @pytest.mark.django_db(transaction=True)
+    def test_refresh_token_outside_of_any_transaction(self, test_user):
+        in_transaction = []
+
+        def refresh(credentials, request):
+            in_transaction.append(connection.in_atomic_block)
+            credentials.token = 'refreshed_token'
+            credentials.expiry = NOW.replace(tzinfo=None) + timedelta(hours=1)
+
+        set_token_expiry(NOW - timedelta(minutes=1))
+        with patch.object(tokens.Credentials,
+                          'refresh',
+                          autospec=True,
+                          side_effect=refresh):
+            tokens.refresh_token(SocialToken.objects.get().id)
+
+        assert in_transaction == [False]
+        assert TokenRefresh.objects.get().lease_owner is None
+
+    def test_wait_for_token_being_refreshed_by_another_process(
+            self, test_user, refresh_mock
+    ):
+        set_token_expiry(NOW - timedelta(minutes=1))
+        social_token = SocialToken.objects.get()
+        TokenRefresh.objects.create(
+                social_token=social_token,
+                lease_owner='other process',
+                lease_expires_at=django_timezone.now() + timedelta(minutes=1)
+        )
+
+        def other_process_refreshes(rows, timeout):
+            SocialToken.objects.update(token='refreshed_token',
+                                       expires_at=NOW + timedelta(hours=1))
+            return True
+
+        with patch.object(tokens.leases,
+                          'wait_for_release',
+                          side_effect=other_process_refreshes):
+            social_token = tokens.refresh_token(social_token.id)
+
+        refresh_mock.assert_not_called()
+        assert social_token.token == 'refreshed_token'
+
+    def test_forget_lock_of_token_once_refreshed(
+            self, test_user, refresh_mock
+    ):
+        set_token_expiry(NOW - timedelta(minutes=1))
+
+        tokens.refresh_token(SocialToken.objects.get().id)
+
+        refresh_mock.assert_called_once()
+        assert tokens._refresh_locks == {}
+
+    def test_keep_lock_of_token_while_threads_wait_for_it(self):
+        holding = threading.Event()
+        done = threading.Event()
+
+        def refresh():
+            with tokens._refresh_lock(42):
+                holding.set()
+                done.wait()
+
+        with tokens._refresh_lock(42):
+            thread = threading.Thread(target=refresh)
+            thread.start()
+            while tokens._refresh_locks[42][1] < 2:
+                time.sleep(0.01)
+        holding.wait()
+
+        assert tokens._is_being_refreshed(42)
+        done.set()
+        thread.join()
+        assert not tokens._is_being_refreshed(42)
+
+
+class TestBackgroundRefresh:
+    @patch.object(tokens.threading, 'Thread')
+    def test_dont_start_another_refresh_of_a_token_being_refreshed(
+            self, ThreadMock
+    ):
+        with tokens._refresh_lock(42):
+            tokens._start_background_refresh(42)
+        ThreadMock.assert_not_called()
+
+        tokens._start_background_refresh(42)
+        ThreadMock.assert_called_once()
+
+    @patch.object(tokens, 'connection')
+    @patch.object(tokens, 'refresh_token', side_effect=Exception('Boom'))
+    def test_failed_background_refresh_is_only_logged(
+            self, _, connection_mock
+    ):
+        tokens._refresh_in_background(42)
+        connection_mock.close.assert_called_once()
@@ -1,9 +1,10 @@
 # Create your tests here.
 import json
 from datetime import timedelta
-from unittest.mock import patch
+from unittest.mock import patch, AsyncMock
 
 import pytest
+from django.test import Client
 from django.urls import reverse
 from django.utils import timezone
 from pytest_django.asserts import assertRedirects, assertTemplateUsed, \
@@ -11,7 +12,8 @@ from pytest_django.asserts import assertRedirects, assertTemplateUsed, \
 
 import conftest
 import timers.views
-from timers.models import Event, Calendar
+from timers.dashboard import bump_data_version
+from timers.models import Event, Calendar, UserSyncState
 
 pytestmark = pytest.mark.django_db
 
@@ -209,6 +211,26 @@ class TestHomePage:
                     f'href="{reverse("account_logout")}'
             )
 
+        def test_refresh_events_on_page_load(
+                self, client, logged_in_test_user, settings
+        ):
+            settings.TIMERS_REFRESH_ON_PAGE_LOAD = True
+            response = client.get('/')
+            assertContains(response, "fetch('/events/refresh')", count=1)
+
+        def test_polls_upcoming_events_if_active_calendars(
+                self, client, logged_in_test_user, test_user_calendar
+        ):
+            response = client.get('/')
+            assertContains(response, "fetch('/events/upcoming/'")
+
+        def test_do_not_refresh_events_on_page_load_if_synced_in_background(
+                self, client, logged_in_test_user, settings
+        ):
+            settings.TIMERS_REFRESH_ON_PAGE_LOAD = False
+            response = client.get('/')
+            assertNotContains(response, "fetch('/events/refresh')")
+
 
 class TestSettings:
     def test_redirects_if_user_not_logged_in(self, client):
@@ -294,6 +316,13 @@ class TestSettings:
         response = client.get('/settings/')
         assertContains(response, f'href="{reverse("index")}"')
 
+    def test_do_not_refresh_calendars_on_page_load_if_synced_in_background(
+            self, client, logged_in_test_user, settings
+    ):
+        settings.TIMERS_REFRESH_ON_PAGE_LOAD = False
+        response = client.get('/settings/')
+        assertNotContains(response, "fetch('/calendars/refresh')")
+
 
 class TestRefreshEvents:
     def test_returns_error_if_user_not_logged_in(self, client):
@@ -302,14 +331,118 @@ class TestRefreshEvents:
                        "Please log in before refreshing!",
                        status_code=401)
 
-    @patch.object(timers.views, 'refresh_events')
+    @patch.object(timers.views, 'refresh_events_once')
     def test_refreshes_the_events_of_logged_in_user(
             self, refresh_events_mock, logged_in_test_user, client
     ):
+        refresh_events_mock.return_value = 2
+
         response = client.post('/events/refresh/')
 
-        assertContains(response, "Ok", status_code=200)
-        refresh_events_mock.assert_called_with(logged_in_test_user)
+        assert response.json() == {'refreshed_calendars': 2}
+        refresh_events_mock.assert_called_with(logged_in_test_user,
+                                               force=False)
+
+    @patch.object(timers.views, 'refresh_events_once')
+    def test_can_force_refresh_of_fresh_events(
+            self, refresh_events_mock, logged_in_test_user, client
+    ):
+        refresh_events_mock.return_value = 1
+
+        client.post('/events/refresh/?force=1')
+
+        refresh_events_mock.assert_called_with(logged_in_test_user,
+                                               force=True)
+
+
+class TestRefreshEventsAsync:
+    def test_returns_error_if_user_not_logged_in(self, client):
+        response = client.post('/events/refresh/async/')
+        assertContains(response,
+                       "Please log in before refreshing!",
+                       status_code=401)
+
+    @patch.object(timers.views, 'refresh_events_async', new_callable=AsyncMock)
+    def test_refreshes_the_events_of_logged_in_user(
+            self, refresh_events_mock, logged_in_test_user, client
+    ):
+        refresh_events_mock.return_value = 2
+
+        response = client.post('/events/refresh/async/?force=1')
+
+        assert response.json() == {'refreshed_calendars': 2}
+        refresh_events_mock.assert_awaited_with(logged_in_test_user,
+                                                force=True)
+
+
+class TestUpcomingEvents:
+    @pytest.fixture
+    def sync_state(self, test_user):
+        return UserSyncState.objects.create(user=test_user)
+
+    def test_returns_error_if_user_not_logged_in(self, client):
+        response = client.get('/events/upcoming/')
+        assertContains(response, "Please log in!", status_code=401)
+
+    def test_returns_events_to_show_in_compact_form(
+            self, client, logged_in_test_user, test_user_calendar, sync_state
+    ):
+        start = timezone.now().replace(microsecond=0) + timedelta(minutes=5)
+        Event(google_id='1',
+              name='Soon',
+              calendar=test_user_calendar,
+              start=start,
+              end=start + timedelta(hours=1)).save()
+
+        response = client.get('/events/upcoming/')
+
+        assert response.json() == {'events': [{
+            'start': int(start.timestamp()),
+            'name': 'Soon',
+            'calendar': 'test_calendar'
+        }]}
+        assert response.headers['Cache-Control'] == 'private, no-cache'
+
+    def test_not_modified_while_data_version_and_period_are_the_same(
+            self, client, logged_in_test_user, sync_state, assert_query_budget
+    ):
+        etag = client.get('/events/upcoming/').headers['ETag']
+
+        with assert_query_budget(1):
+            response = client.get('/events/upcoming/',
+                                  HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+
+    def test_modified_when_data_version_changes(
+            self, client, logged_in_test_user, sync_state
+    ):
+        etag = client.get('/events/upcoming/').headers['ETag']
+        bump_data_version([logged_in_test_user.id])
+
+        response = client.get('/events/upcoming/', HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+    def test_modified_in_the_next_period(
+            self, client, logged_in_test_user, sync_state, settings
+    ):
+        settings.TIMERS_UPCOMING_EVENTS_PERIOD_SECONDS = 60
+        now = timezone.now()
+        etag = client.get('/events/upcoming/').headers['ETag']
+
+        with patch.object(timers.views, 'timezone') as timezone_mock:
+            timezone_mock.now.return_value = now + timedelta(seconds=60)
+            response = client.get('/events/upcoming/',
+                                  HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == 200
+
+    def test_no_etag_before_first_sync(self, client, logged_in_test_user):
+        response = client.get('/events/upcoming/')
+        assert 'ETag' not in response.headers
 
 
 class TestRefreshCalendars:
@@ -319,14 +452,55 @@ class TestRefreshCalendars:
                        "Please log in before refreshing!",
                        status_code=401)
 
-    @patch.object(timers.views, 'refresh_calendars')
+    @patch.object(timers.views, 'refresh_calendars_once')
     def test_refreshes_the_events_of_logged_in_user(
             self, refresh_calendars_mock, logged_in_test_user, client
     ):
-        response = client.post('/calendars/refresh/')
+        refresh_calendars_mock.return_value = False
 
-        assertContains(response, "Ok", status_code=200)
-        refresh_calendars_mock.assert_called_with(logged_in_test_user)
+        response = client.post('/calendars/refresh/?force=1')
+
+        assert response.json() == {'refreshed': False}
+        refresh_calendars_mock.assert_called_with(logged_in_test_user,
+                                                  force=True)
+
+
+class TestRefreshCalendarsAsync:
+    def test_returns_error_if_user_not_logged_in(self, client):
+        response = client.post('/calendars/refresh/async/')
+        assertContains(response,
+                       "Please log in before refreshing!",
+                       status_code=401)
+
+    @patch.object(timers.views,
+                  'refresh_calendars_async',
+                  new_callable=AsyncMock)
+    def test_refreshes_the_calendars_of_logged_in_user(
+            self, refresh_calendars_mock, logged_in_test_user, client
+    ):
+        refresh_calendars_mock.return_value = True
+
+        response = client.post('/calendars/refresh/async/')
+
+        assert response.json() == {'refreshed': True}
+        refresh_calendars_mock.assert_awaited_with(logged_in_test_user,
+                                                   force=False)
+
+
+class TestRefreshStats:
+    def test_only_available_to_staff(self, client, logged_in_test_user):
+        response = client.get('/refresh/stats/')
+        assert response.status_code == 302
+
+    def test_returns_counters(self, client, logged_in_test_user):
+        logged_in_test_user.is_staff = True
+        logged_in_test_user.save()
+
+        response = client.get('/refresh/stats/')
+
+        assert response.json() == {'started': 0,
+                                   'coalesced_in_process': 0,
+                                   'coalesced_across_processes': 0}
 
 
 class TestUpdateCalendar:
@@ -343,6 +517,22 @@ class TestUpdateCalendar:
         calendar = Calendar.objects.get(id=test_user_calendar.id)
         assert calendar.active
 
+    def test_activates_events_of_calendar_too(
+            self, client, logged_in_test_user, test_user_calendar):
+        test_user_calendar.active = False
+        test_user_calendar.save()
+        Event(google_id='1',
+              name='event',
+              calendar=test_user_calendar,
+              start=timezone.now(),
+              end=timezone.now()).save()
+
+        client.post(f'/calendars/{test_user_calendar.id}/',
+                    json.dumps({'active': True}),
+                    content_type="application/json")
+
+        assert Event.objects.get().active
+
     def test_returns_error_if_user_not_logged_in(
             self, client, test_user_calendar
     ):
@@ -396,3 +586,133 @@ class TestUpdateCalendar:
                        status_code=404)
         cal = Calendar.objects.get(id=another_user_calendar.id)
         assert not cal.active
+
+
+class TestCalendarsNotifications:
+    @pytest.fixture
+    def watched_calendar(self, test_user_calendar):
+        test_user_calendar.channel_id = 'channel_id'
+        test_user_calendar.channel_token = 'secret_token'
+        test_user_calendar.save()
+        return test_user_calendar
+
+    def notify(self, client, channel_id, token):
+        return client.post('/calendars/notifications/',
+                           HTTP_X_GOOG_CHANNEL_ID=channel_id,
+                           HTTP_X_GOOG_CHANNEL_TOKEN=token,
+                           HTTP_X_GOOG_RESOURCE_STATE='exists')
+
+    def test_marks_calendar_as_due(self, watched_calendar):
+        # Google doesn't log in, nor sends a CSRF token
+        client = Client(enforce_csrf_checks=True)
+
+        response = self.notify(client, 'channel_id', 'secret_token')
+
+        assertContains(response, "Ok")
+        watched_calendar.refresh_from_db()
+        assert watched_calendar.next_sync_at is not None
+
+    def test_returns_error_if_token_is_wrong(self, client, watched_calendar):
+        response = self.notify(client, 'channel_id', 'wrong_token')
+
+        assertContains(response, "Unknown channel", status_code=404)
+        watched_calendar.refresh_from_db()
+        assert watched_calendar.next_sync_at is None
+
+    def test_returns_error_if_token_is_not_ascii(
+            self, client, watched_calendar
+    ):
+        response = self.notify(client, 'channel_id', 'sécret_token')
+
+        assertContains(response, "Unknown channel", status_code=404)
+
+    def test_only_accepts_post(self, client, watched_calendar):
+        response = client.get('/calendars/notifications/')
+        assert response.status_code == 405
+
+
+class TestQueryBudgets:
+    """See the docstrings of the views"""
+
+    @pytest.fixture
+    def dashboard(self, test_user, test_user_calendar):
+        UserSyncState.objects.create(user=test_user)
+        for i in range(10):
+            Event(google_id=str(i),
+                  name=str(i),
+                  calendar=test_user_calendar,
+                  start=timezone.now() + timedelta(minutes=i),
+                  end=timezone.now() + timedelta(hours=1)).save()
+
+    def test_home_page(
+            self, client, logged_in_test_user, dashboard, assert_query_budget
+    ):
+        with assert_query_budget(4):
+            client.get('/')
+
+    def test_home_page_cached(
+            self, client, logged_in_test_user, dashboard, assert_query_budget
+    ):
+        client.get('/')
+        with assert_query_budget(2):
+            client.get('/')
+
+    def test_settings_page(
+            self, client, logged_in_test_user, test_user_calendar,
+            another_user_calendar, assert_query_budget
+    ):
+        with assert_query_budget(2):
+            client.get('/settings/')
+
+    def test_update_calendar(
+            self, client, logged_in_test_user, test_user_calendar,
+            assert_query_budget
+    ):
+        with assert_query_budget(4):
+            client.post(f'/calendars/{test_user_calendar.id}/',
+                        json.dumps({'active': False}),
+                        content_type="application/json")
+
+    def test_update_calendar_of_another_user(
+            self, client, logged_in_test_user, another_user_calendar,
+            assert_query_budget
+    ):
+        with assert_query_budget(1):
+            client.post(f'/calendars/{another_user_calendar.id}/',
+                        json.dumps({'active': False}),
+                        content_type="application/json")
+
+    @patch.object(timers.views, 'refresh_events_once')
+    def test_refresh_events_only_runs_the_queries_of_the_refresh(
+            self, refresh_events_mock, client, logged_in_test_user,
+            assert_query_budget
+    ):
+        refresh_events_mock.return_value = 0
+        with assert_query_budget(0):
+            client.post('/events/refresh/')
+
+    def test_notification(self, client, test_user_calendar,
+                          assert_query_budget):
+        test_user_calendar.channel_id = 'channel_id'
+        test_user_calendar.channel_token = 'secret_token'
+        test_user_calendar.save()
+
+        with assert_query_budget(2, logged_in=False):
+            client.post('/calendars/notifications/',
+                        HTTP_X_GOOG_CHANNEL_ID='channel_id',
+                        HTTP_X_GOOG_CHANNEL_TOKEN='secret_token',
+                        HTTP_X_GOOG_RESOURCE_STATE='exists')
+
+    def test_refresh_stats(self, client, logged_in_test_user,
+                           assert_query_budget):
+        logged_in_test_user.is_staff = True
+        logged_in_test_user.save()
+
+        with assert_query_budget(0):
+            client.get('/refresh/stats/')
+
+    @patch.object(timers.views.requests, 'post')
+    def test_revoke(self, post_mock, client, logged_in_test_user,
+                    assert_query_budget):
+        with assert_query_budget(3):
+            client.get('/revoke/')
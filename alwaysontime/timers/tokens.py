@@ -0,0 +1,171 @@
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta, timezone as dt_timezone
+
+from allauth.socialaccount.models import SocialToken
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from timers import leases
+from timers.models import TokenRefresh
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_TOKEN_URI = 'https://oauth2.googleapis.com/token'
+
+# One lock per token, so only one thread of the process refreshes it at a
+# time: token id -> [its lock, number of threads holding or waiting for it].
+# Forgotten once no thread needs it, so it doesn't grow with every token.
+_refresh_locks = {}
+_refresh_locks_guard = threading.Lock()
+
+
+def social_token_of(user):
+    return SocialToken.objects \
+        .select_related('app') \
+        .get(account__user=user)
+
+
+def credentials_from(social_token):
+    """
+    Returns the Google credentials of 'social_token'.
+
+    An expired token is refreshed before returning. A token about to expire
+    (see `TIMERS_TOKEN_REFRESH_MARGIN_SECONDS`) is refreshed in the background
+    while the current one is still used. Refreshed tokens are saved in the
+    `SocialToken`, so the next requests don't refresh them again.
+    """
+    if _is_expired(social_token):
+        social_token = refresh_token(social_token.id)
+    elif _expires_soon(social_token):
+        _start_background_refresh(social_token.id)
+
+    return _to_credentials(social_token)
+
+
+def refresh_token(social_token_id):
+    """
+    Refreshes the token and saves it, unless a concurrent refresh already did.
+
+    Only one refresh of a token runs at a time: across the threads of the
+    process thanks to a lock, and across processes thanks to the lease of its
+    `TokenRefresh` row. No transaction is open while Google refreshes it, so
+    the DB isn't locked meanwhile. Returns the up-to-date `SocialToken`.
+    """
+    with _refresh_lock(social_token_id):
+        social_token = _load_token(social_token_id)
+        if not _expires_soon(social_token):
+            # Refreshed while waiting for the lock
+            return social_token
+
+        TokenRefresh.objects.get_or_create(social_token_id=social_token_id)
+        refresh = TokenRefresh.objects.filter(social_token_id=social_token_id)
+        owner = leases.new_owner()
+        claimed = leases.claim(refresh, owner)
+        if not claimed:
+            # Being refreshed by another process
+            leases.wait_for_release(
+                    refresh,
+                    settings.TIMERS_SINGLE_FLIGHT_TIMEOUT_SECONDS
+            )
+            return _load_token(social_token_id)
+
+        try:
+            # Re-read: another process may have refreshed it before the claim
+            social_token = _load_token(social_token_id)
+            if not _expires_soon(social_token):
+                return social_token
+
+            credentials = _to_credentials(social_token)
+            credentials.refresh(Request())
+
+            social_token.token = credentials.token
+            # 'google-auth' uses naive datetimes in UTC
+            social_token.expires_at = \
+                credentials.expiry.replace(tzinfo=dt_timezone.utc)
+            if credentials.refresh_token:
+                social_token.token_secret = credentials.refresh_token
+            social_token.save(
+                    update_fields=['token', 'expires_at', 'token_secret']
+            )
+            return social_token
+        finally:
+            leases.release(claimed, owner)
+
+
+def _load_token(social_token_id):
+    return SocialToken.objects \
+        .select_related('app') \
+        .get(id=social_token_id)
+
+
+def _start_background_refresh(social_token_id):
+    if _is_being_refreshed(social_token_id):
+        # Already being refreshed by this process
+        return
+    threading.Thread(target=_refresh_in_background,
+                     args=(social_token_id,),
+                     daemon=True).start()
+
+
+def _refresh_in_background(social_token_id):
+    try:
+        refresh_token(social_token_id)
+    except Exception:
+        # The token is refreshed again when it expires
+        logger.exception("Couldn't refresh token '%s' in the background",
+                         social_token_id)
+    finally:
+        # Every thread gets its own connection, which isn't closed otherwise
+        connection.close()
+
+
+@contextmanager
+def _refresh_lock(social_token_id):
+    with _refresh_locks_guard:
+        lock_and_users = _refresh_locks.setdefault(social_token_id,
+                                                   [threading.Lock(), 0])
+        lock_and_users[1] += 1
+    try:
+        with lock_and_users[0]:
+            yield
+    finally:
+        with _refresh_locks_guard:
+            lock_and_users[1] -= 1
+            if not lock_and_users[1]:
+                del _refresh_locks[social_token_id]
+
+
+def _is_being_refreshed(social_token_id):
+    with _refresh_locks_guard:
+        return social_token_id in _refresh_locks
+
+
+def _is_expired(social_token):
+    return social_token.expires_at is not None \
+           and social_token.expires_at <= timezone.now()
+
+
+def _expires_soon(social_token):
+    margin = timedelta(seconds=settings.TIMERS_TOKEN_REFRESH_MARGIN_SECONDS)
+    return social_token.expires_at is not None \
+           and social_token.expires_at <= timezone.now() + margin
+
+
+def _to_credentials(social_token):
+    expiry = None
+    if social_token.expires_at is not None:
+        expiry = timezone.make_naive(social_token.expires_at, dt_timezone.utc)
+    return Credentials(
+            token=social_token.token,
+            refresh_token=social_token.token_secret,
+            expiry=expiry,
+            token_uri=GOOGLE_TOKEN_URI,
+            client_id=social_token.app.client_id,
+            client_secret=social_token.app.secret,
+            scopes=settings.GOOGLE_SCOPES
+    )
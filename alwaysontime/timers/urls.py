@@ -10,9 +10,20 @@ urlpatterns = [
          views.refresh_events_in_db,
          name='refresh_events_in_db'),
     path('events/refresh/', views.events_refresh, name='events_refresh'),
+    path('events/refresh/async/',
+         views.events_refresh_async,
+         name='events_refresh_async'),
+    path('events/upcoming/', views.events_upcoming, name='events_upcoming'),
     path('calendars/refresh/',
          views.calendars_refresh,
          name='calendars_refresh'),
+    path('calendars/refresh/async/',
+         views.calendars_refresh_async,
+         name='calendars_refresh_async'),
+    path('refresh/stats/', views.refresh_stats, name='refresh_stats'),
+    path('calendars/notifications/',
+         views.calendars_notifications,
+         name='calendars_notifications'),
     path('calendars/<int:cal_id>/',
          views.calendars_update,
          name='calendars_update'),
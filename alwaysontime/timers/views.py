@@ -4,40 +4,42 @@ from functools import wraps
 
 import requests
 from allauth.socialaccount.models import SocialToken
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, \
+    JsonResponse
 from django.shortcuts import render, redirect
 from django.utils import timezone
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 from googleapiclient.errors import HttpError
+from ratelimit.core import is_ratelimited
 from ratelimit.decorators import ratelimit
+from ratelimit.exceptions import Ratelimited
 
-from alwaysontime.settings import GOOGLE_SCOPES
-from timers.calendar import refresh_events, refresh_calendars
-from timers.models import Event, Calendar
+from timers.calendar import set_calendars_active, refresh_events_async, \
+    refresh_calendars_async
+from timers.channels import handle_notification
+from timers.clients import calendar_api_for, forget_calendar_api_of
+from timers.dashboard import dashboard_of, data_version_of, \
+    period_start_of, upcoming_events
+from timers.models import Calendar
+from timers.singleflight import refresh_events_once, \
+    refresh_calendars_once, counters as singleflight_counters
 
 
-def with_authenticated_calendar_service(endpoint_func):
+def with_calendar_api(endpoint_func):
     @wraps(endpoint_func)
     def wrapper(request):
-        social_token = SocialToken.objects.get(account__user=request.user)
-        creds = Credentials(token=social_token.token,
-                            refresh_token=social_token.token_secret,
-                            token_uri='https://oauth2.googleapis.com/token',
-                            client_id=social_token.app.client_id,
-                            client_secret=social_token.app.secret,
-                            scopes=GOOGLE_SCOPES)
-        if creds.expired:
-            creds.refresh(Request())
-            print("Token refreshed!")
+        calendar_api = calendar_api_for(request.user)
 
         try:
-            service = build('calendar', 'v3', credentials=creds)
-            resp = endpoint_func(request, service)
+            resp = endpoint_func(request, calendar_api)
 
         except HttpError as error:
             print('An error occurred: %s' % error)
@@ -54,55 +56,117 @@ def google_account_required(view_func):
         if not request.user.is_authenticated:
             raise RuntimeError("Only use this decorator in combination "
                                "with '@login_required'")
-        if not SocialToken.objects.filter(account__user=request.user):
+        if not SocialToken.objects.filter(account__user=request.user).exists():
             return redirect('/accounts/social/connections/')
         return view_func(request)
 
     return wrapper
 
 
+def async_ratelimit(key, rate):
+    """
+    `ratelimit(block=True)` for async views
+    """
+
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            if await sync_to_async(is_ratelimited)(request,
+                                                   fn=view_func,
+                                                   key=key,
+                                                   rate=rate,
+                                                   increment=True):
+                raise Ratelimited()
+            return await view_func(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 @login_required
 @google_account_required
 def index(request):
-    now = timezone.now()
-    now_minus_delta = \
-        now - datetime.timedelta(minutes=settings.TIMERS_SHOW_X_MIN_PAST)
-    now_plus_delta = \
-        now + datetime.timedelta(minutes=settings.TIMERS_SHOW_X_MIN_FUTURE)
-
-    active_calendars = Calendar.objects.filter(active=True, user=request.user)
-    events = list(Event.objects.filter(
-            calendar__in=active_calendars,
-            start__gte=now_minus_delta,
-            start__lt=now_plus_delta
-    ).order_by('start'))
+    """
+    Queries: 1 for the Google account, 1 for the data version, then only
+    when not cached: 1 for the calendars, 1 for the events
+    """
+    dashboard = dashboard_of(request.user)
+    events = dashboard['events']
 
     return render(request, 'index.html', {
         'main_event': events[0] if events else None,
         'other_events': events[1:],
-        'active_calendars': [c.name for c in active_calendars]
+        'active_calendars': dashboard['active_calendars'],
+        'refresh_on_page_load': settings.TIMERS_REFRESH_ON_PAGE_LOAD,
+        'show_x_min_past': settings.TIMERS_SHOW_X_MIN_PAST,
+        'show_x_min_future': settings.TIMERS_SHOW_X_MIN_FUTURE,
+        'poll_seconds': settings.TIMERS_UPCOMING_EVENTS_POLL_SECONDS
     })
 
 
+@require_GET
+def events_upcoming(request):
+    """
+    The events to show, see `upcoming_events`, for the home page to poll.
+    Their ETag changes with the data version of the user and with the
+    period, so clients still up to date get a 304.
+
+    Queries: 1 for the data version, then only when changed: 1 for the events
+    """
+    if not request.user.is_authenticated:
+        return HttpResponse("Please log in!", status=401)
+
+    period_start = period_start_of(timezone.now())
+    version = data_version_of(request.user)
+    etag = None
+    if version is not None:
+        etag = quote_etag(f'{request.user.id}.{version}.'
+                          f'{int(period_start.timestamp())}')
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+            response.headers['ETag'] = etag
+            return response
+
+    response = JsonResponse({
+        'events': upcoming_events(request.user, period_start)
+    })
+    if etag:
+        response.headers['ETag'] = etag
+    # Revalidated on every poll
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 @login_required
 @google_account_required
 def settings_page(request):
-    calendars = Calendar.objects.filter(user=request.user)
+    """
+    Queries: 1 for the Google account, 1 for the calendars
+    """
+    calendars = Calendar.objects \
+        .filter(user=request.user) \
+        .values('id', 'name', 'active')
     return render(request, 'settings.html', {
-        'calendars': [{
-            'id': c.id,
-            'name': c.name,
-            'active': c.active
-        } for c in calendars]
+        'calendars': list(calendars),
+        'refresh_on_page_load': settings.TIMERS_REFRESH_ON_PAGE_LOAD
     })
 
 
 @login_required
 def revoke(request):
-    social_token = SocialToken.objects.get(account__user=request.user)
-    requests.post('https://oauth2.googleapis.com/revoke',
-                  params={'token': social_token.token},
-                  headers={'content-type': 'application/x-www-form-urlencoded'})
+    """
+    Queries: 1 for the token, 2 to delete the session
+    """
+    social_token = SocialToken.objects \
+        .only('token') \
+        .get(account__user=request.user)
+    requests.post(
+            'https://oauth2.googleapis.com/revoke',
+            params={'token': social_token.token},
+            headers={'content-type': 'application/x-www-form-urlencoded'}
+    )
+    forget_calendar_api_of(request.user)
     logout(request)
     return redirect('index')
 
@@ -114,55 +178,109 @@ def refresh_events_in_db(request):
 
 
 @login_required
-@with_authenticated_calendar_service
-def sandbox(request, calendar_service):
-    def to_google_format(dt):
-        return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-    list_calendars(calendar_service)
+@with_calendar_api
+def sandbox(request, calendar_api):
+    list_calendars(calendar_api)
 
     now = timezone.now()
     now_minus_1_hour = now - datetime.timedelta(days=1)
     now_plus_7_days = now + datetime.timedelta(days=7)
-    events = calendar_service \
-        .events() \
-        .list(calendarId='primary',
-              timeMin=to_google_format(now_minus_1_hour),
-              timeMax=to_google_format(now_plus_7_days),
-              maxResults=100,
-              singleEvents=True,
-              orderBy='startTime') \
-        .execute() \
-        .get('items', [])
+    events = calendar_api.events('primary',
+                                 before=now_minus_1_hour,
+                                 after=now_plus_7_days,
+                                 order_by='startTime')
 
     return HttpResponse(f'{events=}')
 
 
-def list_calendars(service):
+def list_calendars(calendar_api):
     print("Listing all calendars")
-    calendar_list_result = service.calendarList().list().execute()
-    calendars = calendar_list_result.get('items', [])
-    for c in calendars:
-        print(f"{c['id']=} {c['summary']=}")
+    for c in calendar_api.calendars():
+        print(f"{c['id']=} {c['name']=}")
 
 
 @ratelimit(key='user', rate='600/m', block=True)
 def events_refresh(request):
+    """
+    Queries: only the ones of `refresh_events_once`
+    """
     if not request.user.is_authenticated:
         return HttpResponse("Please log in before refreshing!", status=401)
-    refresh_events(request.user)
-    return HttpResponse("Ok")
+    refreshed = refresh_events_once(request.user,
+                                    force=_is_forced(request))
+    return JsonResponse({'refreshed_calendars': refreshed})
 
 
 @ratelimit(key='user', rate='600/m', block=True)
 def calendars_refresh(request):
+    """
+    Queries: only the ones of `refresh_calendars_once`
+    """
     if not request.user.is_authenticated:
         return HttpResponse("Please log in before refreshing!", status=401)
-    refresh_calendars(request.user)
-    return HttpResponse("Ok")
+    refreshed = refresh_calendars_once(request.user,
+                                       force=_is_forced(request))
+    return JsonResponse({'refreshed': refreshed})
+
+
+@async_ratelimit(key='user', rate='600/m')
+async def events_refresh_async(request):
+    """
+    Async counterpart of `events_refresh`, for ASGI deployments: fetches the
+    events of every calendar concurrently, without tying up a thread.
+    Concurrent refreshes are not coalesced.
+
+    Queries: only the ones of `refresh_events_async`
+    """
+    user = await sync_to_async(_authenticated_user_of)(request)
+    if user is None:
+        return HttpResponse("Please log in before refreshing!", status=401)
+    refreshed = await refresh_events_async(user, force=_is_forced(request))
+    return JsonResponse({'refreshed_calendars': refreshed})
+
+
+@async_ratelimit(key='user', rate='600/m')
+async def calendars_refresh_async(request):
+    """
+    Async counterpart of `calendars_refresh`
+
+    Queries: only the ones of `refresh_calendars_async`
+    """
+    user = await sync_to_async(_authenticated_user_of)(request)
+    if user is None:
+        return HttpResponse("Please log in before refreshing!", status=401)
+    refreshed = await refresh_calendars_async(user, force=_is_forced(request))
+    return JsonResponse({'refreshed': refreshed})
+
+
+def _authenticated_user_of(request):
+    # Loads the user from the DB on first access, can't run in the event loop
+    return request.user if request.user.is_authenticated else None
+
+
+def _is_forced(request):
+    """
+    By default, refreshes skip the data synced recently, see
+    `TIMERS_EVENTS_MAX_STALENESS_SECONDS`. '?force=1' refreshes it anyway.
+    """
+    return request.GET.get('force') == '1'
+
+
+@staff_member_required
+def refresh_stats(request):
+    """
+    How many refreshes ran, and how many concurrent calls were coalesced
+
+    Queries: none, the counters are in the cache
+    """
+    return JsonResponse(singleflight_counters())
 
 
 def calendars_update(request, cal_id):
+    """
+    Queries: 1 for the calendar, 3 to update it, its events and the data
+    version of the user
+    """
     if not request.user.is_authenticated:
         return HttpResponse("Please log in!", status=401)
 
@@ -170,11 +288,27 @@ def calendars_update(request, cal_id):
     if 'active' not in params:
         return HttpResponse("Missing 'active' parameter!", status=400)
 
-    if not Calendar.objects.filter(id=cal_id, user=request.user).exists():
+    if not set_calendars_active(
+            Calendar.objects.filter(id=cal_id, user=request.user),
+            params['active']
+    ):
         return HttpResponse(f"No calendar with id '{cal_id}'", status=404)
 
-    calendar = Calendar.objects.get(id=cal_id)
-    calendar.active = params['active']
-    calendar.save()
+    return HttpResponse("Ok")
+
 
+@csrf_exempt
+@require_POST
+def calendars_notifications(request):
+    """
+    Webhook notified by Google when the events of a calendar change
+
+    Queries: 1 for the channel, 1 to mark its calendar as due
+    """
+    if not handle_notification(
+            channel_id=request.headers.get('X-Goog-Channel-ID'),
+            token=request.headers.get('X-Goog-Channel-Token'),
+            resource_state=request.headers.get('X-Goog-Resource-State')
+    ):
+        return HttpResponse("Unknown channel", status=404)
     return HttpResponse("Ok")